@@ -0,0 +1,357 @@
+"""
+Câmaras ligadas ao servidor (camera_stream / stop_camera).
+
+Cada dispositivo tem uma só thread de captura, por mais pessoas que estejam a
+ver: os frames vão para um buffer circular partilhado e cada frame é
+codificado em JPEG uma vez para todos os espectadores (MJPEG). A leitura dos
+QR codes, só para as marcações no vídeo, corre noutra thread a FPS_LEITURA,
+sempre sobre o frame mais recente.
+
+A captura começa com o primeiro espectador e termina ESPERA_FECHO segundos
+depois de sair o último. stop_camera só termina as transmissões da sessão
+que o pede. O estado é do processo: só um processo deve abrir cada câmara.
+
+ENGEN_CAMERA_DISPOSITIVO=falsa (ou falsa:imagem.png) usa uma fonte de vídeo
+falsa, sem câmara (testes e desenvolvimento).
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from pyzbar import pyzbar
+
+from . import leitura_qr
+
+# Dispositivo por omissão: índice do cv2.VideoCapture ou "falsa[:imagem]"
+DISPOSITIVO = getattr(settings, 'ENGEN_CAMERA_DISPOSITIVO', '0')
+# Frames capturados (e transmitidos) por segundo
+FPS = getattr(settings, 'ENGEN_CAMERA_FPS', 10)
+# Leituras de QR codes por segundo; 0 para não ler
+FPS_LEITURA = getattr(settings, 'ENGEN_CAMERA_FPS_LEITURA', 3)
+# Frames guardados no buffer circular de cada câmara
+TAMANHO_BUFFER = getattr(settings, 'ENGEN_CAMERA_BUFFER', 4)
+# Segundos que a câmara fica aberta depois de sair o último espectador
+ESPERA_FECHO = getattr(settings, 'ENGEN_CAMERA_ESPERA_FECHO', 5)
+
+LARGURA = 640
+ALTURA = 480
+PREFIXO_FALSA = 'falsa'
+# Falhas seguidas de leitura do dispositivo antes de desistir
+MAX_FALHAS = 10
+
+logger = logging.getLogger(__name__)
+
+
+def normalizar_dispositivo(dispositivo):
+    """'0' -> 0 (índice do cv2); outros valores ficam como texto"""
+    dispositivo = str(dispositivo).strip()
+    return int(dispositivo) if dispositivo.isdigit() else dispositivo
+
+
+# ================================
+# FONTES DE VÍDEO
+# ================================
+
+class FonteFalsa:
+    """
+    Fonte de vídeo com a interface do cv2.VideoCapture, sem câmara.
+    Repete as `imagens` dadas, ou gera um fundo cinzento com o número do frame.
+    """
+
+    def __init__(self, imagens=None, largura=LARGURA, altura=ALTURA):
+        self.imagens = [imagem for imagem in imagens or [] if imagem is not None]
+        self.largura = largura
+        self.altura = altura
+        self.lidos = 0
+        self.aberta = True
+
+    def isOpened(self):
+        return self.aberta
+
+    def read(self):
+        if not self.aberta:
+            return False, None
+        self.lidos += 1
+        if self.imagens:
+            return True, self.imagens[(self.lidos - 1) % len(self.imagens)].copy()
+        frame = np.full((self.altura, self.largura, 3), 90, np.uint8)
+        cv2.putText(frame, str(self.lidos), (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        return True, frame
+
+    def release(self):
+        self.aberta = False
+
+
+def abrir_fonte(dispositivo):
+    if isinstance(dispositivo, str) and dispositivo.startswith(PREFIXO_FALSA):
+        caminho = dispositivo[len(PREFIXO_FALSA):].lstrip(':')
+        return FonteFalsa([cv2.imread(caminho)] if caminho else None)
+
+    fonte = cv2.VideoCapture(dispositivo)
+    fonte.set(cv2.CAP_PROP_FRAME_WIDTH, LARGURA)
+    fonte.set(cv2.CAP_PROP_FRAME_HEIGHT, ALTURA)
+    return fonte
+
+
+def parte_mjpeg(jpeg):
+    return b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n'
+
+
+# ================================
+# CAPTURA
+# ================================
+
+class Captura:
+    """Thread de captura de um dispositivo, com buffer circular dos últimos frames"""
+
+    def __init__(self, gestor, dispositivo, fonte, fps=FPS, fps_leitura=FPS_LEITURA, tamanho_buffer=TAMANHO_BUFFER):
+        self.gestor = gestor
+        self.dispositivo = dispositivo
+        self.intervalo = 1 / fps
+        self.intervalo_leitura = 1 / fps_leitura if fps_leitura else 0
+        self._fonte = fonte
+        # (numero, frame, jpeg), do mais antigo para o mais recente
+        self._frames = deque(maxlen=tamanho_buffer)
+        self._numero = 0
+        self._condicao = threading.Condition()
+        # [(rect, codigo)] da última leitura, desenhados nos frames seguintes
+        self.codigos = []
+        self.espectadores = 0
+        self.sem_espectadores_desde = None
+        self.ativa = True
+
+    def iniciar(self):
+        threading.Thread(target=self._capturar, name=f'camera-{self.dispositivo}', daemon=True).start()
+        if self.intervalo_leitura:
+            threading.Thread(target=self._ler_codigos, name=f'camera-{self.dispositivo}-qr', daemon=True).start()
+
+    def ultimo_frame(self):
+        """(numero, jpeg) do frame mais recente; (0, None) se ainda não há nenhum"""
+        with self._condicao:
+            if not self._frames:
+                return 0, None
+            numero, _, jpeg = self._frames[-1]
+            return numero, jpeg
+
+    def esperar_frame(self, visto, timeout=1):
+        """(numero, jpeg) do primeiro frame mais recente do que `visto`; jpeg None se não chegar a tempo"""
+        with self._condicao:
+            self._condicao.wait_for(lambda: self._numero > visto or not self.ativa, timeout)
+            if self._numero <= visto or not self._frames:
+                return visto, None
+            numero, _, jpeg = self._frames[-1]
+            return numero, jpeg
+
+    def _desenhar(self, frame):
+        for (x, y, w, h), codigo in self.codigos:
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+            cv2.putText(frame, codigo, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+
+    def _capturar(self):
+        falhas = 0
+        proximo = time.monotonic()
+        try:
+            while not self.gestor._terminar_se_sem_espectadores(self):
+                sucesso, frame = self._fonte.read()
+                if not sucesso:
+                    falhas += 1
+                    if falhas >= MAX_FALHAS:
+                        logger.warning('Câmara %s deixou de enviar frames', self.dispositivo)
+                        break
+                    time.sleep(self.intervalo)
+                    continue
+                falhas = 0
+
+                # O JPEG com as marcações é feito uma vez, para todos os espectadores
+                marcado = frame.copy()
+                self._desenhar(marcado)
+                _, jpeg = cv2.imencode('.jpg', marcado)
+                with self._condicao:
+                    self._numero += 1
+                    self._frames.append((self._numero, frame, jpeg.tobytes()))
+                    self._condicao.notify_all()
+
+                proximo += self.intervalo
+                espera = proximo - time.monotonic()
+                if espera > 0:
+                    time.sleep(espera)
+                else:
+                    proximo = time.monotonic()
+        except Exception:
+            logger.exception('Erro na captura da câmara %s', self.dispositivo)
+        finally:
+            self._fonte.release()
+            self.gestor._esquecer_captura(self)
+            with self._condicao:
+                self.ativa = False
+                self._condicao.notify_all()
+
+    def _ler_codigos(self):
+        visto = 0
+        while self.ativa:
+            time.sleep(self.intervalo_leitura)
+            with self._condicao:
+                if not self._frames or self._frames[-1][0] == visto:
+                    continue
+                visto, frame, _ = self._frames[-1]
+            try:
+                cinzento = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                self.codigos = [
+                    (tuple(qr_code.rect), qr_code.data.decode('utf-8', 'replace'))
+                    for qr_code in pyzbar.decode(cinzento, symbols=leitura_qr.SIMBOLOS)
+                ]
+            except Exception:
+                logger.exception('Erro na leitura de QR codes da câmara %s', self.dispositivo)
+
+
+# ================================
+# GESTOR
+# ================================
+
+class GestorCameras:
+    """Capturas abertas neste processo, com a contagem de espectadores de cada uma"""
+
+    def __init__(self, abrir_fonte=abrir_fonte, espera_fecho=ESPERA_FECHO):
+        self._abrir_fonte = abrir_fonte
+        self.espera_fecho = espera_fecho
+        self._capturas = {}
+        # dispositivo -> evento assinalado quando acabar de ser aberto
+        self._aberturas = {}
+        # sessão -> eventos de paragem das suas transmissões
+        self._sessoes = {}
+        self._lock = threading.Lock()
+
+    def abrir(self, dispositivo):
+        """Captura do dispositivo com mais um espectador (iniciada se preciso)"""
+        while True:
+            with self._lock:
+                captura = self._capturas.get(dispositivo)
+                if captura is not None and captura.ativa:
+                    captura.espectadores += 1
+                    return captura
+                abertura = self._aberturas.get(dispositivo)
+                if abertura is None:
+                    abertura = self._aberturas[dispositivo] = threading.Event()
+                    break
+            # Outro pedido está a abrir o mesmo dispositivo: esperar e usar a sua captura
+            abertura.wait()
+
+        # Abrir o dispositivo pode demorar segundos: fora do lock, para não parar
+        # os outros dispositivos nem os espectadores que entram e saem
+        try:
+            captura = Captura(self, dispositivo, self._abrir_fonte(dispositivo))
+            captura.espectadores = 1
+            with self._lock:
+                self._capturas[dispositivo] = captura
+            captura.iniciar()
+            return captura
+        finally:
+            with self._lock:
+                del self._aberturas[dispositivo]
+            abertura.set()
+
+    def fechar(self, captura):
+        with self._lock:
+            captura.espectadores -= 1
+            if not captura.espectadores:
+                captura.sem_espectadores_desde = time.monotonic()
+
+    def _terminar_se_sem_espectadores(self, captura):
+        """
+        Chamado pela thread de captura: True se deve terminar. A captura sai logo
+        do gestor, para que um novo espectador abra outra.
+        """
+        with self._lock:
+            if captura.espectadores or captura.sem_espectadores_desde is None:
+                return False
+            if time.monotonic() - captura.sem_espectadores_desde < self.espera_fecho:
+                return False
+            self._retirar(captura)
+            return True
+
+    def _retirar(self, captura):
+        if self._capturas.get(captura.dispositivo) is captura:
+            del self._capturas[captura.dispositivo]
+
+    def _esquecer_captura(self, captura):
+        with self._lock:
+            self._retirar(captura)
+
+    def estado(self):
+        """dispositivo -> número de espectadores"""
+        with self._lock:
+            return {dispositivo: captura.espectadores for dispositivo, captura in self._capturas.items()}
+
+    # ================================
+    # TRANSMISSÕES (MJPEG)
+    # ================================
+
+    def _entrar(self, dispositivo, sessao):
+        parar = threading.Event()
+        captura = self.abrir(dispositivo)
+        with self._lock:
+            self._sessoes.setdefault(sessao, set()).add(parar)
+        return captura, parar
+
+    def _sair(self, captura, sessao, parar):
+        with self._lock:
+            eventos = self._sessoes.get(sessao, set())
+            eventos.discard(parar)
+            if not eventos:
+                self._sessoes.pop(sessao, None)
+        self.fechar(captura)
+
+    def parar_sessao(self, sessao):
+        """Termina as transmissões da sessão. Retorna quantas eram."""
+        with self._lock:
+            eventos = self._sessoes.pop(sessao, set())
+        for parar in eventos:
+            parar.set()
+        return len(eventos)
+
+    def transmitir(self, dispositivo, sessao):
+        """Partes multipart/x-mixed-replace com os frames do dispositivo (WSGI)"""
+        captura, parar = self._entrar(dispositivo, sessao)
+        try:
+            visto = 0
+            while not parar.is_set() and captura.ativa:
+                visto, jpeg = captura.esperar_frame(visto)
+                if jpeg is not None:
+                    yield parte_mjpeg(jpeg)
+        finally:
+            self._sair(captura, sessao, parar)
+
+    async def transmitir_async(self, dispositivo, sessao):
+        """Como transmitir(), sem ocupar uma thread por espectador (ASGI)"""
+        # Abrir o dispositivo pode demorar: fora do ciclo de eventos
+        captura, parar = await sync_to_async(self._entrar, thread_sensitive=False)(dispositivo, sessao)
+        try:
+            visto = 0
+            while not parar.is_set() and captura.ativa:
+                numero, jpeg = captura.ultimo_frame()
+                if jpeg is not None and numero != visto:
+                    visto = numero
+                    yield parte_mjpeg(jpeg)
+                await asyncio.sleep(captura.intervalo / 2)
+        finally:
+            # _sair espera pelo lock do gestor: fora do ciclo de eventos
+            await sync_to_async(self._sair, thread_sensitive=False)(captura, sessao, parar)
+
+
+_gestor = None
+_gestor_lock = threading.Lock()
+
+
+def obter_gestor():
+    """Gestor de câmaras deste processo, criado no primeiro uso"""
+    global _gestor
+    with _gestor_lock:
+        if _gestor is None:
+            _gestor = GestorCameras()
+        return _gestor
@@ -0,0 +1,168 @@
+"""
+Canal WebSocket do scan do funcionário (ws/funcionario/scan/).
+
+A autenticação é feita uma vez, na ligação (sessão do Django). Depois:
+  - mensagens binárias: frames da câmara (JPEG/PNG), lidos no pool de leitura
+    (ver leitura_qr.py) fora do ciclo de eventos. No máximo FPS frames por
+    segundo são lidos em cada ligação: enquanto um frame espera a sua vez,
+    um mais recente substitui-o e o anterior recebe {"superseded": true};
+  - mensagens de texto (JSON):
+      {"codigo": "..."}                          código já lido no browser
+      {"acao": "resgatar", "codigo": "...", "tipo_combustivel": "..."}
+      {"acao": "combustivel", "tipo_combustivel": "gasolina"|"diesel"|null}
+        com combustível escolhido, as senhas lidas nos frames são logo resgatadas.
+As respostas têm o mesmo formato das views de scan. Um resgate é também
+enviado ({"evento": "resgate", ...}) às outras ligações do mesmo funcionário.
+"""
+import asyncio
+import json
+import time
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from gerente.models import ContadorLeitura
+from .views import (
+    erro_leitura, get_empresa_funcionario, is_funcionario, ler_codigo_frame,
+    resgatar_codigo, resposta_codigo,
+)
+
+# Frames lidos por segundo em cada ligação; 0 para não limitar
+FPS = getattr(settings, 'ENGEN_WS_SCAN_FPS', 4)
+
+COMBUSTIVEIS = ('gasolina', 'diesel')
+
+
+def _empresa_do_funcionario(user):
+    """Empresa do utilizador se for funcionário (carrega também user.funcionario)"""
+    if not is_funcionario(user):
+        return None
+    return get_empresa_funcionario(user)
+
+
+class ScanConsumer(AsyncWebsocketConsumer):
+
+    async def connect(self):
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            await self.close(code=4401)
+            return
+        self.empresa = await database_sync_to_async(_empresa_do_funcionario)(self.user)
+        if not self.empresa:
+            await self.close(code=4403)
+            return
+
+        self.grupo = f'scan_funcionario_{self.user.id}'
+        self.intervalo = 1 / FPS if FPS else 0
+        self.tipo_combustivel = None
+        self.frame_pendente = None
+        self.ultima_leitura = 0
+        self.tarefa = None
+        await self.channel_layer.group_add(self.grupo, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        if getattr(self, 'tarefa', None):
+            self.tarefa.cancel()
+        if getattr(self, 'grupo', None):
+            await self.channel_layer.group_discard(self.grupo, self.channel_name)
+
+    async def enviar(self, dados):
+        await self.send(text_data=json.dumps(dados))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            await self.receber_frame(bytes_data)
+            return
+
+        try:
+            dados = json.loads(text_data)
+            codigo_string = (dados.get('codigo') or '').strip()
+            acao = dados.get('acao')
+        except (ValueError, AttributeError):
+            await self.enviar({'success': False, 'error': 'Mensagem inválida'})
+            return
+
+        try:
+            if acao == 'combustivel':
+                tipo_combustivel = dados.get('tipo_combustivel')
+                self.tipo_combustivel = tipo_combustivel if tipo_combustivel in COMBUSTIVEIS else None
+                await self.enviar({'success': True, 'tipo_combustivel': self.tipo_combustivel})
+            elif not codigo_string:
+                await self.enviar({'success': False, 'error': 'Nenhum código fornecido'})
+            elif acao == 'resgatar':
+                tipo_combustivel = dados.get('tipo_combustivel')
+                await self.resolver(
+                    codigo_string, ContadorLeitura.MODO_DISPOSITIVO,
+                    tipo_combustivel if tipo_combustivel in COMBUSTIVEIS else None, resgatar=True,
+                )
+            else:
+                await self.resolver(codigo_string, ContadorLeitura.MODO_DISPOSITIVO)
+        except Exception as e:
+            await self.enviar({'success': False, 'error': f'Erro ao processar: {str(e)}'})
+
+    # ================================
+    # FRAMES
+    # ================================
+
+    async def receber_frame(self, dados):
+        if self.frame_pendente is not None:
+            await self.enviar({'success': False, 'superseded': True, 'error': 'Frame substituído por um mais recente'})
+        self.frame_pendente = dados
+        if self.tarefa is None or self.tarefa.done():
+            self.tarefa = asyncio.create_task(self.processar_frames())
+
+    async def processar_frames(self):
+        """Lê o frame pendente mais recente, no máximo um a cada `intervalo` segundos"""
+        while self.frame_pendente is not None:
+            espera = self.ultima_leitura + self.intervalo - time.monotonic()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            dados, self.frame_pendente = self.frame_pendente, None
+            self.ultima_leitura = time.monotonic()
+            try:
+                await self.ler_frame(dados)
+            except Exception as e:
+                await self.enviar({'success': False, 'error': f'Erro ao processar: {str(e)}'})
+
+    async def ler_frame(self, dados):
+        nparr = np.frombuffer(dados, np.uint8)
+        # A leitura bloqueia à espera do pool: numa thread, fora do ciclo de eventos
+        estado, codigo_string = await sync_to_async(ler_codigo_frame, thread_sensitive=False)(
+            f'ws:{self.channel_name}', self.user.id, nparr,
+        )
+        erro = erro_leitura(estado, codigo_string)
+        if erro:
+            await self.enviar(erro)
+            return
+        await self.resolver(
+            codigo_string, ContadorLeitura.MODO_SERVIDOR,
+            self.tipo_combustivel, resgatar=self.tipo_combustivel is not None,
+        )
+
+    # ================================
+    # RESPOSTAS
+    # ================================
+
+    async def resolver(self, codigo_string, modo, tipo_combustivel=None, resgatar=False):
+        if resgatar:
+            resposta = await database_sync_to_async(resgatar_codigo)(
+                self.user, codigo_string, self.empresa, tipo_combustivel, modo,
+            )
+        else:
+            resposta = await database_sync_to_async(resposta_codigo)(self.user, codigo_string, self.empresa, modo)
+        await self.enviar(resposta)
+
+        if resposta.get('resgatada'):
+            await self.channel_layer.group_send(self.grupo, {
+                'type': 'scan.evento',
+                'origem': self.channel_name,
+                'dados': {'evento': 'resgate', 'codigo': codigo_string, 'data': resposta['data']},
+            })
+
+    async def scan_evento(self, event):
+        if event.get('origem') != self.channel_name:
+            await self.enviar(event['dados'])
@@ -0,0 +1,248 @@
+"""
+Leitura de QR codes nas imagens enviadas pela câmara do funcionário.
+
+Em vez de passar o frame a cores inteiro ao zbar (que procura todas as
+simbologias), a imagem é:
+  1. descodificada diretamente em tons de cinzento;
+  2. reduzida se for maior do que LADO_MAXIMO;
+  3. lida primeiro só na região central (onde o funcionário aponta o código)
+     e só se falhar no frame inteiro;
+  4. em último recurso, binarizada com limiar adaptativo (sombras e reflexos).
+O zbar só procura QR codes em todas as etapas.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from django.conf import settings
+from pyzbar import pyzbar
+from pyzbar.pyzbar import ZBarSymbol
+
+# Lado máximo (px) da imagem a analisar; 0 para não reduzir
+LADO_MAXIMO = getattr(settings, 'ENGEN_QR_LEITURA_LADO_MAXIMO', 1024)
+# Fração (largura e altura) da região central tentada primeiro; 0 para não usar
+FRACAO_CENTRO = getattr(settings, 'ENGEN_QR_LEITURA_FRACAO_CENTRO', 0.6)
+# Tentar o limiar adaptativo quando as outras etapas falham
+LIMIAR_ADAPTATIVO = getattr(settings, 'ENGEN_QR_LEITURA_LIMIAR_ADAPTATIVO', True)
+
+SIMBOLOS = [ZBarSymbol.QRCODE]
+
+logger = logging.getLogger(__name__)
+
+ETAPA_CENTRO = 'centro'
+ETAPA_COMPLETA = 'completa'
+ETAPA_LIMIAR = 'limiar'
+
+
+def _ler(imagem, x0=0, y0=0, altura=None, largura=None):
+    """
+    (codigo, regiao) do primeiro QR code da imagem, ou (None, None). A região
+    (x, y, largura, altura) é dada em frações da imagem inteira de que `imagem`
+    é o recorte com canto em (x0, y0).
+    """
+    resultados = pyzbar.decode(imagem, symbols=SIMBOLOS)
+    if not resultados:
+        return None, None
+    if altura is None:
+        altura, largura = imagem.shape
+    retangulo = resultados[0].rect
+    regiao = (
+        (x0 + retangulo.left) / largura, (y0 + retangulo.top) / altura,
+        retangulo.width / largura, retangulo.height / altura,
+    )
+    return resultados[0].data.decode('utf-8').strip(), regiao
+
+
+def preparar_imagem(dados):
+    """Bytes (array numpy) de um JPEG/PNG -> imagem em tons de cinzento já reduzida (ou None)"""
+    imagem = cv2.imdecode(dados, cv2.IMREAD_GRAYSCALE)
+    if imagem is None:
+        return None
+
+    altura, largura = imagem.shape
+    maior = max(altura, largura)
+    if LADO_MAXIMO and maior > LADO_MAXIMO:
+        escala = LADO_MAXIMO / maior
+        imagem = cv2.resize(imagem, (round(largura * escala), round(altura * escala)), interpolation=cv2.INTER_AREA)
+    return imagem
+
+
+def _margens_centro(imagem, fracao):
+    altura, largura = imagem.shape
+    return int(largura * (1 - fracao) / 2), int(altura * (1 - fracao) / 2)
+
+
+def regiao_central(imagem, fracao=FRACAO_CENTRO):
+    altura, largura = imagem.shape
+    margem_x, margem_y = _margens_centro(imagem, fracao)
+    return imagem[margem_y:altura - margem_y, margem_x:largura - margem_x]
+
+
+def ler_qr_code(imagem):
+    """
+    Lê o primeiro QR code de uma imagem em tons de cinzento.
+    Retorna (codigo, etapa, regiao) ou (None, None, None) se nenhuma etapa o
+    encontrar; a região do QR code vem em frações da imagem (ver _ler).
+    """
+    if FRACAO_CENTRO:
+        altura, largura = imagem.shape
+        margem_x, margem_y = _margens_centro(imagem, FRACAO_CENTRO)
+        codigo, regiao = _ler(regiao_central(imagem), margem_x, margem_y, altura, largura)
+        if codigo:
+            return codigo, ETAPA_CENTRO, regiao
+
+    codigo, regiao = _ler(imagem)
+    if codigo:
+        return codigo, ETAPA_COMPLETA, regiao
+
+    if LIMIAR_ADAPTATIVO:
+        binaria = cv2.adaptiveThreshold(
+            imagem, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10,
+        )
+        codigo, regiao = _ler(binaria)
+        if codigo:
+            return codigo, ETAPA_LIMIAR, regiao
+
+    return None, None, None
+
+
+def _ler_todos(imagem):
+    lidos = [resultado.data.decode('utf-8').strip() for resultado in pyzbar.decode(imagem, symbols=SIMBOLOS)]
+    # O zbar costuma falhar com vários QR codes alinhados (uma tira de senhas): o
+    # detetor do OpenCV encontra-os todos
+    encontrados, dados, _, _ = cv2.QRCodeDetector().detectAndDecodeMulti(imagem)
+    if encontrados:
+        lidos.extend(codigo.strip() for codigo in dados if codigo)
+    return list(dict.fromkeys(lidos))
+
+
+def ler_qr_codes(imagem):
+    """
+    Lê todos os QR codes de uma imagem em tons de cinzento (resgate em lote),
+    sem repetidos. Lê o frame inteiro e, se não encontrar nenhum, a imagem
+    binarizada.
+    """
+    lidos = _ler_todos(imagem)
+    if not lidos and LIMIAR_ADAPTATIVO:
+        binaria = cv2.adaptiveThreshold(
+            imagem, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10,
+        )
+        lidos = _ler_todos(binaria)
+    return lidos
+
+
+# ================================
+# POOL DE LEITURA
+# ================================
+# A leitura corre num pool de threads limitado (o cv2 e o zbar libertam o GIL),
+# para que os frames da câmara não ocupem todo o CPU dos workers web.
+# Cada funcionário tem um "slot": enquanto um frame seu está a ser lido, só
+# fica à espera o mais recente - um frame novo substitui o que estava à espera.
+# Com o pool cheio o pedido recebe logo uma resposta "ocupado".
+
+TRABALHADORES = getattr(settings, 'ENGEN_QR_LEITURA_TRABALHADORES', 4)
+# Leituras em curso ou em fila no pool (de funcionários diferentes)
+CAPACIDADE = getattr(settings, 'ENGEN_QR_LEITURA_CAPACIDADE', 2 * TRABALHADORES)
+# Segundos que um pedido espera pela sua leitura antes de desistir
+ESPERA_MAXIMA = getattr(settings, 'ENGEN_QR_LEITURA_ESPERA', 5)
+
+LIDO = 'lido'
+NAO_LIDO = 'nao_lido'
+INVALIDA = 'invalida'
+SUBSTITUIDO = 'substituido'
+OCUPADO = 'ocupado'
+
+
+class _Pedido:
+    def __init__(self, dados, todos=False):
+        self.dados = dados
+        self.todos = todos
+        self.evento = threading.Event()
+        self.estado = None
+        self.codigo = None
+        self.regiao = None
+        self.cancelado = False
+
+    def terminar(self, estado, codigo=None, regiao=None):
+        self.estado = estado
+        self.codigo = codigo
+        self.regiao = regiao
+        self.evento.set()
+
+
+class PoolLeitura:
+    """Pool limitado de leituras com um slot "o último frame ganha" por funcionário"""
+
+    def __init__(self, trabalhadores=TRABALHADORES, capacidade=CAPACIDADE):
+        self.capacidade = capacidade
+        self._executor = ThreadPoolExecutor(max_workers=trabalhadores, thread_name_prefix='leitura-qr')
+        self._lock = threading.Lock()
+        # chave -> pedido à espera (None se só há um em curso); chave ausente = nada em curso
+        self._slots = {}
+        self.ativas = 0
+
+    def ler(self, chave, dados, espera=ESPERA_MAXIMA, todos=False):
+        """
+        Lê o QR code de `dados` (bytes da imagem). Retorna (estado, codigo, regiao),
+        com a região do QR code lido (ver ler_qr_code); com `todos`, o codigo é a
+        lista de todos os QR codes da imagem e não há região.
+        """
+        pedido = _Pedido(dados, todos)
+        with self._lock:
+            if chave in self._slots:
+                # Já há um frame deste funcionário a ser lido: este fica à espera no lugar do anterior
+                anterior = self._slots[chave]
+                if anterior is not None:
+                    anterior.terminar(SUBSTITUIDO)
+                self._slots[chave] = pedido
+            elif self.ativas >= self.capacidade:
+                return OCUPADO, None, None
+            else:
+                self._slots[chave] = None
+                self.ativas += 1
+                self._executor.submit(self._executar, chave, pedido)
+
+        if not pedido.evento.wait(espera):
+            pedido.cancelado = True
+            return OCUPADO, None, None
+        return pedido.estado, pedido.codigo, pedido.regiao
+
+    def _executar(self, chave, pedido):
+        while pedido is not None:
+            if not pedido.cancelado:
+                try:
+                    imagem = preparar_imagem(pedido.dados)
+                    if imagem is None:
+                        pedido.terminar(INVALIDA)
+                    elif pedido.todos:
+                        lidos = ler_qr_codes(imagem)
+                        pedido.terminar(LIDO if lidos else NAO_LIDO, lidos)
+                    else:
+                        codigo, _, regiao = ler_qr_code(imagem)
+                        pedido.terminar(LIDO if codigo else NAO_LIDO, codigo, regiao)
+                except Exception:
+                    logger.exception('Erro na leitura de QR code')
+                    pedido.terminar(INVALIDA)
+
+            # Passar ao frame mais recente deste funcionário, se entretanto chegou algum
+            with self._lock:
+                pedido = self._slots.get(chave)
+                if pedido is None:
+                    self._slots.pop(chave, None)
+                    self.ativas -= 1
+                else:
+                    self._slots[chave] = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def obter_pool():
+    """Pool de leitura deste processo, criado no primeiro uso"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PoolLeitura()
+        return _pool
@@ -0,0 +1,121 @@
+import os
+import random
+import statistics
+import time
+
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand
+from pyzbar import pyzbar
+
+from funcionario import leitura_qr
+from gerente import codigos, qrcodes
+
+EXTENSOES = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def ler_atual(dados):
+    """Leitura antiga: frame a cores inteiro e todas as simbologias"""
+    frame = cv2.imdecode(dados, cv2.IMREAD_COLOR)
+    resultados = pyzbar.decode(frame)
+    return resultados[0].data.decode('utf-8').strip() if resultados else None
+
+
+def ler_otimizada(dados):
+    imagem = leitura_qr.preparar_imagem(dados)
+    return leitura_qr.ler_qr_code(imagem)[0] if imagem is not None else None
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara a taxa de leitura e a latência da leitura antiga de QR codes com a '
+        'leitura otimizada, sobre uma pasta de fotografias ou um conjunto sintético'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pasta', help=(
+            'Pasta com fotografias reais (jpg/png/webp). Se o nome do ficheiro (sem extensão) '
+            'for o código, a leitura também é validada.'
+        ))
+        parser.add_argument('--sinteticas', type=int, default=50,
+                            help='Número de imagens sintéticas a gerar quando não é indicada uma pasta')
+        parser.add_argument('--repeticoes', type=int, default=3, help='Leituras de cada imagem por método')
+
+    def handle(self, *args, **options):
+        if options['pasta']:
+            corpus = self._carregar_pasta(options['pasta'])
+            self.stdout.write(f'{len(corpus)} fotografia(s) em {options["pasta"]}')
+        else:
+            corpus = self._gerar_sinteticas(options['sinteticas'])
+            self.stdout.write(f'{len(corpus)} imagem(ns) sintética(s) 1920x1080 (usar --pasta para fotografias reais)')
+
+        if not corpus:
+            self.stderr.write(self.style.ERROR('Nenhuma imagem para testar.'))
+            return
+
+        self.stdout.write(
+            f'Configuração: lado máximo {leitura_qr.LADO_MAXIMO}, centro {leitura_qr.FRACAO_CENTRO}, '
+            f'limiar adaptativo {"sim" if leitura_qr.LIMIAR_ADAPTATIVO else "não"}'
+        )
+        for nome, ler in (('atual', ler_atual), ('otimizada', ler_otimizada)):
+            self._medir(nome, ler, corpus, options['repeticoes'])
+
+    def _medir(self, nome, ler, corpus, repeticoes):
+        tempos = []
+        lidas = 0
+        corretas = 0
+        for dados, esperado in corpus:
+            for _ in range(repeticoes):
+                inicio = time.perf_counter()
+                codigo = ler(dados)
+                tempos.append((time.perf_counter() - inicio) * 1000)
+            if codigo:
+                lidas += 1
+                corretas += esperado is None or codigo == esperado
+
+        tempos.sort()
+        p95 = tempos[min(len(tempos) - 1, int(len(tempos) * 0.95))]
+        self.stdout.write(
+            f'{nome:>10}: lidas {lidas}/{len(corpus)} ({100 * lidas / len(corpus):.0f}%), '
+            f'corretas {corretas}, média {statistics.mean(tempos):.1f} ms, '
+            f'mediana {statistics.median(tempos):.1f} ms, p95 {p95:.1f} ms'
+        )
+
+    def _carregar_pasta(self, pasta):
+        corpus = []
+        for nome in sorted(os.listdir(pasta)):
+            base, extensao = os.path.splitext(nome)
+            if extensao.lower() not in EXTENSOES:
+                continue
+            with open(os.path.join(pasta, nome), 'rb') as ficheiro:
+                dados = np.frombuffer(ficheiro.read(), np.uint8)
+            esperado = base.upper() if codigos.classificar_codigo(base.upper()) else None
+            corpus.append((dados, esperado))
+        return corpus
+
+    def _gerar_sinteticas(self, quantidade):
+        """Frames 1920x1080 com o QR code num sítio e tamanho aleatórios, iluminação desigual e ruído"""
+        aleatorio = random.Random(42)
+        corpus = []
+        for _ in range(quantidade):
+            codigo = codigos.gerar_codigo(codigos.TIPO_SENHA)
+            qr = cv2.imdecode(np.frombuffer(qrcodes.desenhar_png(codigo), np.uint8), cv2.IMREAD_COLOR)
+            lado = aleatorio.randint(180, 420)
+            qr = cv2.resize(qr, (lado, lado), interpolation=cv2.INTER_NEAREST)
+
+            frame = np.full((1080, 1920, 3), aleatorio.randint(60, 160), np.uint8)
+            centro_x = 960 + aleatorio.randint(-500, 500)
+            centro_y = 540 + aleatorio.randint(-250, 250)
+            y0 = min(max(centro_y - lado // 2, 0), 1080 - lado)
+            x0 = min(max(centro_x - lado // 2, 0), 1920 - lado)
+            frame[y0:y0 + lado, x0:x0 + lado] = qr
+
+            gradiente = np.linspace(aleatorio.uniform(0.5, 0.8), 1.0, 1920, dtype=np.float32)
+            frame = (frame * gradiente[None, :, None]).astype(np.uint8)
+            frame = cv2.GaussianBlur(frame, (5, 5), aleatorio.uniform(0.5, 1.5))
+            ruido = np.random.default_rng(aleatorio.randint(0, 10 ** 6)).normal(0, 8, frame.shape)
+            frame = np.clip(frame + ruido, 0, 255).astype(np.uint8)
+
+            jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])[1]
+            corpus.append((np.frombuffer(jpeg.tobytes(), np.uint8), codigo))
+        return corpus
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.utils import timezone
+
+from gerente.models import ContadorLeitura
+
+
+class Command(BaseCommand):
+    help = 'Mostra quantos códigos foram lidos em cada modo (no dispositivo, no servidor, recurso)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, default=7, help='Últimos N dias (por omissão 7)')
+        parser.add_argument('--empresa', type=int, help='Só os funcionários desta empresa (id)')
+        parser.add_argument('--por-funcionario', action='store_true', help='Detalhar por funcionário')
+
+    def handle(self, *args, **options):
+        desde = timezone.localdate() - timedelta(days=options['dias'] - 1)
+        contadores = ContadorLeitura.objects.filter(data__gte=desde)
+        if options['empresa']:
+            contadores = contadores.filter(funcionario__empresa_id=options['empresa'])
+
+        campos = ['modo']
+        if options['por_funcionario']:
+            campos = ['funcionario__user__username', 'modo']
+        linhas = contadores.values(*campos).annotate(total=Sum('leituras')).order_by(*campos)
+
+        total = sum(linha['total'] for linha in linhas)
+        self.stdout.write(f'Leituras desde {desde:%d/%m/%Y}: {total}')
+        nomes = dict(ContadorLeitura.MODO_CHOICES)
+        for linha in linhas:
+            prefixo = f"{linha['funcionario__user__username']}: " if options['por_funcionario'] else ''
+            percentagem = 100 * linha['total'] / total if total else 0
+            self.stdout.write(f"  {prefixo}{nomes.get(linha['modo'], linha['modo'])}: {linha['total']} ({percentagem:.0f}%)")
@@ -0,0 +1,178 @@
+"""
+Supressão de trabalho repetido no scan pela câmara.
+
+Enquanto o funcionário segura a senha em frente à câmara, o browser envia
+frame atrás de frame quase iguais. Em cada processo:
+  1. guarda-se a assinatura do último frame de cada sessão: com um código lido,
+     a região do QR code reduzida a um módulo por pixel e binarizada; sem
+     código, uma miniatura 32x32 do frame inteiro. Um frame com a mesma
+     assinatura, dentro de JANELA_FRAME segundos, tem o resultado da leitura
+     anterior sem voltar a ler o QR code. Como a assinatura é o próprio QR code,
+     trocar uma senha por outra no mesmo sítio nunca dá o código anterior;
+  2. guarda-se durante JANELA_CODIGO segundos a resposta do último código
+     resolvido para cada funcionário: o mesmo código devolve a mesma resposta
+     sem ir à base de dados. A resposta é esquecida quando o código é usado.
+Uma janela a 0 desliga a respetiva supressão.
+"""
+import threading
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from gerente import qrcodes
+
+JANELA_FRAME = getattr(settings, 'ENGEN_QR_REPETIDO_JANELA_FRAME', 2)
+# Diferença média (em tons de cinzento, 0-255) até à qual dois frames sem código são considerados iguais
+DIFERENCA_FRAME = getattr(settings, 'ENGEN_QR_REPETIDO_DIFERENCA', 3)
+LADO_ASSINATURA = 32
+# Módulos de lado dos QR codes das senhas
+MODULOS_QR = 17 + 4 * qrcodes.VERSAO
+# Módulos diferentes até aos quais a região do QR code é a mesma. Dois QR codes
+# versão 1-L válidos diferem em pelo menos 8 módulos (distância do Reed-Solomon)
+MODULOS_DIFERENTES = 3
+JANELA_CODIGO = getattr(settings, 'ENGEN_QR_REPETIDO_JANELA_CODIGO', 5)
+
+MAX_ITENS = 5000
+
+
+class MemoriaTTL:
+    """Dicionário limitado em que cada valor expira `ttl` segundos depois de guardado"""
+
+    def __init__(self, ttl, max_itens=MAX_ITENS):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self._itens = {}
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._itens[chave]
+                return None
+            return item[1]
+
+    def guardar(self, chave, valor):
+        agora = time.monotonic()
+        with self._lock:
+            if len(self._itens) >= self.max_itens:
+                # Limpar os expirados; se não chegar, descartar os mais antigos
+                self._itens = {c: item for c, item in self._itens.items() if item[0] >= agora}
+                while len(self._itens) >= self.max_itens:
+                    del self._itens[next(iter(self._itens))]
+            self._itens.pop(chave, None)
+            self._itens[chave] = (agora + self.ttl, valor)
+
+    def descartar(self, chave):
+        with self._lock:
+            self._itens.pop(chave, None)
+
+
+_frames = MemoriaTTL(JANELA_FRAME)
+_codigos = MemoriaTTL(JANELA_CODIGO)
+
+
+# ================================
+# FRAMES REPETIDOS
+# ================================
+
+def assinatura_frame(dados):
+    """Miniatura dos bytes (array numpy) de um JPEG/PNG, ou None se a imagem for inválida"""
+    # Descodificar já a 1/8 do tamanho e em cinzento é muito mais barato do que a leitura
+    imagem = cv2.imdecode(dados, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if imagem is None:
+        return None
+    # A média de cada bloco elimina o ruído do sensor e da compressão
+    return cv2.resize(imagem, (LADO_ASSINATURA, LADO_ASSINATURA), interpolation=cv2.INTER_AREA)
+
+
+def assinatura_regiao(dados, regiao):
+    """
+    Módulos (MODULOS_QR x MODULOS_QR, 0 ou 255) da região (frações da imagem, ver
+    leitura_qr.ler_qr_code) de um JPEG/PNG, ou None se a região não se puder ler.
+    """
+    # A 1/2 do tamanho um QR code legível ainda tem vários pixels por módulo
+    imagem = cv2.imdecode(dados, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if imagem is None:
+        return None
+    altura, largura = imagem.shape
+    x, y, largura_regiao, altura_regiao = regiao
+    recorte = imagem[
+        round(y * altura):round((y + altura_regiao) * altura),
+        round(x * largura):round((x + largura_regiao) * largura),
+    ]
+    if min(recorte.shape) < MODULOS_QR:
+        return None
+    # Um pixel por módulo: um tremor de menos de meio módulo não muda nenhum
+    modulos = cv2.resize(recorte, (MODULOS_QR, MODULOS_QR), interpolation=cv2.INTER_AREA)
+    _, binaria = cv2.threshold(modulos, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return binaria
+
+
+def diferenca(assinatura, outra):
+    return float(np.mean(cv2.absdiff(assinatura, outra)))
+
+
+def frame_repetido(sessao, dados):
+    """
+    Código lido no frame anterior da sessão ('' se não tinha QR code) quando o
+    frame atual (bytes como array numpy) é o mesmo; None se tiver de ser lido.
+    """
+    if not JANELA_FRAME:
+        return None
+    anterior = _frames.obter(sessao)
+    if anterior is None:
+        return None
+    regiao, assinatura, codigo = anterior
+    if regiao is None:
+        atual = assinatura_frame(dados)
+        if atual is None or diferenca(assinatura, atual) > DIFERENCA_FRAME:
+            return None
+    else:
+        atual = assinatura_regiao(dados, regiao)
+        if atual is None or np.count_nonzero(atual != assinatura) > MODULOS_DIFERENTES:
+            return None
+    return codigo
+
+
+def lembrar_frame(sessao, dados, codigo, regiao=None):
+    """Guarda o resultado da leitura do frame; `regiao` é a do QR code lido (ver leitura_qr)"""
+    if not JANELA_FRAME:
+        return
+    if codigo:
+        # Um código lido só se repete pela região do próprio QR code
+        if regiao is None:
+            return
+        assinatura = assinatura_regiao(dados, regiao)
+    else:
+        regiao, assinatura = None, assinatura_frame(dados)
+    if assinatura is not None:
+        _frames.guardar(sessao, (regiao, assinatura, codigo or ''))
+
+
+# ================================
+# CÓDIGOS RESOLVIDOS RECENTEMENTE
+# ================================
+
+def resposta_recente(funcionario_id, codigo):
+    """Resposta guardada para o código se foi resolvida há pouco para o mesmo funcionário"""
+    if not JANELA_CODIGO:
+        return None
+    guardada = _codigos.obter(codigo)
+    if guardada is None or guardada[0] != funcionario_id:
+        return None
+    return guardada[1]
+
+
+def lembrar_resposta(funcionario_id, codigo, resposta):
+    if JANELA_CODIGO:
+        _codigos.guardar(codigo, (funcionario_id, resposta))
+
+
+def esquecer_codigo(codigo):
+    """Chamar quando o código é usado (senha resgatada ou saldo debitado)"""
+    _codigos.descartar(codigo)
@@ -1,3 +1,234 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from empresas.models import Empresa
+from gerente import cache_codigos, codigos, qrcodes
+from gerente.emissao import emitir_senhas
+from gerente.models import Cliente, Funcionario, RequisicaoSenhas
+
+from . import cameras, leitura_qr, repeticoes
+from .routing import websocket_urlpatterns
+
+CAMADA_MEMORIA = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@override_settings(CHANNEL_LAYERS=CAMADA_MEMORIA)
+@mock.patch.object(cache_codigos, 'ATIVA', False)
+class ScanConsumerTest(TestCase):
+
+    def setUp(self):
+        gerente = User.objects.create_user(username='gerente')
+        self.empresa = Empresa.objects.create(nome='Bomba', gerente=gerente)
+        self.user = User.objects.create_user(username='funcionario')
+        self.user.groups.add(Group.objects.get_or_create(name='Funcionarios')[0])
+        Funcionario.objects.create(user=self.user, empresa=self.empresa)
+        cliente = Cliente.objects.create(empresa=self.empresa, nome='Cliente')
+        requisicao = RequisicaoSenhas.objects.create(empresa=self.empresa, cliente=cliente, valor=2, senhas=2)
+        with transaction.atomic():
+            emitir_senhas(requisicao, 2)
+        self.codigo = requisicao.lista_senhas.values_list('codigo', flat=True).first()
+
+    def ligacao(self, user):
+        comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/funcionario/scan/')
+        comunicador.scope['user'] = user
+        return comunicador
+
+    async def enviar(self, comunicador, dados):
+        await comunicador.send_to(text_data=json.dumps(dados))
+        return json.loads(await comunicador.receive_from())
+
+    def test_recusa_sem_sessao(self):
+        async def cenario():
+            ligado, codigo = await self.ligacao(AnonymousUser()).connect()
+            self.assertFalse(ligado)
+            self.assertEqual(codigo, 4401)
+        async_to_sync(cenario)()
+
+    def test_recusa_quem_nao_e_funcionario(self):
+        outro = User.objects.create_user(username='cliente')
+
+        async def cenario():
+            ligado, codigo = await self.ligacao(outro).connect()
+            self.assertFalse(ligado)
+            self.assertEqual(codigo, 4403)
+        async_to_sync(cenario)()
+
+    def test_codigo_e_combustivel(self):
+        async def cenario():
+            comunicador = self.ligacao(self.user)
+            ligado, _ = await comunicador.connect()
+            self.assertTrue(ligado)
+
+            resposta = await self.enviar(comunicador, {'acao': 'combustivel', 'tipo_combustivel': 'diesel'})
+            self.assertEqual(resposta, {'success': True, 'tipo_combustivel': 'diesel'})
+
+            resposta = await self.enviar(comunicador, {'codigo': self.codigo})
+            self.assertTrue(resposta['success'])
+            self.assertEqual(resposta['codigo'], self.codigo)
+
+            resposta = await self.enviar(comunicador, {'codigo': 'NAOEXISTE'})
+            self.assertFalse(resposta['success'])
+            await comunicador.disconnect()
+        async_to_sync(cenario)()
+
+    def test_resgate_chega_as_outras_ligacoes(self):
+        async def cenario():
+            leitor, painel = self.ligacao(self.user), self.ligacao(self.user)
+            await leitor.connect()
+            await painel.connect()
+
+            resposta = await self.enviar(leitor, {
+                'acao': 'resgatar', 'codigo': self.codigo, 'tipo_combustivel': 'gasolina',
+            })
+            self.assertTrue(resposta['resgatada'])
+
+            evento = json.loads(await painel.receive_from())
+            self.assertEqual(evento['evento'], 'resgate')
+            self.assertEqual(evento['codigo'], self.codigo)
+            # Quem resgatou não recebe o próprio evento
+            self.assertTrue(await leitor.receive_nothing())
+
+            await leitor.disconnect()
+            await painel.disconnect()
+        async_to_sync(cenario)()
+
+
+class FramesRepetidosTest(TestCase):
+
+    def frame(self, codigo, deslocamento=0):
+        """JPEG 1280x720 com o QR code do código a meio, como vindo da câmara"""
+        qr = cv2.imdecode(np.frombuffer(qrcodes.desenhar_png(codigo), np.uint8), cv2.IMREAD_GRAYSCALE)
+        imagem = np.full((720, 1280), 120, np.uint8)
+        y, x = 250, 540 + deslocamento
+        imagem[y:y + qr.shape[0], x:x + qr.shape[1]] = qr
+        return np.frombuffer(cv2.imencode('.jpg', imagem)[1].tobytes(), np.uint8)
+
+    def ler(self, sessao, dados):
+        codigo, _, regiao = leitura_qr.ler_qr_code(leitura_qr.preparar_imagem(dados))
+        repeticoes.lembrar_frame(sessao, dados, codigo, regiao)
+        return codigo
+
+    def test_mesma_senha_nao_e_lida_de_novo(self):
+        senha = codigos.gerar_codigo(codigos.TIPO_SENHA)
+        self.assertEqual(self.ler('sessao-igual', self.frame(senha)), senha)
+        self.assertEqual(repeticoes.frame_repetido('sessao-igual', self.frame(senha, deslocamento=1)), senha)
+
+    def test_outra_senha_no_mesmo_sitio_nao_e_juntada(self):
+        primeira = codigos.gerar_codigo(codigos.TIPO_SENHA)
+        segunda = codigos.gerar_codigo(codigos.TIPO_SENHA)
+        self.assertEqual(self.ler('sessao-troca', self.frame(primeira)), primeira)
+        self.assertIsNone(repeticoes.frame_repetido('sessao-troca', self.frame(segunda)))
+
+
+class GestorCamerasTest(SimpleTestCase):
+    ESPERA_FECHO = 0.2
+
+    def setUp(self):
+        self.fontes = []
+        self.gestor = cameras.GestorCameras(abrir_fonte=self.abrir_fonte, espera_fecho=self.ESPERA_FECHO)
+
+    def tearDown(self):
+        # Sem frames, as threads de captura que ficaram abertas terminam
+        for fonte in self.fontes:
+            fonte.release()
+
+    def abrir_fonte(self, dispositivo):
+        fonte = cameras.FonteFalsa()
+        self.fontes.append(fonte)
+        return fonte
+
+    def esperar(self, condicao, timeout=3):
+        limite = time.monotonic() + timeout
+        while not condicao():
+            if time.monotonic() > limite:
+                self.fail('A condição não se verificou a tempo')
+            time.sleep(0.02)
+
+    def test_captura_partilhada_e_espectadores(self):
+        primeira = self.gestor.abrir('0')
+        segunda = self.gestor.abrir('0')
+        self.assertIs(primeira, segunda)
+        self.assertEqual(len(self.fontes), 1)
+        self.assertEqual(self.gestor.estado(), {'0': 2})
+
+        self.gestor.fechar(primeira)
+        self.assertEqual(self.gestor.estado(), {'0': 1})
+        self.gestor.fechar(segunda)
+        self.assertEqual(self.gestor.estado(), {'0': 0})
+        self.assertTrue(primeira.ativa)
+
+    def test_fecha_depois_da_espera(self):
+        captura = self.gestor.abrir('0')
+        self.esperar(lambda: captura.ultimo_frame()[1] is not None)
+        inicio = time.monotonic()
+        self.gestor.fechar(captura)
+
+        self.esperar(lambda: not captura.ativa)
+        self.assertGreaterEqual(time.monotonic() - inicio, self.ESPERA_FECHO)
+        self.assertFalse(self.fontes[0].aberta)
+        self.assertEqual(self.gestor.estado(), {})
+
+        # Um novo espectador abre outra captura
+        self.assertIsNot(self.gestor.abrir('0'), captura)
+        self.assertEqual(len(self.fontes), 2)
+
+    def test_abrir_nao_bloqueia_os_outros_dispositivos(self):
+        libertar = threading.Event()
+
+        def abrir_lenta(dispositivo):
+            if dispositivo == 'lenta':
+                libertar.wait(3)
+            return self.abrir_fonte(dispositivo)
+
+        self.gestor._abrir_fonte = abrir_lenta
+        capturas = []
+        threads = [threading.Thread(target=lambda: capturas.append(self.gestor.abrir('lenta'))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+
+        self.gestor.abrir('rapida')
+        self.assertEqual(self.gestor.estado(), {'rapida': 1})
+
+        libertar.set()
+        for thread in threads:
+            thread.join(3)
+        self.assertIs(capturas[0], capturas[1])
+        self.assertEqual(len(self.fontes), 2)
+        self.assertEqual(self.gestor.estado(), {'rapida': 1, 'lenta': 2})
+
+    def test_parar_sessao_so_para_a_propria(self):
+        minha = self.gestor.transmitir('0', 'minha')
+        outra = self.gestor.transmitir('0', 'outra')
+        self.assertTrue(next(minha).startswith(b'--frame'))
+        self.assertTrue(next(outra).startswith(b'--frame'))
+        self.assertEqual(self.gestor.estado(), {'0': 2})
+
+        self.assertEqual(self.gestor.parar_sessao('minha'), 1)
+        with self.assertRaises(StopIteration):
+            next(minha)
+        self.assertTrue(next(outra).startswith(b'--frame'))
+        self.assertEqual(self.gestor.estado(), {'0': 1})
+        self.assertEqual(self.gestor.parar_sessao('minha'), 0)
+
+        outra.close()
+        self.assertEqual(self.gestor.estado(), {'0': 0})
+
+    def test_transmissao_async(self):
+        async def cenario():
+            transmissao = self.gestor.transmitir_async('0', 'minha')
+            self.assertTrue((await transmissao.__anext__()).startswith(b'--frame'))
+            self.assertEqual(self.gestor.estado(), {'0': 1})
+            await transmissao.aclose()
+            self.assertEqual(self.gestor.estado(), {'0': 0})
+        async_to_sync(cenario)()
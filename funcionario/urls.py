@@ -12,5 +12,8 @@ urlpatterns = [
     path('camera-stream/', views.camera_stream, name='camera_stream'),
     path('stop-camera/', views.stop_camera, name='stop_camera'),
     path('scan-qr-code/', views.scan_qr_code, name='scan_qr_code'),
+    path('procurar-codigo/', views.procurar_codigo_lido, name='procurar_codigo_lido'),
+    path('scan-resgatar/', views.scan_e_resgatar, name='scan_e_resgatar'),
+    path('resgatar-lote/', views.resgatar_lote, name='resgatar_lote'),
     path('process-scanned-code/', views.process_scanned_code, name='process_scanned_code'),
 ]
\ No newline at end of file
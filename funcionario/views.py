@@ -1,22 +1,25 @@
 from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import render, redirect
 from django.contrib import messages
-from django.db.models import Q
+from django.core import signing
+from django.db.models import Q, Sum
 from django.utils import timezone
-from gerente.models import Senha, RequisicaoSaldo, Movimento, Funcionario
+from django.conf import settings
+from gerente.models import Senha, RequisicaoSaldo, Funcionario, RequisicaoSenhas, ContadorLeitura
+from gerente.codigos import classificar_codigo, TIPO_SENHA, TIPO_SALDO, TIPO_INTERVALO, TIPO_LEGADO
+from gerente.armazenamento import procurar_senha_intervalo
+from gerente import indice_codigos, resgates, saldos
+from . import cameras, leitura_qr, repeticoes
 from django.contrib.auth.decorators import user_passes_test, login_required
 from decimal import Decimal
-import cv2
 import json
 import base64
 import numpy as np
-from pyzbar import pyzbar
+from django.core.handlers.asgi import ASGIRequest
 from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
-import threading
-import time
 
 
 # Create your views here.
@@ -39,6 +42,26 @@ def get_empresa_funcionario(user):
     return None
 
 
+def procurar_codigo(codigo_string, empresa):
+    """
+    Procura o código nas senhas e nas requisições de saldo ativas DA EMPRESA.
+    Códigos inválidos são rejeitados sem ir à base de dados, os do modo intervalo
+    são decodificados e os restantes resolvidos com uma só query ao índice de
+    códigos (ver gerente/indice_codigos.py).
+    A senha devolvida pode ser uma Senha, uma SenhaIntervalo (modo intervalo)
+    ou um ResgateSenha (senha já usada de uma requisição convertida).
+    Retorna (senha, requisicao_saldo) - no máximo um dos dois preenchido.
+    """
+    tipo = classificar_codigo(codigo_string)
+    if tipo is None:
+        return None, None
+
+    if tipo == TIPO_INTERVALO:
+        return procurar_senha_intervalo(codigo_string, empresa), None
+
+    return indice_codigos.procurar(codigo_string, empresa)
+
+
 def login_funcionario_view(request):
     """View para login de funcionários"""
     if request.method == 'POST':
@@ -89,9 +112,16 @@ def scan_senha_view(request):
         .order_by('-data_criacao')
     )
     
-    # Calcular estatísticas APENAS da empresa
-    total_senhas = senhas.count()
-    senhas_usadas = senhas.filter(usada=True).count()
+    # Calcular estatísticas APENAS da empresa (incluindo requisições em modo intervalo)
+    total_senhas = senhas.count() + (
+        RequisicaoSenhas.objects
+        .filter(empresa=empresa, modo_armazenamento=RequisicaoSenhas.MODO_INTERVALO)
+        .aggregate(total=Sum('senhas'))['total'] or 0
+    )
+    senhas_usadas = (
+        RequisicaoSenhas.objects.filter(empresa=empresa)
+        .aggregate(total=Sum('senhas_usadas'))['total'] or 0
+    )
     senhas_disponiveis = total_senhas - senhas_usadas
     
     # Processar formulário de scan
@@ -100,41 +130,42 @@ def scan_senha_view(request):
         valor = request.POST.get('valor', '').strip()
         tipo_combustivel = request.POST.get('tipo_combustivel', '').strip()
         
-        if codigo_string:
-            # Verificar se é senha ou código de requisição de saldo DA EMPRESA
-            senha_encontrada = None
-            requisicao_saldo_encontrada = None
-            
-            # Primeiro, tentar encontrar como senha DA EMPRESA
+        lidos = resgates.separar_codigos(codigo_string)
+        if len(lidos) > 1 and not valor:
+            # Vários códigos no mesmo campo: resgate em lote das senhas. Códigos
+            # escritos à mão não são leituras de QR code e não entram nos contadores
             try:
-                senha_encontrada = Senha.objects.get(
-                    codigo=codigo_string,
-                    empresa=empresa  # FILTRO CRÍTICO
+                resposta = resposta_lote(
+                    request.user, lidos, empresa,
+                    tipo_combustivel if tipo_combustivel in ('gasolina', 'diesel') else None,
+                    None,
                 )
-            except Senha.DoesNotExist:
-                pass
-            
-            # Depois, tentar encontrar como código de requisição de saldo DA EMPRESA
-            try:
-                requisicao_saldo_encontrada = RequisicaoSaldo.objects.get(
-                    codigo=codigo_string,
-                    empresa=empresa,  # FILTRO CRÍTICO
-                    ativa=True
-                )
-            except RequisicaoSaldo.DoesNotExist:
-                pass
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                recusadas = [
+                    f"{resultado['codigo']}: {resultado['mensagem']}"
+                    for resultado in resposta['resultados'] if resultado['estado'] != resgates.RESGATADA
+                ]
+                if resposta['resgatadas']:
+                    messages.success(request, resposta['message'])
+                if recusadas:
+                    messages.error(request, 'Não resgatadas - ' + '; '.join(recusadas))
+        
+        elif codigo_string:
+            # Verificar se é senha ou código de requisição de saldo DA EMPRESA
+            senha_encontrada, requisicao_saldo_encontrada = procurar_codigo(codigo_string, empresa)
             
             # Processar senha
             if senha_encontrada:
                 if not valor:  # Sem valor = marcar senha como usada
-                    if senha_encontrada.usada:
+                    try:
+                        resgatar_senha(senha_encontrada, request.user.funcionario if hasattr(request.user, 'funcionario') else None)
+                    except ValueError:
                         messages.error(request, f'Senha {codigo_string} já foi utilizada!')
                     else:
-                        senha_encontrada.usada = True
-                        senha_encontrada.data_uso = timezone.now()
-                        senha_encontrada.funcionario_uso = request.user.funcionario if hasattr(request.user, 'funcionario') else None
-                        senha_encontrada.save()
                         messages.success(request, f'Senha {codigo_string} escaneada com sucesso!')
+                    repeticoes.esquecer_codigo(codigo_string)
                 else:
                     messages.error(request, f'Senhas não precisam de valor. Use apenas o código.')
                     
@@ -145,26 +176,28 @@ def scan_senha_view(request):
                         valor_decimal = Decimal(valor)
                         if valor_decimal <= 0:
                             messages.error(request, 'Valor deve ser maior que zero!')
-                        elif valor_decimal > requisicao_saldo_encontrada.saldo_restante:
-                            messages.error(request, f'Saldo insuficiente! Disponível: {requisicao_saldo_encontrada.saldo_restante} MT')
+                        # Validar tipo de combustível para débitos
+                        elif not tipo_combustivel or tipo_combustivel not in ['gasolina', 'diesel']:
+                            messages.error(request, 'Por favor, selecione o tipo de combustível (Gasolina ou Diesel).')
                         else:
-                            # Validar tipo de combustível para débitos
-                            if not tipo_combustivel or tipo_combustivel not in ['gasolina', 'diesel']:
-                                messages.error(request, 'Por favor, selecione o tipo de combustível (Gasolina ou Diesel).')
-                            else:
-                                # Criar movimento de débito com tipo de combustível
-                                movimento = Movimento.objects.create(
-                                    requisicao_saldo=requisicao_saldo_encontrada,
-                                    valor=valor_decimal,
-                                    tipo_combustivel=tipo_combustivel,
-                                    descricao=f'Débito via scan ({tipo_combustivel.title()}) - Funcionário: {request.user.get_full_name() or request.user.username}',
-                                    funcionario=request.user.funcionario if hasattr(request.user, 'funcionario') else None
-                                )
-                                
-                                messages.success(request, 
-                                    f'Débito de {valor_decimal} MT realizado com sucesso! '
-                                    f'Combustível: {tipo_combustivel.title()}'
-                                )
+                            # Criar movimento de débito com tipo de combustível (saldo verificado com a requisição bloqueada)
+                            saldos.debitar(
+                                requisicao_saldo_encontrada,
+                                valor_decimal,
+                                tipo_combustivel,
+                                funcionario=request.user.funcionario if hasattr(request.user, 'funcionario') else None,
+                                descricao=f'Débito via scan ({tipo_combustivel.title()}) - Funcionário: {request.user.get_full_name() or request.user.username}',
+                            )
+                            repeticoes.esquecer_codigo(codigo_string)
+                            
+                            messages.success(request, 
+                                f'Débito de {valor_decimal} MT realizado com sucesso! '
+                                f'Combustível: {tipo_combustivel.title()}'
+                            )
+                    except saldos.SaldoInsuficiente as e:
+                        messages.error(request, str(e))
+                    except RequisicaoSaldo.DoesNotExist:
+                        messages.error(request, 'Requisição de saldo não encontrada')
                     except (ValueError, TypeError):
                         messages.error(request, 'Valor inválido!')
                 else:
@@ -186,6 +219,10 @@ def scan_senha_view(request):
         'senhas_disponiveis': senhas_disponiveis,
         'empresa': empresa,
         'funcionario': request.user.funcionario if hasattr(request.user, 'funcionario') else None,
+        'leitura_no_dispositivo': getattr(settings, 'ENGEN_QR_LEITURA_NO_DISPOSITIVO', False),
+        'tentativas_dispositivo': getattr(settings, 'ENGEN_QR_LEITURA_TENTATIVAS_DISPOSITIVO', 10),
+        'resgate_direto': getattr(settings, 'ENGEN_SCAN_RESGATE_DIRETO', False),
+        'scan_websocket': getattr(settings, 'ENGEN_SCAN_WEBSOCKET', False),
     }
     
     return render(request, 'funcionario/dashboard_funcionario.html', context)
@@ -233,66 +270,28 @@ def funcionario_dashboard(request):
     
     return render(request, 'funcionario/dashboard.html', context)
 
-# Variável global para controlar o estado da câmera
-camera_active = {}
-
-@login_required(login_url='/funcionario/login')
-@user_passes_test(is_funcionario, login_url='/login')
-def generate_camera_frames(camera_id=0):
-    """
-    Gerador de frames da câmera para streaming
-    """
-    cap = cv2.VideoCapture(camera_id)
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-    
-    try:
-        while camera_active.get(camera_id, False):
-            success, frame = cap.read()
-            if not success:
-                break
-            
-            # Detectar QR codes
-            qr_codes = pyzbar.decode(frame)
-            
-            # Desenhar retângulos ao redor dos QR codes detectados
-            for qr_code in qr_codes:
-                # Extrair posição do QR code
-                (x, y, w, h) = qr_code.rect
-                
-                # Desenhar retângulo verde ao redor do QR code
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                
-                # Decodificar dados do QR code
-                qr_data = qr_code.data.decode('utf-8')
-                
-                # Adicionar texto com o código detectado
-                cv2.putText(frame, qr_data, (x, y - 10), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-            
-            # Converter frame para JPEG
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
-            
-            # Retornar frame em formato de streaming
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-            
-            time.sleep(0.1)  # Pequeno delay para controlar FPS
-    finally:
-        cap.release()
 
 @login_required(login_url='/funcionario/login')
 @user_passes_test(is_funcionario, login_url='/login')
 def camera_stream(request):
     """
-    View para streaming da câmera
+    View para streaming da câmera (MJPEG). A captura é partilhada por todos os
+    espectadores do dispositivo (ver funcionario/cameras.py).
     """
-    camera_id = 0
-    camera_active[camera_id] = True
+    dispositivo = request.GET.get('dispositivo', '')
+    if not dispositivo.isdigit():
+        dispositivo = cameras.DISPOSITIVO
+    dispositivo = cameras.normalizar_dispositivo(dispositivo)
+    
+    gestor = cameras.obter_gestor()
+    sessao = request.session.session_key
+    if isinstance(request, ASGIRequest):
+        frames = gestor.transmitir_async(dispositivo, sessao)
+    else:
+        frames = gestor.transmitir(dispositivo, sessao)
     
     response = StreamingHttpResponse(
-        generate_camera_frames(camera_id),
+        frames,
         content_type='multipart/x-mixed-replace; boundary=frame'
     )
     response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
@@ -307,11 +306,91 @@ def camera_stream(request):
 @user_passes_test(is_funcionario, login_url='/login')
 def stop_camera(request):
     """
-    View para parar a câmera
+    View para parar a câmera (só as transmissões desta sessão)
+    """
+    parados = cameras.obter_gestor().parar_sessao(request.session.session_key)
+    return JsonResponse({'status': 'stopped', 'streams': parados})
+
+# Tipos de conteúdo aceites para o frame enviado em binário (sem JSON nem base64)
+TIPOS_IMAGEM_BINARIA = ('application/octet-stream', 'image/jpeg', 'image/png', 'image/webp')
+
+
+def ler_imagem_pedido(request):
+    """
+    Bytes da imagem enviada ao scan_qr_code como array numpy (ou None).
+    Aceita o corpo binário (canvas.toBlob) ou, por compatibilidade, JSON
+    com a imagem em data URL base64 no campo "image".
+    """
+    if request.content_type in TIPOS_IMAGEM_BINARIA:
+        # Sem cópias: o array usa diretamente o buffer do corpo do pedido
+        return np.frombuffer(request.body, np.uint8)
+
+    data = json.loads(request.body)
+    image_data = data.get('image')
+    if not image_data:
+        return None
+
+    # Decodificar imagem base64
+    image_data = image_data.split(',')[-1]  # Remover prefixo data:image/jpeg;base64,
+    return np.frombuffer(base64.b64decode(image_data), np.uint8)
+
+
+def ler_codigo_frame(sessao, chave, nparr):
+    """
+    Lê o QR code de um frame (bytes como array numpy) no pool de leitura
+    (ver funcionario/leitura_qr.py); um frame praticamente igual ao anterior
+    da sessão tem o mesmo resultado sem nova leitura (ver repeticoes.py).
+    Retorna (estado, codigo) com os estados de leitura_qr.
+    """
+    codigo_anterior = repeticoes.frame_repetido(sessao, nparr)
+    if codigo_anterior is not None:
+        return (leitura_qr.LIDO, codigo_anterior) if codigo_anterior else (leitura_qr.NAO_LIDO, None)
+    
+    estado, codigo_string, regiao = leitura_qr.obter_pool().ler(chave, nparr)
+    if estado in (leitura_qr.LIDO, leitura_qr.NAO_LIDO):
+        repeticoes.lembrar_frame(sessao, nparr, codigo_string, regiao)
+    return estado, codigo_string
+
+
+def erro_leitura(estado, codigo_string):
+    """Resposta para uma leitura sem código, ou None se o código foi lido"""
+    if estado == leitura_qr.OCUPADO:
+        return {'success': False, 'busy': True, 'error': 'Servidor ocupado, a tentar novamente...'}
+    if estado == leitura_qr.SUBSTITUIDO:
+        return {'success': False, 'superseded': True, 'error': 'Frame substituído por um mais recente'}
+    if estado == leitura_qr.INVALIDA:
+        return {'success': False, 'error': 'Imagem inválida'}
+    if not codigo_string:
+        return {'success': False, 'error': 'Nenhum QR code detectado'}
+    return None
+
+
+def ler_codigo_pedido(request):
+    """
+    Lê o QR code da imagem do pedido.
+    Retorna (codigo, None) ou (None, JsonResponse com o motivo da falha).
     """
-    camera_id = 0
-    camera_active[camera_id] = False
-    return JsonResponse({'status': 'stopped'})
+    nparr = ler_imagem_pedido(request)
+    if nparr is None or not nparr.size:
+        return None, JsonResponse({'success': False, 'error': 'Nenhuma imagem fornecida'})
+    
+    estado, codigo_string = ler_codigo_frame(request.session.session_key or request.user.id, request.user.id, nparr)
+    erro = erro_leitura(estado, codigo_string)
+    if erro is None:
+        return codigo_string, None
+    if erro.get('busy'):
+        response = JsonResponse(erro, status=503)
+        response['Retry-After'] = '1'
+        return None, response
+    return None, JsonResponse(erro)
+
+
+def modo_leitura_pedido(request):
+    """O cliente indica se está a enviar imagens depois de a leitura no browser falhar"""
+    if request.headers.get('X-Modo-Leitura') == ContadorLeitura.MODO_RECURSO:
+        return ContadorLeitura.MODO_RECURSO
+    return ContadorLeitura.MODO_SERVIDOR
+
 
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -330,82 +409,289 @@ def scan_qr_code(request):
                 'error': 'Funcionário não está associado a nenhuma empresa.'
             })
         
-        # Obter dados da requisição
-        data = json.loads(request.body)
-        image_data = data.get('image')
-        
-        if not image_data:
-            return JsonResponse({'success': False, 'error': 'Nenhuma imagem fornecida'})
+        codigo_string, erro = ler_codigo_pedido(request)
+        if erro:
+            return erro
         
-        # Decodificar imagem base64
-        image_data = image_data.split(',')[1]  # Remover prefixo data:image/jpeg;base64,
-        image_bytes = base64.b64decode(image_data)
-        
-        # Converter para numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        # Detectar QR codes
-        qr_codes = pyzbar.decode(frame)
+        return JsonResponse(resposta_codigo(request.user, codigo_string, empresa, modo_leitura_pedido(request)))
+    
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f'Erro ao processar: {str(e)}'})
+
+
+# Token assinado devolvido com os códigos de saldo: o débito que se segue usa-o
+# em vez de voltar a procurar o código (ver process_scanned_code)
+SALT_TOKEN_SALDO = 'funcionario.debito-saldo'
+VALIDADE_TOKEN_SALDO = getattr(settings, 'ENGEN_TOKEN_SALDO_SEGUNDOS', 120)
+
+
+def gerar_token_saldo(user, requisicao_saldo):
+    return signing.dumps({'r': requisicao_saldo.id, 'u': user.id}, salt=SALT_TOKEN_SALDO)
+
+
+def ler_token_saldo(user, token):
+    """Id da requisição de saldo do token, ou None se for inválido, expirado ou de outro utilizador"""
+    try:
+        dados = signing.loads(token, salt=SALT_TOKEN_SALDO, max_age=VALIDADE_TOKEN_SALDO)
+    except signing.BadSignature:
+        return None
+    if dados.get('u') != user.id:
+        return None
+    return dados.get('r')
+
+
+def resposta_senha(codigo_string, senha):
+    return {
+        'success': True,
+        'type': 'senha',
+        'codigo': codigo_string,
+        'data': {
+            'usada': senha.usada,
+            'cliente': senha.cliente.nome if senha.cliente else 'N/A',
+            'data_criacao': senha.data_criacao.strftime('%d/%m/%Y %H:%M'),
+        }
+    }
+
+
+def resposta_saldo(user, codigo_string, requisicao_saldo):
+    return {
+        'success': True,
+        'type': 'saldo',
+        'codigo': codigo_string,
+        'token': gerar_token_saldo(user, requisicao_saldo),
+        'data': {
+            'saldo_restante': float(requisicao_saldo.saldo_restante),
+            'cliente': requisicao_saldo.cliente.nome if requisicao_saldo.cliente else 'N/A',
+            'data_criacao': requisicao_saldo.data_criacao.strftime('%d/%m/%Y %H:%M'),
+        }
+    }
+
+
+def registar_leitura(user, modo):
+    if hasattr(user, 'funcionario'):
+        ContadorLeitura.registar(user.funcionario, modo)
+
+
+def resposta_codigo(user, codigo_string, empresa, modo):
+    """
+    Dados do código lido (senha ou requisição de saldo DA EMPRESA) para o ecrã
+    do funcionário; conta a leitura no modo indicado quando o código é encontrado.
+    O mesmo código lido de novo pelo funcionário pouco depois tem a resposta
+    anterior, sem procurar o código (ver repeticoes.py), mas conta como leitura.
+    """
+    recente = repeticoes.resposta_recente(user.id, codigo_string)
+    if recente is not None:
+        if recente['success']:
+            registar_leitura(user, modo)
+        return recente
+    
+    senha_encontrada, requisicao_saldo_encontrada = procurar_codigo(codigo_string, empresa)
+    
+    if senha_encontrada:
+        resposta = resposta_senha(codigo_string, senha_encontrada)
+    elif requisicao_saldo_encontrada:
+        resposta = resposta_saldo(user, codigo_string, requisicao_saldo_encontrada)
+    else:
+        resposta = {
+            'success': False, 
+            'error': f'Código {codigo_string} não encontrado ou não pertence à sua empresa!'
+        }
+        repeticoes.lembrar_resposta(user.id, codigo_string, resposta)
+        return resposta
+    
+    registar_leitura(user, modo)
+    repeticoes.lembrar_resposta(user.id, codigo_string, resposta)
+    return resposta
+
+
+def resgatar_senha(senha, funcionario, tipo_combustivel=None):
+    """
+    Marca a senha como usada sem corridas entre funcionários: Senha.usar faz um
+    UPDATE condicional (ver gerente/resgates.py) e, no modo intervalo, resgatar()
+    bloqueia a requisição. Lança ValueError se a senha já tiver sido usada.
+    """
+    if senha.usada:
+        raise ValueError("Senha já foi usada")
+    return senha.usar(funcionario, tipo_combustivel)
+
+
+@require_http_methods(["POST"])
+@login_required(login_url='/funcionario/login')
+@user_passes_test(is_funcionario, login_url='/login')
+def procurar_codigo_lido(request):
+    """
+    Consulta leve para o modo de leitura no dispositivo: o browser já leu o
+    QR code e envia só o código (JSON {"codigo": ...}), sem imagem
+    """
+    try:
+        empresa = get_empresa_funcionario(request.user)
+        if not empresa:
+            return JsonResponse({
+                'success': False, 
+                'error': 'Funcionário não está associado a nenhuma empresa.'
+            })
         
-        if not qr_codes:
-            return JsonResponse({'success': False, 'error': 'Nenhum QR code detectado'})
+        data = json.loads(request.body)
+        codigo_string = (data.get('codigo') or '').strip()
+        if not codigo_string:
+            return JsonResponse({'success': False, 'error': 'Código não fornecido'})
         
-        # Processar primeiro QR code encontrado
-        qr_code = qr_codes[0]
-        codigo_string = qr_code.data.decode('utf-8').strip()
+        return JsonResponse(resposta_codigo(request.user, codigo_string, empresa, ContadorLeitura.MODO_DISPOSITIVO))
+    
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f'Erro ao processar: {str(e)}'})
+
+def resgatar_codigo(user, codigo_string, empresa, tipo_combustivel, modo):
+    """
+    Procura o código e, se for uma senha, marca-a logo como usada (scan_e_resgatar
+    e o canal WebSocket, ver funcionario/consumers.py). Retorna o dicionário da resposta.
+    """
+    senha, requisicao_saldo = procurar_codigo(codigo_string, empresa)
+    if senha is None and requisicao_saldo is None:
+        return {
+            'success': False, 
+            'error': f'Código {codigo_string} não encontrado ou não pertence à sua empresa!'
+        }
+    
+    registar_leitura(user, modo)
+    
+    if requisicao_saldo:
+        return resposta_saldo(user, codigo_string, requisicao_saldo)
+    
+    resposta = resposta_senha(codigo_string, senha)
+    try:
+        resgatar_senha(senha, getattr(user, 'funcionario', None), tipo_combustivel)
+    except ValueError:
+        repeticoes.esquecer_codigo(codigo_string)
+        resposta.update({
+            'success': False,
+            'resgatada': False,
+            'error': f'Senha {codigo_string} já foi utilizada!'
+        })
+        return resposta
+    
+    repeticoes.esquecer_codigo(codigo_string)
+    resposta['data']['usada'] = True
+    resposta.update({
+        'resgatada': True,
+        'message': f'Senha {codigo_string} escaneada com sucesso!'
+    })
+    return resposta
+
+
+@require_http_methods(["POST"])
+@login_required(login_url='/funcionario/login')
+@user_passes_test(is_funcionario, login_url='/login')
+def scan_e_resgatar(request):
+    """
+    Ler e resgatar num só pedido: o código (imagem como no scan_qr_code, ou
+    JSON {"codigo": ...} já lido no browser) é procurado uma vez e, se for uma
+    senha, marcado logo como usada. Os códigos de saldo precisam do valor:
+    a resposta traz os dados e o token para o débito em process_scanned_code.
+    """
+    try:
+        empresa = get_empresa_funcionario(request.user)
+        if not empresa:
+            return JsonResponse({
+                'success': False, 
+                'error': 'Funcionário não está associado a nenhuma empresa.'
+            })
         
-        # Buscar senha ou requisição de saldo
-        senha_encontrada = None
-        requisicao_saldo_encontrada = None
+        data = {}
+        if request.content_type not in TIPOS_IMAGEM_BINARIA:
+            data = json.loads(request.body)
         
-        # Tentar encontrar como senha DA EMPRESA
-        try:
-            senha_encontrada = Senha.objects.get(
-                codigo=codigo_string,
-                empresa=empresa
-            )
-        except Senha.DoesNotExist:
-            pass
+        codigo_string = (data.get('codigo') or '').strip()
+        if codigo_string:
+            modo = ContadorLeitura.MODO_DISPOSITIVO
+        else:
+            codigo_string, erro = ler_codigo_pedido(request)
+            if erro:
+                return erro
+            modo = modo_leitura_pedido(request)
         
-        # Tentar encontrar como código de requisição de saldo DA EMPRESA
-        try:
-            requisicao_saldo_encontrada = RequisicaoSaldo.objects.get(
-                codigo=codigo_string,
-                empresa=empresa,
-                ativa=True
-            )
-        except RequisicaoSaldo.DoesNotExist:
-            pass
+        tipo_combustivel = data.get('tipo_combustivel') or request.GET.get('tipo_combustivel')
+        if tipo_combustivel not in ('gasolina', 'diesel'):
+            tipo_combustivel = None
         
-        if senha_encontrada:
-            return JsonResponse({
-                'success': True,
-                'type': 'senha',
-                'codigo': codigo_string,
-                'data': {
-                    'usada': senha_encontrada.usada,
-                    'cliente': senha_encontrada.cliente.nome if senha_encontrada.cliente else 'N/A',
-                    'data_criacao': senha_encontrada.data_criacao.strftime('%d/%m/%Y %H:%M'),
-                }
-            })
-        elif requisicao_saldo_encontrada:
-            return JsonResponse({
-                'success': True,
-                'type': 'saldo',
-                'codigo': codigo_string,
-                'data': {
-                    'saldo_restante': float(requisicao_saldo_encontrada.saldo_restante),
-                    'cliente': requisicao_saldo_encontrada.cliente.nome if requisicao_saldo_encontrada.cliente else 'N/A',
-                    'data_criacao': requisicao_saldo_encontrada.data_criacao.strftime('%d/%m/%Y %H:%M'),
-                }
-            })
-        else:
+        return JsonResponse(resgatar_codigo(request.user, codigo_string, empresa, tipo_combustivel, modo))
+    
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f'Erro ao processar: {str(e)}'})
+
+
+def resposta_lote(user, lidos, empresa, tipo_combustivel, modo):
+    """
+    Resgata as senhas lidas de uma vez (ver gerente/resgates.py) e resume o
+    resultado; as encontradas contam como leituras no `modo` (None para não contar).
+    """
+    funcionario = getattr(user, 'funcionario', None)
+    resultados = resgates.resgatar_lote(lidos, empresa, funcionario, tipo_combustivel)
+    
+    encontradas = sum(
+        1 for resultado in resultados
+        if resultado['estado'] not in (resgates.NAO_ENCONTRADA, resgates.INVALIDA)
+    )
+    if funcionario and modo and encontradas:
+        ContadorLeitura.registar(funcionario, modo, encontradas)
+    for resultado in resultados:
+        repeticoes.esquecer_codigo(resultado['codigo'])
+    
+    resgatadas = sum(1 for resultado in resultados if resultado['estado'] == resgates.RESGATADA)
+    return {
+        'success': resgatadas > 0,
+        'resgatadas': resgatadas,
+        'total': len(resultados),
+        'resultados': resultados,
+        'message': f'{resgatadas} de {len(resultados)} senhas resgatadas.',
+    }
+
+
+@require_http_methods(["POST"])
+@login_required(login_url='/funcionario/login')
+@user_passes_test(is_funcionario, login_url='/login')
+def resgatar_lote(request):
+    """
+    Resgate em lote (frotas): JSON {"codigos": [...], "tipo_combustivel": ...}
+    ou a imagem de uma tira de senhas, de que são lidos todos os QR codes.
+    Todas as senhas são resgatadas numa só transação; a resposta traz o
+    resultado de cada código.
+    """
+    try:
+        empresa = get_empresa_funcionario(request.user)
+        if not empresa:
             return JsonResponse({
                 'success': False, 
-                'error': f'Código {codigo_string} não encontrado ou não pertence à sua empresa!'
+                'error': 'Funcionário não está associado a nenhuma empresa.'
             })
+        
+        data = {}
+        if request.content_type not in TIPOS_IMAGEM_BINARIA:
+            data = json.loads(request.body)
+        
+        lidos = data.get('codigos')
+        if isinstance(lidos, str):
+            lidos = resgates.separar_codigos(lidos)
+        if lidos:
+            modo = ContadorLeitura.MODO_DISPOSITIVO
+        else:
+            nparr = ler_imagem_pedido(request)
+            if nparr is None or not nparr.size:
+                return JsonResponse({'success': False, 'error': 'Nenhum código ou imagem fornecidos'})
+            estado, lidos, _ = leitura_qr.obter_pool().ler(request.user.id, nparr, todos=True)
+            erro = erro_leitura(estado, lidos)
+            if erro:
+                return JsonResponse(erro, status=503 if erro.get('busy') else 200)
+            modo = modo_leitura_pedido(request)
+        
+        tipo_combustivel = data.get('tipo_combustivel') or request.GET.get('tipo_combustivel')
+        if tipo_combustivel not in ('gasolina', 'diesel'):
+            tipo_combustivel = None
+        
+        return JsonResponse(resposta_lote(request.user, lidos, empresa, tipo_combustivel, modo))
     
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)})
     except Exception as e:
         return JsonResponse({'success': False, 'error': f'Erro ao processar: {str(e)}'})
 
@@ -434,26 +720,31 @@ def process_scanned_code(request):
         if not codigo_string:
             return JsonResponse({'success': False, 'error': 'Código não fornecido'})
         
+        # Rejeitar códigos inválidos (ou de outro tipo) sem ir à base de dados
+        tipos_aceites = (TIPO_LEGADO, TIPO_SENHA, TIPO_INTERVALO) if tipo == 'senha' else (TIPO_LEGADO, TIPO_SALDO)
+        if classificar_codigo(codigo_string) not in tipos_aceites:
+            return JsonResponse({'success': False, 'error': f'Código {codigo_string} inválido!'})
+        
         if tipo == 'senha':
             # Processar senha
-            try:
-                senha = Senha.objects.get(codigo=codigo_string, empresa=empresa)
-                if senha.usada:
-                    return JsonResponse({
-                        'success': False, 
-                        'error': f'Senha {codigo_string} já foi utilizada!'
-                    })
-                else:
-                    senha.usada = True
-                    senha.data_uso = timezone.now()
-                    senha.funcionario_uso = request.user.funcionario if hasattr(request.user, 'funcionario') else None
-                    senha.save()
-                    return JsonResponse({
-                        'success': True, 
-                        'message': f'Senha {codigo_string} escaneada com sucesso!'
-                    })
-            except Senha.DoesNotExist:
+            senha, _ = procurar_codigo(codigo_string, empresa)
+            if senha is None:
                 return JsonResponse({'success': False, 'error': 'Senha não encontrada'})
+            
+            try:
+                resgatar_senha(senha, request.user.funcionario if hasattr(request.user, 'funcionario') else None)
+            except ValueError:
+                repeticoes.esquecer_codigo(codigo_string)
+                return JsonResponse({
+                    'success': False, 
+                    'error': f'Senha {codigo_string} já foi utilizada!'
+                })
+            
+            repeticoes.esquecer_codigo(codigo_string)
+            return JsonResponse({
+                'success': True, 
+                'message': f'Senha {codigo_string} escaneada com sucesso!'
+            })
         
         elif tipo == 'saldo':
             # Processar requisição de saldo
@@ -469,37 +760,44 @@ def process_scanned_code(request):
                     'error': 'Por favor, selecione o tipo de combustível.'
                 })
             
+            # Com o token da leitura (scan_e_resgatar/scan_qr_code) a requisição vem pela chave
+            # primária; o código tem de ser o da mesma requisição (senão não é encontrada)
+            token = data.get('token')
+            filtro = {'codigo': codigo_string}
+            if token:
+                requisicao_id = ler_token_saldo(request.user, token)
+                if requisicao_id is None:
+                    return JsonResponse({'success': False, 'error': 'A leitura expirou. Leia o código novamente.'})
+                filtro['pk'] = requisicao_id
+            
             try:
                 requisicao_saldo = RequisicaoSaldo.objects.get(
-                    codigo=codigo_string, 
                     empresa=empresa, 
-                    ativa=True
+                    ativa=True,
+                    **filtro
                 )
                 
                 valor_decimal = Decimal(valor)
                 if valor_decimal <= 0:
                     return JsonResponse({'success': False, 'error': 'Valor deve ser maior que zero!'})
                 
-                if valor_decimal > requisicao_saldo.saldo_restante:
-                    return JsonResponse({
-                        'success': False, 
-                        'error': f'Saldo insuficiente! Disponível: {requisicao_saldo.saldo_restante} MT'
-                    })
-                
-                # Criar movimento de débito
-                movimento = Movimento.objects.create(
-                    requisicao_saldo=requisicao_saldo,
-                    valor=valor_decimal,
-                    tipo_combustivel=tipo_combustivel,
+                # Criar movimento de débito (saldo verificado com a requisição bloqueada)
+                saldos.debitar(
+                    requisicao_saldo,
+                    valor_decimal,
+                    tipo_combustivel,
+                    funcionario=request.user.funcionario if hasattr(request.user, 'funcionario') else None,
                     descricao=f'Débito via scan QR ({tipo_combustivel.title()}) - Funcionário: {request.user.get_full_name() or request.user.username}',
-                    funcionario=request.user.funcionario if hasattr(request.user, 'funcionario') else None
                 )
+                repeticoes.esquecer_codigo(codigo_string)
                 
                 return JsonResponse({
                     'success': True, 
                     'message': f'Débito de {valor_decimal} MT realizado com sucesso! Combustível: {tipo_combustivel.title()}'
                 })
                 
+            except saldos.SaldoInsuficiente as e:
+                return JsonResponse({'success': False, 'error': str(e)})
             except RequisicaoSaldo.DoesNotExist:
                 return JsonResponse({'success': False, 'error': 'Requisição de saldo não encontrada'})
             except (ValueError, TypeError):
@@ -0,0 +1,329 @@
+"""
+Armazenamento compacto das senhas (modo intervalo).
+
+No modo "linhas" cada senha é uma linha da tabela Senha. No modo "intervalo"
+a requisição não grava senhas: a senha `i` tem o código derivado
+`codigos.codigo_intervalo(requisicao.id, i)`, o estado de uso fica num mapa de
+bits na própria requisição (`bitmap_uso`) e cada uso gera um `ResgateSenha`
+com a data, o funcionário, o combustível e o fecho.
+
+As funções deste módulo escondem a diferença entre os dois modos das views
+(scan, ver_senhas, impressão de QR codes, extrato e fecho).
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from . import cache_codigos, codigos
+from .models import CodigoIndex, RequisicaoSenhas, ResgateSenha
+
+# Modo usado nas requisições novas ('linhas' ou 'intervalo')
+MODO_PADRAO = getattr(settings, 'ENGEN_MODO_ARMAZENAMENTO_SENHAS', RequisicaoSenhas.MODO_LINHAS)
+
+
+class SenhaIntervalo:
+    """Senha de uma requisição em modo intervalo, com a mesma interface que Senha"""
+
+    def __init__(self, requisicao, indice, resgate=None):
+        self.requisicao = requisicao
+        self.indice = indice
+        self.resgate = resgate
+        # As requisições convertidas mantêm o código original no resgate
+        self.codigo = resgate.codigo if resgate else codigos.codigo_intervalo(requisicao.id, indice)
+
+    def __str__(self):
+        return f"{self.codigo} ({'Usada' if self.usada else 'Disponível'})"
+
+    @property
+    def usada(self):
+        return bit_usado(self.requisicao.bitmap_uso, self.indice)
+
+    @property
+    def pode_ser_usada(self):
+        return not self.usada
+
+    @property
+    def empresa(self):
+        return self.requisicao.empresa
+
+    @property
+    def cliente(self):
+        return self.requisicao.cliente
+
+    @property
+    def data_criacao(self):
+        return self.requisicao.data_criacao
+
+    @property
+    def data_uso(self):
+        return self.resgate.data_uso if self.resgate else None
+
+    @property
+    def funcionario_uso(self):
+        return self.resgate.funcionario_uso if self.resgate else None
+
+    @property
+    def tipo_combustivel(self):
+        return self.resgate.tipo_combustivel if self.resgate else None
+
+    @property
+    def fecho(self):
+        return self.resgate.fecho if self.resgate else None
+
+    def usar(self, funcionario, tipo_combustivel=None):
+        """Marca a senha como usada - FICA PENDENTE PARA FECHO"""
+        self.resgate = resgatar(self.requisicao.id, self.indice, funcionario, tipo_combustivel)
+        self.requisicao.bitmap_uso = self.resgate.requisicao.bitmap_uso
+        return True
+
+
+# ================================
+# MAPA DE BITS
+# ================================
+
+def bits_usados(bitmap):
+    return int.from_bytes(bytes(bitmap or b''), 'big').bit_count()
+
+
+def bit_usado(bitmap, indice):
+    bitmap = bitmap or b''
+    byte = indice // 8
+    return byte < len(bitmap) and bool(bitmap[byte] & (1 << (indice % 8)))
+
+
+def _bitmap_com_tamanho(bitmap, quantidade):
+    """Garante que o mapa tem pelo menos `quantidade` bits (novos bits a zero)"""
+    bitmap = bytes(bitmap or b'')
+    necessario = (quantidade + 7) // 8
+    return bitmap + bytes(max(necessario - len(bitmap), 0))
+
+
+# ================================
+# EMISSÃO E USO
+# ================================
+
+def reservar_intervalo(requisicao):
+    """
+    "Emite" as senhas de uma requisição em modo intervalo: só é preciso que o
+    mapa de bits cubra `requisicao.senhas`. Retorna o número de senhas da requisição.
+    """
+    if requisicao.senhas > codigos.MAX_SENHAS_INTERVALO:
+        raise ValueError(f'O modo intervalo suporta no máximo {codigos.MAX_SENHAS_INTERVALO} senhas por requisição.')
+
+    with transaction.atomic():
+        bitmap = (
+            RequisicaoSenhas.objects.select_for_update()
+            .values_list('bitmap_uso', flat=True)
+            .get(pk=requisicao.pk)
+        )
+        requisicao.bitmap_uso = _bitmap_com_tamanho(bitmap, requisicao.senhas)
+        RequisicaoSenhas.objects.filter(pk=requisicao.pk).update(bitmap_uso=requisicao.bitmap_uso)
+    return requisicao.senhas
+
+
+def resgatar(requisicao_id, indice, funcionario, tipo_combustivel=None):
+    """Marca a senha `indice` como usada. Levanta ValueError se já foi usada."""
+    with transaction.atomic():
+        # Bloquear a requisição: o mapa de bits é lido e escrito por inteiro
+        requisicao = RequisicaoSenhas.objects.select_for_update().get(pk=requisicao_id)
+        if bit_usado(requisicao.bitmap_uso, indice):
+            raise ValueError("Senha já foi usada")
+
+        bitmap = bytearray(_bitmap_com_tamanho(requisicao.bitmap_uso, indice + 1))
+        bitmap[indice // 8] |= 1 << (indice % 8)
+        requisicao.bitmap_uso = bytes(bitmap)
+        requisicao.senhas_usadas += 1
+        RequisicaoSenhas.objects.filter(pk=requisicao.pk).update(
+            bitmap_uso=requisicao.bitmap_uso, senhas_usadas=F('senhas_usadas') + 1,
+        )
+
+        resgate = ResgateSenha.objects.create(
+            requisicao=requisicao,
+            indice=indice,
+            codigo=codigos.codigo_intervalo(requisicao.id, indice),
+            data_uso=timezone.now(),
+            funcionario_uso=funcionario,
+            tipo_combustivel=tipo_combustivel,
+        )
+
+        # Verificar se completou a requisição
+        requisicao.concluir()
+    return resgate
+
+
+def resgatar_indices(requisicao_id, indices, empresa, funcionario, tipo_combustivel=None):
+    """
+    Marca várias senhas da mesma requisição como usadas, com um só bloqueio e
+    uma só escrita do mapa de bits; as já usadas são ignoradas.
+    Retorna (requisicao, índices resgatados), ou (None, []) se a requisição
+    não for da empresa ou não estiver em modo intervalo.
+    """
+    with transaction.atomic():
+        requisicao = (
+            RequisicaoSenhas.objects.select_for_update(of=('self',)).select_related('cliente')
+            .filter(pk=requisicao_id, empresa=empresa, modo_armazenamento=RequisicaoSenhas.MODO_INTERVALO)
+            .first()
+        )
+        if requisicao is None:
+            return None, []
+
+        livres = sorted({
+            indice for indice in indices
+            if indice < requisicao.senhas and not bit_usado(requisicao.bitmap_uso, indice)
+        })
+        if not livres:
+            return requisicao, []
+
+        bitmap = bytearray(_bitmap_com_tamanho(requisicao.bitmap_uso, livres[-1] + 1))
+        for indice in livres:
+            bitmap[indice // 8] |= 1 << (indice % 8)
+        requisicao.bitmap_uso = bytes(bitmap)
+        requisicao.senhas_usadas += len(livres)
+        RequisicaoSenhas.objects.filter(pk=requisicao.pk).update(
+            bitmap_uso=requisicao.bitmap_uso, senhas_usadas=F('senhas_usadas') + len(livres),
+        )
+
+        agora = timezone.now()
+        ResgateSenha.objects.bulk_create([
+            ResgateSenha(
+                requisicao=requisicao,
+                indice=indice,
+                codigo=codigos.codigo_intervalo(requisicao.id, indice),
+                data_uso=agora,
+                funcionario_uso=funcionario,
+                tipo_combustivel=tipo_combustivel,
+            )
+            for indice in livres
+        ])
+
+        # Verificar se completou a requisição
+        requisicao.concluir()
+    return requisicao, livres
+
+
+# ================================
+# CONSULTA
+# ================================
+
+def procurar_senha_intervalo(codigo, empresa):
+    """SenhaIntervalo correspondente a um código do tipo intervalo já validado (ou None)"""
+    requisicao_id, indice = codigos.decodificar_intervalo(codigo)
+    requisicao = (
+        RequisicaoSenhas.objects.select_related('cliente')
+        .filter(pk=requisicao_id, empresa=empresa, modo_armazenamento=RequisicaoSenhas.MODO_INTERVALO)
+        .first()
+    )
+    if requisicao is None or indice >= requisicao.senhas:
+        return None
+
+    resgate = None
+    if bit_usado(requisicao.bitmap_uso, indice):
+        resgate = requisicao.resgates.filter(indice=indice).first()
+    return SenhaIntervalo(requisicao, indice, resgate)
+
+
+def listar_senhas(requisicao, usada=None):
+    """
+    Senhas da requisição em qualquer modo (opcionalmente só usadas/não usadas).
+    No modo linhas retorna um queryset, no modo intervalo uma lista de SenhaIntervalo.
+    """
+    if not requisicao.em_intervalo:
+        senhas = requisicao.lista_senhas.all()
+        return senhas if usada is None else senhas.filter(usada=usada)
+
+    resgates = {}
+    if usada is not False:
+        resgates = {r.indice: r for r in requisicao.resgates.select_related('funcionario_uso', 'fecho')}
+
+    return [
+        SenhaIntervalo(requisicao, indice, resgates.get(indice))
+        for indice in range(requisicao.senhas)
+        if usada is None or bit_usado(requisicao.bitmap_uso, indice) == usada
+    ]
+
+
+def iterar_codigos(requisicao, usada=None):
+    """
+    Só os códigos das senhas, sem criar um objeto por senha (para folhas grandes).
+    No modo linhas os códigos são lidos da base de dados em blocos.
+    """
+    if not requisicao.em_intervalo:
+        senhas = requisicao.lista_senhas.order_by('id')
+        if usada is not None:
+            senhas = senhas.filter(usada=usada)
+        yield from senhas.values_list('codigo', flat=True).iterator(chunk_size=2000)
+        return
+
+    # As senhas usadas das requisições convertidas mantêm o código original
+    codigos_resgates = {}
+    if usada is not False:
+        codigos_resgates = dict(requisicao.resgates.values_list('indice', 'codigo'))
+
+    for indice in range(requisicao.senhas):
+        if usada is None or bit_usado(requisicao.bitmap_uso, indice) == usada:
+            yield codigos_resgates.get(indice) or codigos.codigo_intervalo(requisicao.id, indice)
+
+
+# ================================
+# CONVERSÃO DE REQUISIÇÕES ANTIGAS
+# ================================
+
+def pode_converter(requisicao):
+    """Só requisições fechadas com todas as senhas usadas e fechadas podem ser convertidas"""
+    if requisicao.em_intervalo or requisicao.fecho_id is None:
+        return False
+    senhas = requisicao.lista_senhas
+    return (
+        senhas.count() == requisicao.senhas and
+        not senhas.filter(usada=False).exists() and
+        not senhas.filter(fecho__isnull=True).exists()
+    )
+
+
+def converter_requisicao(requisicao):
+    """
+    Converte uma requisição fechada do modo linhas para o modo intervalo.
+    O histórico de uso passa para ResgateSenha (com o código original) e as
+    linhas de Senha são apagadas. Retorna o número de senhas convertidas.
+    """
+    with transaction.atomic():
+        requisicao = RequisicaoSenhas.objects.select_for_update().get(pk=requisicao.pk)
+        if not pode_converter(requisicao):
+            raise ValueError(f'A requisição #{requisicao.id} não pode ser convertida.')
+
+        senhas = list(requisicao.lista_senhas.order_by('id'))
+        ResgateSenha.objects.bulk_create([
+            ResgateSenha(
+                requisicao=requisicao,
+                indice=indice,
+                codigo=senha.codigo,
+                data_uso=senha.data_uso or senha.data_criacao,
+                funcionario_uso_id=senha.funcionario_uso_id,
+                tipo_combustivel=senha.tipo_combustivel,
+                fecho_id=senha.fecho_id,
+            )
+            for indice, senha in enumerate(senhas)
+        ])
+
+        bitmap = bytearray(_bitmap_com_tamanho(b'', len(senhas)))
+        for indice in range(len(senhas)):
+            bitmap[indice // 8] |= 1 << (indice % 8)
+
+        RequisicaoSenhas.objects.filter(pk=requisicao.pk).update(
+            modo_armazenamento=RequisicaoSenhas.MODO_INTERVALO,
+            bitmap_uso=bytes(bitmap),
+        )
+        # O índice de códigos passa a apontar para os resgates (mesmo código)
+        CodigoIndex.objects.filter(
+            tipo=CodigoIndex.TIPO_SENHA, objeto_id__in=requisicao.lista_senhas.values('id'),
+        ).update(
+            tipo=CodigoIndex.TIPO_RESGATE,
+            estado=CodigoIndex.ESTADO_USADA,
+            objeto_id=Subquery(
+                ResgateSenha.objects.filter(requisicao=requisicao, codigo=OuterRef('codigo')).values('id')[:1]
+            ),
+        )
+        requisicao.lista_senhas.all().delete()
+        cache_codigos.invalidar(requisicao.empresa_id)
+    return len(senhas)
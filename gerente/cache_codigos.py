@@ -0,0 +1,418 @@
+"""
+Cache em memória (por processo) à frente do índice de códigos (CodigoIndex).
+
+A maioria dos scans só vai à base de dados para descobrir que o código não
+existe ou é de outra empresa. Por isso cada processo guarda, por empresa:
+  - um filtro de Bloom com todos os códigos da empresa no índice, que responde
+    "não existe" sem nenhuma query;
+  - um LRU pequeno código -> entrada do índice (tipo, id do objeto, empresa).
+
+O LRU não serve o estado da senha nem do saldo: o estado vem sempre da linha
+do objeto, lida pela chave primária, e usar uma senha ou editar um saldo não
+invalida nada.
+
+Códigos novos (emissão de senhas, criação de requisições de saldo) são
+acrescentados ao filtro vivo: cada lote fica num registo de adições na cache
+do Django (partilhada entre processos, ver CACHES nos settings), e cada
+processo aplica os lotes que ainda não viu. O número de cada lote tem de ser
+único, e só a cache Redis o incrementa de forma atómica: com outra cache (p.
+ex. a da base de dados), os códigos novos incrementam a versão da empresa.
+
+As alterações que tiram ou mudam códigos (conversão para o modo intervalo,
+reconstrução e correção do índice) incrementam sempre a versão da empresa: o
+LRU dessa empresa deixa logo de servir e o filtro é montado de novo numa
+thread. Até o filtro novo estar pronto, ao antigo podem faltar códigos (como
+quando expirou um lote do registo), e a procura dessa empresa vai
+diretamente ao índice.
+
+Cada processo lê a versão e o registo no máximo a cada INTERVALO_VERSAO
+segundos. Enquanto uma empresa não tem filtro, e se a cache do Django
+falhar, a procura vai diretamente ao índice.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.db import connection, transaction
+
+from .models import CodigoIndex
+
+ATIVA = getattr(settings, 'ENGEN_CACHE_CODIGOS', True)
+# Entradas do índice guardadas no LRU (todas as empresas)
+TAMANHO_LRU = getattr(settings, 'ENGEN_CACHE_CODIGOS_LRU', 10000)
+# Taxa de falsos positivos pretendida para o filtro de Bloom
+FALSOS_POSITIVOS = getattr(settings, 'ENGEN_CACHE_CODIGOS_FALSOS_POSITIVOS', 0.01)
+# Segundos entre leituras da versão de cada empresa na cache do Django
+INTERVALO_VERSAO = getattr(settings, 'ENGEN_CACHE_CODIGOS_INTERVALO_VERSAO', 2)
+# Segundos que cada lote de códigos novos fica no registo de adições
+DURACAO_ADICOES = getattr(settings, 'ENGEN_CACHE_CODIGOS_DURACAO_ADICOES', 3600)
+
+PREFIXO_VERSAO = 'engen:codigos:versao:'
+CHAVE_VERSAO_GLOBAL = 'engen:codigos:versao'
+PREFIXO_ADICOES = 'engen:codigos:adicoes:'
+
+logger = logging.getLogger(__name__)
+
+
+class FiltroBloom:
+    """Filtro de Bloom num bytearray, dimensionado para `capacidade` códigos"""
+
+    def __init__(self, capacidade, falsos_positivos=FALSOS_POSITIVOS):
+        capacidade = max(capacidade, 1)
+        self.capacidade = capacidade
+        self.bits = max(64, math.ceil(-capacidade * math.log(falsos_positivos) / math.log(2) ** 2))
+        self.funcoes = max(1, round(self.bits / capacidade * math.log(2)))
+        self._mapa = bytearray((self.bits + 7) // 8)
+
+    def _posicoes(self, codigo):
+        # Dupla dispersão (Kirsch-Mitzenmacher) a partir de um só digest
+        digest = hashlib.blake2b(codigo.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.funcoes)]
+
+    def adicionar(self, codigo):
+        for posicao in self._posicoes(codigo):
+            self._mapa[posicao >> 3] |= 1 << (posicao & 7)
+
+    def __contains__(self, codigo):
+        return all(self._mapa[posicao >> 3] & (1 << (posicao & 7)) for posicao in self._posicoes(codigo))
+
+
+class _Empresa:
+    def __init__(self, versao, adicoes):
+        # O LRU só serve entradas guardadas nesta versão
+        self.versao = versao
+        # None até à primeira montagem (a procura vai ao índice)
+        self.filtro = None
+        # False enquanto o filtro pode não ter todos os códigos (a procura vai ao índice)
+        self.confiavel = True
+        # Pedidos de montagem por falta de códigos: se chegar um durante a montagem, monta de novo
+        self.geracao = 0
+        self.codigos = 0
+        # Último lote do registo de adições já aplicado
+        self.adicoes = adicoes
+        self.montando = False
+        # Códigos acrescentados durante a montagem, para o filtro novo
+        self.pendentes = []
+        # Serializa as escritas no filtro (os bits são alterados byte a byte)
+        self.lock = threading.Lock()
+        self.verificada_em = time.monotonic()
+
+    def adicionar(self, codigos):
+        with self.lock:
+            if self.filtro is not None:
+                for codigo in codigos:
+                    self.filtro.adicionar(codigo)
+                self.codigos += len(codigos)
+            if self.montando:
+                self.pendentes.extend(codigos)
+
+
+_empresas = {}
+_lru = OrderedDict()  # codigo -> (versao da empresa, entrada)
+_lock = threading.Lock()
+
+_contadores = {
+    'consultas': 0,
+    'negativas_bloom': 0,    # respondidas pelo filtro, sem query
+    'acertos_lru': 0,        # entrada do índice vinda do LRU, sem query
+    'falhas_lru': 0,         # filtro disse "talvez" e foi preciso ir ao índice
+    'falsos_positivos': 0,   # ... e o índice não tinha o código
+    'montagens_filtro': 0,   # em segundo plano
+    'lotes_adicionados': 0,  # lotes de códigos novos acrescentados ao filtro vivo
+    'sem_filtro': 0,         # filtro a ser montado ou sem todos os códigos: procura direta
+    'sem_cache': 0,          # cache do Django indisponível: procura direta
+}
+
+
+def _contar(tipo):
+    with _lock:
+        _contadores[tipo] += 1
+
+
+def estatisticas():
+    """Contadores da cache neste processo, com as taxas de acerto e de falsos positivos"""
+    with _lock:
+        dados = dict(_contadores)
+        dados['empresas'] = len(_empresas)
+        dados['itens_lru'] = len(_lru)
+    sem_query = dados['negativas_bloom'] + dados['acertos_lru']
+    negativos = dados['negativas_bloom'] + dados['falsos_positivos']
+    pedidos_lru = dados['acertos_lru'] + dados['falhas_lru']
+    dados.update({
+        'taxa_acerto': sem_query / dados['consultas'] if dados['consultas'] else 0.0,
+        'taxa_acerto_lru': dados['acertos_lru'] / pedidos_lru if pedidos_lru else 0.0,
+        'taxa_falsos_positivos': dados['falsos_positivos'] / negativos if negativos else 0.0,
+    })
+    return dados
+
+
+# ================================
+# VERSÕES (CACHE DO DJANGO)
+# ================================
+
+def _ler_versao(empresa_id):
+    """((global, empresa), último lote de adições) dos códigos da empresa"""
+    chaves = [CHAVE_VERSAO_GLOBAL, f'{PREFIXO_VERSAO}{empresa_id}', f'{PREFIXO_ADICOES}{empresa_id}']
+    valores = cache.get_many(chaves)
+    versao_global, versao, adicoes = (valores.get(chave, 0) for chave in chaves)
+    return (versao_global, versao), adicoes
+
+
+def _incrementar(chave):
+    """Incrementa o contador e retorna o valor novo"""
+    cache.add(chave, 0, timeout=None)
+    try:
+        return cache.incr(chave)
+    except ValueError:
+        # A chave foi descartada entretanto
+        cache.set(chave, 1, timeout=None)
+        return 1
+
+
+def _registo_atomico():
+    """Se a cache do Django incrementa contadores de forma atómica entre processos"""
+    return isinstance(caches['default'], RedisCache)
+
+
+def _descartar_local(empresa_id=None):
+    """Neste processo: o LRU deixa de servir e o filtro é montado de novo, sem largar o atual"""
+    with _lock:
+        if empresa_id is None:
+            estados = list(_empresas.items())
+            _lru.clear()
+        else:
+            estados = [(empresa_id, _empresas[empresa_id])] if empresa_id in _empresas else []
+        for _, estado in estados:
+            estado.versao = None
+    for empresa_id, estado in estados:
+        _montar_em_fundo(empresa_id, estado)
+
+
+def adicionar(empresa_id, codigos):
+    """
+    Acrescenta códigos novos da empresa aos filtros de todos os processos, depois
+    do commit da transação em curso. Com a cache Redis não invalida o LRU nem
+    monta filtros; com outra cache é o mesmo que invalidar().
+    """
+    codigos = list(codigos)
+    if empresa_id is not None and codigos and not _registo_atomico():
+        # Dois processos podiam receber o mesmo número de lote e um lote tapar o outro
+        invalidar(empresa_id)
+        return
+
+    def registar():
+        try:
+            lote = _incrementar(f'{PREFIXO_ADICOES}{empresa_id}')
+            cache.set(f'{PREFIXO_ADICOES}{empresa_id}:{lote}', codigos, timeout=DURACAO_ADICOES)
+        except Exception:
+            logger.exception('Não foi possível registar os códigos novos da empresa #%s', empresa_id)
+            invalidar(empresa_id)
+            return
+        # Neste processo os códigos ficam logo no filtro
+        with _lock:
+            estado = _empresas.get(empresa_id)
+            if estado is None:
+                return
+            if estado.adicoes == lote - 1:
+                estado.adicoes = lote
+        estado.adicionar(codigos)
+
+    if empresa_id is not None and codigos:
+        transaction.on_commit(registar)
+
+
+def invalidar(empresa_id):
+    """
+    Nova versão dos códigos da empresa, depois do commit da transação em curso:
+    para códigos removidos ou alterados (os novos usam adicionar()).
+    """
+    def incrementar():
+        _descartar_local(empresa_id)
+        try:
+            _incrementar(f'{PREFIXO_VERSAO}{empresa_id}')
+        except Exception:
+            logger.exception('Não foi possível invalidar a cache de códigos da empresa #%s', empresa_id)
+
+    if empresa_id is not None:
+        transaction.on_commit(incrementar)
+
+
+def invalidar_todas():
+    """Nova versão para todas as empresas (p. ex. depois de reconstruir o índice)"""
+    def incrementar():
+        _descartar_local()
+        try:
+            _incrementar(CHAVE_VERSAO_GLOBAL)
+        except Exception:
+            logger.exception('Não foi possível invalidar a cache de códigos')
+
+    transaction.on_commit(incrementar)
+
+
+# ================================
+# PROCURA
+# ================================
+
+def _montar_filtro(empresa_id):
+    """(filtro, número de códigos) com todos os códigos da empresa no índice"""
+    codigos = CodigoIndex.objects.filter(empresa_id=empresa_id).values_list('codigo', flat=True)
+    total = codigos.count()
+    # Folga para os códigos acrescentados até à próxima montagem
+    filtro = FiltroBloom(int(total * 1.25) + 100)
+    for codigo in codigos.iterator(chunk_size=5000):
+        filtro.adicionar(codigo)
+    return filtro, total
+
+
+def _montar(empresa_id, estado):
+    try:
+        while True:
+            with estado.lock:
+                geracao = estado.geracao
+            filtro, total = _montar_filtro(empresa_id)
+            with estado.lock:
+                # Os códigos acrescentados durante a montagem podem não ter sido lidos
+                for codigo in estado.pendentes:
+                    filtro.adicionar(codigo)
+                estado.filtro = filtro
+                estado.codigos = total + len(estado.pendentes)
+                estado.pendentes = []
+                pronto = estado.geracao == geracao
+                if pronto:
+                    estado.confiavel = True
+                    estado.montando = False
+            _contar('montagens_filtro')
+            if pronto:
+                break
+            # Pedida durante a leitura: podem faltar códigos commitados depois de ela começar
+    except Exception:
+        logger.exception('Não foi possível montar o filtro de códigos da empresa #%s', empresa_id)
+        with estado.lock:
+            estado.pendentes = []
+            estado.montando = False
+    finally:
+        connection.close()
+
+
+def _montar_em_fundo(empresa_id, estado, incompleto=True):
+    """
+    Monta o filtro da empresa numa thread. Se ao filtro atual podem faltar
+    códigos (`incompleto`), a procura vai ao índice até o novo estar pronto;
+    senão (filtro só cheio) o atual continua a responder.
+    """
+    with estado.lock:
+        if incompleto:
+            estado.confiavel = False
+            estado.geracao += 1
+        if estado.montando:
+            return
+        estado.montando = True
+    threading.Thread(target=_montar, args=(empresa_id, estado), name=f'filtro-codigos-{empresa_id}', daemon=True).start()
+
+
+def _aplicar_adicoes(empresa_id, estado, primeiro, ultimo):
+    """Acrescenta ao filtro os lotes do registo de adições de `primeiro` a `ultimo`"""
+    chaves = [f'{PREFIXO_ADICOES}{empresa_id}:{lote}' for lote in range(primeiro, ultimo + 1)]
+    try:
+        lotes = cache.get_many(chaves)
+    except Exception:
+        logger.exception('Cache do Django indisponível; filtro de códigos montado de novo')
+        lotes = {}
+    for chave in chaves:
+        if chave not in lotes:
+            # Lote expirado (ou ainda por gravar): só uma montagem nova garante todos os códigos
+            _montar_em_fundo(empresa_id, estado)
+            continue
+        estado.adicionar(lotes[chave])
+        _contar('lotes_adicionados')
+
+    if estado.filtro is not None and estado.codigos > estado.filtro.capacidade:
+        _montar_em_fundo(empresa_id, estado, incompleto=False)
+
+
+def _estado_empresa(empresa_id):
+    """Estado da empresa neste processo; None se a cache do Django falhar"""
+    with _lock:
+        estado = _empresas.get(empresa_id)
+    if estado and estado.versao is not None and time.monotonic() - estado.verificada_em < INTERVALO_VERSAO:
+        return estado
+
+    try:
+        versao, adicoes = _ler_versao(empresa_id)
+    except Exception:
+        logger.exception('Cache do Django indisponível; códigos procurados sem cache')
+        return None
+
+    montar = False
+    pendentes = None
+    with _lock:
+        estado = _empresas.get(empresa_id)
+        if estado is None:
+            estado = _empresas[empresa_id] = _Empresa(versao, adicoes)
+            montar = True
+        else:
+            # Montagem falhada: tentar outra vez
+            montar = (estado.filtro is None or not estado.confiavel) and not estado.montando
+            if estado.versao != versao:
+                # Códigos removidos ou alterados: o LRU antigo deixa já de servir
+                montar = True
+                estado.versao = versao
+            if adicoes > estado.adicoes:
+                pendentes = (estado.adicoes + 1, adicoes)
+            # Uma só thread aplica cada lote
+            estado.adicoes = max(estado.adicoes, adicoes)
+        estado.verificada_em = time.monotonic()
+
+    if montar:
+        _montar_em_fundo(empresa_id, estado)
+    if pendentes:
+        _aplicar_adicoes(empresa_id, estado, *pendentes)
+    return estado
+
+
+def procurar_entrada(codigo, empresa):
+    """Entrada do índice do código DA EMPRESA (ou None), evitando a query quando possível"""
+    if not ATIVA or empresa is None:
+        return CodigoIndex.objects.filter(codigo=codigo, empresa=empresa).first()
+
+    _contar('consultas')
+    estado = _estado_empresa(empresa.id)
+    if estado is None:
+        _contar('sem_cache')
+        return CodigoIndex.objects.filter(codigo=codigo, empresa=empresa).first()
+
+    filtro = estado.filtro
+    if filtro is None or not estado.confiavel:
+        _contar('sem_filtro')
+        return CodigoIndex.objects.filter(codigo=codigo, empresa=empresa).first()
+    if codigo not in filtro:
+        _contar('negativas_bloom')
+        return None
+
+    with _lock:
+        guardada = _lru.get(codigo)
+        if guardada is not None and guardada[0] == estado.versao and guardada[1].empresa_id == empresa.id:
+            _lru.move_to_end(codigo)
+            _contadores['acertos_lru'] += 1
+            return guardada[1]
+
+    _contar('falhas_lru')
+    entrada = CodigoIndex.objects.filter(codigo=codigo, empresa=empresa).first()
+    if entrada is None:
+        _contar('falsos_positivos')
+        return None
+
+    with _lock:
+        _lru[codigo] = (estado.versao, entrada)
+        _lru.move_to_end(codigo)
+        while len(_lru) > TAMANHO_LRU:
+            _lru.popitem(last=False)
+    return entrada
@@ -0,0 +1,119 @@
+"""
+Formato dos códigos de senhas e de requisições de saldo.
+
+Código atual (12 caracteres): <tipo><corpo><tag>
+  tipo  - 'S' para senha, 'R' para requisição de saldo
+  corpo - 8 caracteres aleatórios (A-Z, 0-9)
+  tag   - 3 caracteres de um HMAC-SHA256 sobre tipo+corpo
+
+Código de senha em modo intervalo (14 caracteres): C<requisicao><indice><tag>
+  requisicao - id da requisição em base 36 (6 caracteres)
+  indice     - posição da senha dentro da requisição em base 36 (4 caracteres)
+  tag        - 3 caracteres de um HMAC-SHA256 sobre os anteriores
+  Estes códigos não são gravados: derivam da requisição (ver gerente/armazenamento.py).
+
+Como a tag depende de uma chave secreta, um código mal digitado ou forjado
+é rejeitado no scan sem ir à base de dados, e o prefixo indica logo em que
+tabela procurar. Os códigos antigos (10 caracteres, sem tag) continuam
+válidos e são procurados nas duas tabelas como antes.
+"""
+import hashlib
+import hmac
+import random
+import string
+
+from django.conf import settings
+
+ALFABETO = string.ascii_uppercase + string.digits
+
+TIPO_SENHA = 'S'
+TIPO_SALDO = 'R'
+TIPO_INTERVALO = 'C'
+TIPO_LEGADO = 'legado'
+
+TAMANHO_CORPO = 8
+TAMANHO_TAG = 3
+TAMANHO_CODIGO = 1 + TAMANHO_CORPO + TAMANHO_TAG
+TAMANHO_LEGADO = 10
+
+TAMANHO_REQUISICAO = 6
+TAMANHO_INDICE = 4
+TAMANHO_CODIGO_INTERVALO = 1 + TAMANHO_REQUISICAO + TAMANHO_INDICE + TAMANHO_TAG
+MAX_SENHAS_INTERVALO = len(ALFABETO) ** TAMANHO_INDICE
+
+
+def _chave():
+    """Chave do HMAC - mudar a chave invalida todos os códigos já emitidos"""
+    chave = getattr(settings, 'ENGEN_CODIGO_CHAVE', None) or settings.SECRET_KEY
+    return chave.encode('utf-8')
+
+
+def codificar_base36(numero, tamanho):
+    """Representa `numero` com exatamente `tamanho` caracteres do ALFABETO"""
+    caracteres = []
+    for _ in range(tamanho):
+        numero, resto = divmod(numero, len(ALFABETO))
+        caracteres.append(ALFABETO[resto])
+    return ''.join(reversed(caracteres))
+
+
+def decodificar_base36(texto):
+    """Inverso de codificar_base36"""
+    numero = 0
+    for caracter in texto:
+        numero = numero * len(ALFABETO) + ALFABETO.index(caracter)
+    return numero
+
+
+def calcular_tag(conteudo, tamanho=TAMANHO_TAG):
+    """Tag de autenticação (HMAC truncado) para o conteúdo do código"""
+    digest = hmac.new(_chave(), conteudo.encode('utf-8'), hashlib.sha256).digest()
+    return codificar_base36(int.from_bytes(digest[:8], 'big'), tamanho)
+
+
+def gerar_codigo(tipo):
+    """Gera um código novo (com prefixo e tag) do tipo indicado"""
+    conteudo = tipo + ''.join(random.choices(ALFABETO, k=TAMANHO_CORPO))
+    return conteudo + calcular_tag(conteudo)
+
+
+def codigo_intervalo(requisicao_id, indice):
+    """Código da senha `indice` de uma requisição em modo intervalo"""
+    conteudo = (
+        TIPO_INTERVALO
+        + codificar_base36(requisicao_id, TAMANHO_REQUISICAO)
+        + codificar_base36(indice, TAMANHO_INDICE)
+    )
+    return conteudo + calcular_tag(conteudo)
+
+
+def decodificar_intervalo(codigo):
+    """Retorna (requisicao_id, indice) de um código em modo intervalo já validado"""
+    inicio_indice = 1 + TAMANHO_REQUISICAO
+    requisicao_id = decodificar_base36(codigo[1:inicio_indice])
+    indice = decodificar_base36(codigo[inicio_indice:inicio_indice + TAMANHO_INDICE])
+    return requisicao_id, indice
+
+
+def classificar_codigo(codigo):
+    """
+    Valida o código só com CPU.
+    Retorna TIPO_SENHA, TIPO_SALDO, TIPO_INTERVALO, TIPO_LEGADO (procurar nas
+    duas tabelas) ou None se o código for inválido.
+    """
+    if not codigo or any(c not in ALFABETO for c in codigo):
+        return None
+
+    if len(codigo) == TAMANHO_LEGADO:
+        return TIPO_LEGADO
+
+    valido = (
+        (len(codigo) == TAMANHO_CODIGO and codigo[0] in (TIPO_SENHA, TIPO_SALDO)) or
+        (len(codigo) == TAMANHO_CODIGO_INTERVALO and codigo[0] == TIPO_INTERVALO)
+    )
+    if valido:
+        conteudo, tag = codigo[:-TAMANHO_TAG], codigo[-TAMANHO_TAG:]
+        if hmac.compare_digest(tag, calcular_tag(conteudo)):
+            return codigo[0]
+
+    return None
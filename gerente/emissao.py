@@ -0,0 +1,233 @@
+"""
+Motor de emissão de senhas em lote.
+
+Em vez de gerar, verificar e gravar uma senha de cada vez, os códigos são
+gerados por lotes, a colisão com o índice único de `codigo` é verificada com
+uma única query por lote e as senhas são inseridas com `bulk_create`.
+
+Sempre que possível os códigos são retirados em blocos do pool de códigos
+pré-gerados (`CodigoReservado`), reabastecido em segundo plano pelo comando
+`reabastecer_codigos`. Se o pool estiver vazio os códigos são gerados na hora.
+
+Requisições muito grandes são emitidas em segundo plano: a view cria uma
+`TarefaEmissao` e o comando `processar_emissoes` grava as senhas lote a lote.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import cache_codigos
+from .armazenamento import reservar_intervalo
+from .models import CodigoIndex, CodigoReservado, RequisicaoSenhas, Senha, TarefaEmissao
+
+logger = logging.getLogger(__name__)
+
+# Número de senhas geradas/gravadas por lote
+TAMANHO_LOTE = 1000
+
+# Tentativas por lote antes de desistir (colisões com outra emissão em paralelo)
+MAX_TENTATIVAS_LOTE = 5
+
+# Limites do pool de códigos (ver comando reabastecer_codigos)
+POOL_MINIMO = getattr(settings, 'ENGEN_POOL_CODIGOS_MINIMO', 20000)
+POOL_ALVO = getattr(settings, 'ENGEN_POOL_CODIGOS_ALVO', 100000)
+
+# A partir desta quantidade as senhas são emitidas em segundo plano
+EMISSAO_ASSINCRONA_A_PARTIR_DE = getattr(settings, 'ENGEN_EMISSAO_ASSINCRONA_A_PARTIR_DE', 50000)
+# Sem o worker processar_emissoes as tarefas ficariam pendentes: emite-se no pedido
+EMISSAO_WORKER = getattr(settings, 'ENGEN_EMISSAO_WORKER', True)
+
+# Uma tarefa em curso sem sinal há mais tempo do que isto é considerada abandonada
+TAREFA_SEM_SINAL = timedelta(minutes=5)
+
+
+def gerar_codigos_unicos(quantidade):
+    """Gera `quantidade` códigos distintos que não existem nas senhas nem no pool"""
+    codigos = set()
+    while len(codigos) < quantidade:
+        em_falta = quantidade - len(codigos)
+        candidatos = {Senha.gerar_codigo() for _ in range(em_falta)} - codigos
+
+        # Uma query por tabela e por lote para descobrir colisões
+        existentes = set(
+            Senha.objects.filter(codigo__in=candidatos).values_list('codigo', flat=True)
+        )
+        existentes.update(
+            CodigoReservado.objects.filter(codigo__in=candidatos).values_list('codigo', flat=True)
+        )
+        codigos |= candidatos - existentes
+    return list(codigos)
+
+
+def reservar_codigos(quantidade, formato=Senha.FORMATO_CODIGO):
+    """
+    Retira do pool um bloco contíguo de até `quantidade` códigos.
+    Deve correr dentro de uma transação: os códigos ficam bloqueados
+    (SKIP LOCKED) para outras emissões até ao commit.
+    """
+    if connection.vendor == 'postgresql':
+        tabela = CodigoReservado._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                DELETE FROM {tabela} WHERE id IN (
+                    SELECT id FROM {tabela}
+                    WHERE formato = %s
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING codigo
+                """,
+                [formato, quantidade],
+            )
+            return [linha[0] for linha in cursor.fetchall()]
+
+    # Outras bases de dados (SQLite serializa as escritas)
+    reservados = list(
+        CodigoReservado.objects.select_for_update(skip_locked=True)
+        .filter(formato=formato)
+        .order_by('id')
+        .values_list('id', 'codigo')[:quantidade]
+    )
+    CodigoReservado.objects.filter(id__in=[id_ for id_, _ in reservados]).delete()
+    return [codigo for _, codigo in reservados]
+
+
+def reabastecer_pool(alvo=POOL_ALVO, formato=Senha.FORMATO_CODIGO, tamanho_lote=TAMANHO_LOTE):
+    """Gera códigos novos até o pool ter `alvo` códigos disponíveis. Retorna quantos foram criados."""
+    inicial = disponiveis = CodigoReservado.objects.filter(formato=formato).count()
+    while disponiveis < alvo:
+        lote = min(tamanho_lote, alvo - disponiveis)
+        # ignore_conflicts: outro processo pode ter reservado o mesmo código entretanto
+        CodigoReservado.objects.bulk_create(
+            [CodigoReservado(formato=formato, codigo=codigo) for codigo in gerar_codigos_unicos(lote)],
+            ignore_conflicts=True,
+        )
+        disponiveis = CodigoReservado.objects.filter(formato=formato).count()
+    return max(disponiveis - inicial, 0)
+
+
+def _gravar_lote(requisicao, quantidade):
+    """Grava um lote de senhas, repetindo com novos códigos se houver colisão"""
+    for tentativa in range(MAX_TENTATIVAS_LOTE):
+        codigos = reservar_codigos(quantidade)
+        if len(codigos) < quantidade:
+            logger.warning(
+                'Pool de códigos sem códigos suficientes (%s de %s); a gerar na hora. '
+                'Execute "manage.py reabastecer_codigos".', len(codigos), quantidade
+            )
+            codigos += gerar_codigos_unicos(quantidade - len(codigos))
+        senhas = [
+            Senha(
+                empresa=requisicao.empresa,
+                codigo=codigo,
+                requisicao=requisicao,
+                cliente=requisicao.cliente,
+            )
+            for codigo in codigos
+        ]
+        try:
+            # Savepoint: uma colisão só desfaz este lote, não a transação inteira
+            with transaction.atomic():
+                Senha.objects.bulk_create(senhas)
+                CodigoIndex.indexar_senhas(senhas)
+            cache_codigos.adicionar(requisicao.empresa_id, codigos)
+            return len(senhas)
+        except IntegrityError:
+            # Outra emissão gravou o mesmo código entre a verificação e o insert
+            continue
+    raise IntegrityError('Não foi possível gerar códigos únicos para o lote de senhas.')
+
+
+def emitir_senhas(requisicao, quantidade, tamanho_lote=TAMANHO_LOTE):
+    """
+    Cria `quantidade` senhas novas para a requisição.
+    Deve ser chamada dentro de transaction.atomic() pela view.
+    Retorna o número de senhas criadas.
+    """
+    if requisicao.em_intervalo:
+        # Modo intervalo: os códigos derivam da requisição, basta alargar o mapa de uso
+        reservar_intervalo(requisicao)
+        return quantidade
+
+    criadas = 0
+    while criadas < quantidade:
+        lote = min(tamanho_lote, quantidade - criadas)
+        criadas += _gravar_lote(requisicao, lote)
+    return criadas
+
+
+# ================================
+# EMISSÃO EM SEGUNDO PLANO
+# ================================
+
+def criar_tarefa_emissao(requisicao):
+    """Agenda a emissão das senhas da requisição para o worker (processar_emissoes)"""
+    return TarefaEmissao.objects.create(requisicao=requisicao, total=requisicao.senhas)
+
+
+def reservar_tarefa():
+    """
+    Reserva a próxima tarefa pendente (ou abandonada por um worker que morreu).
+    Retorna None se não houver trabalho.
+    """
+    limite_sinal = timezone.now() - TAREFA_SEM_SINAL
+    with transaction.atomic():
+        tarefa = (
+            TarefaEmissao.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(estado=TarefaEmissao.ESTADO_PENDENTE) |
+                Q(estado=TarefaEmissao.ESTADO_EM_CURSO, ultimo_sinal__lt=limite_sinal)
+            )
+            .order_by('id')
+            .first()
+        )
+        if tarefa is None:
+            return None
+
+        agora = timezone.now()
+        tarefa.estado = TarefaEmissao.ESTADO_EM_CURSO
+        tarefa.tentativas += 1
+        tarefa.data_inicio = tarefa.data_inicio or agora
+        tarefa.ultimo_sinal = agora
+        tarefa.save(update_fields=['estado', 'tentativas', 'data_inicio', 'ultimo_sinal'])
+    return tarefa
+
+
+def executar_tarefa(tarefa, tamanho_lote=TAMANHO_LOTE):
+    """
+    Emite as senhas em falta da tarefa, um lote por transação.
+    O progresso é calculado a partir das senhas que já existem na base de
+    dados, por isso uma tarefa interrompida pode ser retomada sem duplicar senhas.
+    """
+    try:
+        while True:
+            with transaction.atomic():
+                # Bloquear a tarefa: só um worker grava lotes de cada vez
+                tarefa = TarefaEmissao.objects.select_for_update().get(pk=tarefa.pk)
+                requisicao = RequisicaoSenhas.objects.select_related('empresa', 'cliente').get(pk=tarefa.requisicao_id)
+                existentes = requisicao.lista_senhas.count()
+                em_falta = tarefa.total - existentes
+
+                if em_falta > 0:
+                    existentes += _gravar_lote(requisicao, min(tamanho_lote, em_falta))
+
+                tarefa.criadas = min(existentes, tarefa.total)
+                tarefa.ultimo_sinal = timezone.now()
+                if existentes >= tarefa.total:
+                    tarefa.estado = TarefaEmissao.ESTADO_CONCLUIDA
+                    tarefa.data_fim = tarefa.ultimo_sinal
+                tarefa.save(update_fields=['criadas', 'ultimo_sinal', 'estado', 'data_fim'])
+
+            if tarefa.estado == TarefaEmissao.ESTADO_CONCLUIDA:
+                return tarefa
+
+    except Exception as e:
+        logger.exception('Erro na emissão da requisição #%s', tarefa.requisicao_id)
+        TarefaEmissao.objects.filter(pk=tarefa.pk).update(estado=TarefaEmissao.ESTADO_ERRO, erro=str(e))
+        raise
@@ -0,0 +1,220 @@
+"""
+Folha de senhas em PDF (A4, várias senhas por página) pronta a imprimir e cortar.
+
+Cada senha tem o QR code desenhado em vetores (um retângulo por sequência de
+módulos pretos), o código, o nome do cliente e o número da requisição.
+
+O canvas do reportlab guarda o documento inteiro em memória até ao save(),
+o que numa requisição de 20 000 senhas são dezenas de MB por pedido. Por isso
+o PDF é escrito aqui objeto a objeto e cada página é enviada assim que fica
+pronta: só os offsets dos objetos ficam em memória. Do reportlab usam-se o
+tamanho da página, as unidades e as métricas das fontes.
+"""
+import zlib
+
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm, mm
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+from . import qrcodes
+
+# Grelha por omissão: colunas x linhas de senhas por página
+COLUNAS, LINHAS = (int(n) for n in getattr(settings, 'ENGEN_PDF_GRELHA', '3x7').split('x'))
+MAX_COLUNAS = 6
+MAX_LINHAS = 12
+
+MARGEM = 1 * cm
+ESPACO = 0.25 * cm
+MARCA_CORTE = 4 * mm
+AFASTAMENTO_MARCA = 1 * mm
+
+# Fontes base do PDF (não precisam de ser embutidas)
+FONTES = {
+    'F1': 'Helvetica',
+    'F2': 'Helvetica-Bold',
+    'F3': 'Courier-Bold',
+}
+
+
+def _texto_pdf(texto):
+    """Texto em WinAnsi com os caracteres especiais das strings PDF escapados"""
+    dados = texto.encode('cp1252', 'replace')
+    return dados.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+def _ajustar_texto(texto, fonte, tamanho, largura):
+    """Corta o texto (com reticências) para caber na largura disponível"""
+    if stringWidth(texto, fonte, tamanho) <= largura:
+        return texto
+    while texto and stringWidth(texto + '…', fonte, tamanho) > largura:
+        texto = texto[:-1]
+    return texto + '…'
+
+
+def _numero(valor):
+    return f'{valor:.3f}'.rstrip('0').rstrip('.')
+
+
+class _EscritorPDF:
+    """Escreve um PDF sequencialmente; guarda só os offsets para a tabela xref"""
+
+    PAGINAS = 2  # número reservado para o objeto /Pages, escrito no fim
+
+    def __init__(self):
+        self.posicao = 0
+        self.offsets = {}
+        self.paginas = []
+        self.proximo = 3
+
+    def _emitir(self, dados):
+        self.posicao += len(dados)
+        return dados
+
+    def novo_numero(self):
+        numero = self.proximo
+        self.proximo += 1
+        return numero
+
+    def cabecalho(self):
+        return self._emitir(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def objeto(self, numero, corpo):
+        self.offsets[numero] = self.posicao
+        return self._emitir(b'%d 0 obj\n' % numero + corpo + b'\nendobj\n')
+
+    def stream(self, numero, conteudo):
+        comprimido = zlib.compress(conteudo)
+        corpo = b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(comprimido) + comprimido + b'\nendstream'
+        return self.objeto(numero, corpo)
+
+    def pagina(self, conteudo, fontes):
+        """Stream de conteúdo + objeto da página"""
+        numero_conteudo = self.novo_numero()
+        numero_pagina = self.novo_numero()
+        self.paginas.append(numero_pagina)
+        dados = self.stream(numero_conteudo, conteudo)
+        dados += self.objeto(numero_pagina, (
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] '
+            b'/Resources << /Font %s >> /Contents %d 0 R >>'
+        ) % (self.PAGINAS, _numero(A4[0]).encode(), _numero(A4[1]).encode(), fontes, numero_conteudo))
+        return dados
+
+    def fim(self, numero_catalogo):
+        """Objeto /Pages, tabela xref e trailer"""
+        kids = b' '.join(b'%d 0 R' % n for n in self.paginas)
+        dados = self.objeto(self.PAGINAS, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.paginas)))
+
+        inicio_xref = self.posicao
+        total = self.proximo
+        linhas = [b'xref\n0 %d\n' % total, b'0000000000 65535 f \n']
+        for numero in range(1, total):
+            linhas.append(b'%010d 00000 n \n' % self.offsets[numero])
+        linhas.append(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (total, numero_catalogo, inicio_xref))
+        return dados + self._emitir(b''.join(linhas))
+
+
+class FolhaSenhas:
+    """Geometria da grelha e desenho de cada senha"""
+
+    def __init__(self, requisicao, colunas=COLUNAS, linhas=LINHAS):
+        self.requisicao = requisicao
+        self.cliente = requisicao.cliente.nome if requisicao.cliente_id else ''
+        self.colunas = colunas
+        self.linhas = linhas
+        self.largura_celula = (A4[0] - 2 * MARGEM) / colunas
+        self.altura_celula = (A4[1] - 2 * MARGEM) / linhas
+        # Lado do QR code com a margem branca (BORDA módulos de cada lado), que
+        # encosta às linhas de corte e ao texto sem perder a zona de silêncio
+        self.lado_qr = min(self.altura_celula, self.largura_celula * 0.5)
+
+    @property
+    def por_pagina(self):
+        return self.colunas * self.linhas
+
+    def marcas_corte(self):
+        """Traços nas margens, alinhados com as linhas de corte da grelha"""
+        largura, altura = A4
+        comandos = [b'0.3 w 0 G']
+        for coluna in range(self.colunas + 1):
+            x = _numero(MARGEM + coluna * self.largura_celula).encode()
+            for y0 in (MARGEM - AFASTAMENTO_MARCA - MARCA_CORTE, altura - MARGEM + AFASTAMENTO_MARCA):
+                comandos.append(b'%s %s m %s %s l S' % (x, _numero(y0).encode(), x, _numero(y0 + MARCA_CORTE).encode()))
+        for linha in range(self.linhas + 1):
+            y = _numero(MARGEM + linha * self.altura_celula).encode()
+            for x0 in (MARGEM - AFASTAMENTO_MARCA - MARCA_CORTE, largura - MARGEM + AFASTAMENTO_MARCA):
+                comandos.append(b'%s %s m %s %s l S' % (_numero(x0).encode(), y, _numero(x0 + MARCA_CORTE).encode(), y))
+        return b'\n'.join(comandos)
+
+    def _texto(self, fonte, nome_fonte, tamanho, x, y, texto, largura):
+        texto = _ajustar_texto(texto, nome_fonte, tamanho, largura)
+        return b'BT /%s %s Tf %s %s Td (%s) Tj ET' % (
+            fonte.encode(), _numero(tamanho).encode(), _numero(x).encode(), _numero(y).encode(), _texto_pdf(texto),
+        )
+
+    def senha(self, posicao, codigo):
+        """Comandos PDF de uma senha na posição `posicao` da página"""
+        coluna = posicao % self.colunas
+        linha = posicao // self.colunas
+        x0 = MARGEM + coluna * self.largura_celula
+        y0 = A4[1] - MARGEM - (linha + 1) * self.altura_celula
+
+        # QR code: um retângulo por sequência de módulos pretos, preenchidos de uma vez
+        matriz = qrcodes.matriz_qr(codigo)
+        modulo = self.lado_qr / (len(matriz) + 2 * qrcodes.BORDA)
+        qx = x0 + qrcodes.BORDA * modulo
+        topo_qr = y0 + (self.altura_celula + self.lado_qr) / 2 - qrcodes.BORDA * modulo
+        comandos = [b'q 0 g']
+        for i, linha_qr in enumerate(matriz):
+            y = _numero(topo_qr - (i + 1) * modulo).encode()
+            for inicio, fim in qrcodes.sequencias_pretas(linha_qr):
+                comandos.append(b'%s %s %s %s re' % (
+                    _numero(qx + inicio * modulo).encode(), y,
+                    _numero((fim - inicio) * modulo).encode(), _numero(modulo).encode(),
+                ))
+        comandos.append(b'f Q')
+
+        # Texto à direita do QR code
+        tx = x0 + self.lado_qr
+        largura = x0 + self.largura_celula - ESPACO - tx
+        topo = y0 + self.altura_celula / 2
+        comandos.append(self._texto('F1', 'Helvetica', 7, tx, topo + 12, f'Requisição #{self.requisicao.id}', largura))
+        comandos.append(self._texto('F2', 'Helvetica-Bold', 8, tx, topo + 1, self.cliente, largura))
+        # O código nunca é cortado: a letra diminui até caber (Courier: 0,6 em por carácter)
+        tamanho_codigo = min(9, int(largura / (0.6 * len(codigo)) * 10) / 10)
+        comandos.append(self._texto('F3', 'Courier-Bold', tamanho_codigo, tx, topo - 12, codigo, largura))
+        return b'\n'.join(comandos)
+
+
+def gerar_pdf(requisicao, codigos, colunas=COLUNAS, linhas=LINHAS):
+    """
+    Gerador com os bytes do PDF, página a página, para um StreamingHttpResponse.
+    `codigos` pode ser um iterador (não é preciso ter todas as senhas em memória).
+    """
+    folha = FolhaSenhas(requisicao, colunas, linhas)
+    escritor = _EscritorPDF()
+
+    yield escritor.cabecalho()
+    numero_catalogo = 1
+    yield escritor.objeto(numero_catalogo, b'<< /Type /Catalog /Pages %d 0 R >>' % escritor.PAGINAS)
+
+    referencias_fontes = []
+    for nome, fonte_base in FONTES.items():
+        numero = escritor.novo_numero()
+        yield escritor.objeto(numero, (
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % fonte_base.encode()
+        ))
+        referencias_fontes.append(b'/%s %d 0 R' % (nome.encode(), numero))
+    fontes = b'<< ' + b' '.join(referencias_fontes) + b' >>'
+
+    marcas = folha.marcas_corte()
+    comandos = []
+    for codigo in codigos:
+        comandos.append(folha.senha(len(comandos), codigo))
+        if len(comandos) == folha.por_pagina:
+            yield escritor.pagina(marcas + b'\n' + b'\n'.join(comandos), fontes)
+            comandos = []
+    if comandos or not escritor.paginas:
+        yield escritor.pagina(marcas + b'\n' + b'\n'.join(comandos), fontes)
+
+    yield escritor.fim(numero_catalogo)
@@ -0,0 +1,176 @@
+"""
+Índice único de códigos (CodigoIndex): código -> tipo, id do objeto, empresa e estado.
+
+O scan resolve os códigos gravados com uma query pela chave primária do índice,
+em vez de tentar Senha, depois ResgateSenha e depois RequisicaoSaldo. O índice
+é mantido na emissão (gerente/emissao.py), no uso da senha (Senha.usar), na
+conversão para o modo intervalo (gerente/armazenamento.py) e ao gravar uma
+requisição de saldo (criação e desativação).
+
+Se um código existir em mais do que uma tabela (só possível com códigos
+antigos), o índice fica com a primeira na ordem senha, resgate, saldo - a
+mesma prioridade da procura antiga.
+
+    manage.py reconstruir_indice_codigos   - volta a gerar o índice inteiro
+    manage.py verificar_indice_codigos     - compara o índice com as tabelas
+"""
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from . import cache_codigos, codigos
+from .models import CodigoIndex, RequisicaoSaldo, ResgateSenha, Senha
+
+TAMANHO_LOTE = 5000
+
+
+def procurar(codigo, empresa):
+    """
+    (senha, requisicao_saldo) do código DA EMPRESA, no máximo um preenchido.
+    Requisições de saldo inativas não são devolvidas. A entrada do índice vem
+    da cache em memória quando possível (ver gerente/cache_codigos.py).
+    """
+    return objeto_da_entrada(cache_codigos.procurar_entrada(codigo, empresa))
+
+
+def objeto_da_entrada(entrada):
+    """(senha, requisicao_saldo) apontado pela entrada; o estado vem sempre da linha do objeto"""
+    if entrada is None:
+        return None, None
+
+    if entrada.tipo == CodigoIndex.TIPO_SALDO:
+        # A entrada pode vir do LRU: a desativação conta-se pela linha da requisição
+        requisicao = RequisicaoSaldo.objects.select_related('cliente').filter(pk=entrada.objeto_id, ativa=True).first()
+        return None, requisicao
+
+    if entrada.tipo == CodigoIndex.TIPO_RESGATE:
+        return ResgateSenha.objects.select_related('requisicao__cliente').filter(pk=entrada.objeto_id).first(), None
+    return Senha.objects.select_related('cliente', 'requisicao').filter(pk=entrada.objeto_id).first(), None
+
+
+def entradas_esperadas(tamanho_lote=TAMANHO_LOTE):
+    """Entradas do índice (não gravadas) calculadas a partir das tabelas, por ordem de prioridade"""
+    senhas = Senha.objects.order_by().values_list('id', 'codigo', 'empresa_id', 'usada')
+    for id_, codigo, empresa_id, usada in senhas.iterator(chunk_size=tamanho_lote):
+        yield CodigoIndex(
+            codigo=codigo, tipo=CodigoIndex.TIPO_SENHA, objeto_id=id_, empresa_id=empresa_id,
+            estado=CodigoIndex.ESTADO_USADA if usada else CodigoIndex.ESTADO_DISPONIVEL,
+        )
+
+    resgates = (
+        ResgateSenha.objects.order_by()
+        .values_list('id', 'codigo', 'requisicao__empresa_id')
+    )
+    for id_, codigo, empresa_id in resgates.iterator(chunk_size=tamanho_lote):
+        # Os resgates do modo intervalo têm o código derivado, que não é indexado
+        if codigos.classificar_codigo(codigo) == codigos.TIPO_INTERVALO:
+            continue
+        yield CodigoIndex(
+            codigo=codigo, tipo=CodigoIndex.TIPO_RESGATE, objeto_id=id_, empresa_id=empresa_id,
+            estado=CodigoIndex.ESTADO_USADA,
+        )
+
+    saldos = RequisicaoSaldo.objects.order_by().values_list('id', 'codigo', 'empresa_id', 'ativa')
+    for id_, codigo, empresa_id, ativa in saldos.iterator(chunk_size=tamanho_lote):
+        yield CodigoIndex(
+            codigo=codigo, tipo=CodigoIndex.TIPO_SALDO, objeto_id=id_, empresa_id=empresa_id,
+            estado=CodigoIndex.ESTADO_DISPONIVEL if ativa else CodigoIndex.ESTADO_INATIVA,
+        )
+
+
+def _em_lotes(entradas, tamanho_lote):
+    lote = []
+    for entrada in entradas:
+        lote.append(entrada)
+        if len(lote) == tamanho_lote:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def reconstruir(tamanho_lote=TAMANHO_LOTE):
+    """Apaga e volta a gerar o índice inteiro numa transação. Retorna o número de entradas."""
+    with transaction.atomic():
+        CodigoIndex.objects.all().delete()
+        for lote in _em_lotes(entradas_esperadas(tamanho_lote), tamanho_lote):
+            # ignore_conflicts: um código repetido fica com a primeira tabela (ver acima)
+            CodigoIndex.objects.bulk_create(lote, ignore_conflicts=True)
+        cache_codigos.invalidar_todas()
+        return CodigoIndex.objects.count()
+
+
+def _igual(entrada, esperada):
+    return (
+        entrada.objeto_id == esperada.objeto_id and
+        entrada.empresa_id == esperada.empresa_id and
+        entrada.estado == esperada.estado
+    )
+
+
+def _orfas():
+    """
+    Por tipo, as entradas cujo objeto já não existe (p. ex. apagado em cascata com
+    o cliente) ou já não tem aquele código
+    """
+    modelos = (
+        (CodigoIndex.TIPO_SENHA, Senha),
+        (CodigoIndex.TIPO_RESGATE, ResgateSenha),
+        (CodigoIndex.TIPO_SALDO, RequisicaoSaldo),
+    )
+    for tipo, modelo in modelos:
+        objeto = modelo.objects.filter(pk=OuterRef('objeto_id'), codigo=OuterRef('codigo'))
+        yield CodigoIndex.objects.filter(tipo=tipo).exclude(Exists(objeto))
+
+
+def _diferencas(tamanho_lote):
+    """
+    Por lotes de entradas esperadas, as listas (em_falta, divergentes), sem
+    ter mais do que um lote em memória
+    """
+    for lote in _em_lotes(entradas_esperadas(tamanho_lote), tamanho_lote):
+        atuais = CodigoIndex.objects.in_bulk([esperada.codigo for esperada in lote])
+        em_falta, divergentes = [], []
+        for esperada in lote:
+            entrada = atuais.get(esperada.codigo)
+            if entrada is None:
+                em_falta.append(esperada)
+            elif entrada.tipo == esperada.tipo and not _igual(entrada, esperada):
+                divergentes.append(esperada)
+            # Tipo diferente: código repetido noutra tabela, fica a de maior prioridade
+        yield em_falta, divergentes
+
+
+def verificar(tamanho_lote=TAMANHO_LOTE, exemplos=10):
+    """
+    Compara o índice com as tabelas, sem alterar nada e sem carregar as
+    diferenças todas. Retorna um dicionário com, para 'em_falta' e
+    'divergentes' (entradas esperadas) e 'orfas' (entradas do índice sem
+    objeto), o par (total, até `exemplos` entradas).
+    """
+    totais = {'em_falta': 0, 'divergentes': 0, 'orfas': 0}
+    amostras = {chave: [] for chave in totais}
+    for orfas in _orfas():
+        totais['orfas'] += orfas.count()
+        amostras['orfas'].extend(orfas.order_by('codigo')[:exemplos - len(amostras['orfas'])])
+    for diferencas in _diferencas(tamanho_lote):
+        for chave, entradas in zip(('em_falta', 'divergentes'), diferencas):
+            totais[chave] += len(entradas)
+            amostras[chave].extend(entradas[:exemplos - len(amostras[chave])])
+    return {chave: (totais[chave], amostras[chave]) for chave in totais}
+
+
+def corrigir(tamanho_lote=TAMANHO_LOTE):
+    """Corrige o índice lote a lote, numa transação. Retorna o número de entradas corrigidas."""
+    corrigidas = 0
+    with transaction.atomic():
+        # Primeiro as órfãs (um DELETE por tipo): uma órfã com o código de uma
+        # entrada esperada deixa-a em falta, e é criada a seguir
+        for orfas in _orfas():
+            corrigidas += orfas.delete()[0]
+        for em_falta, divergentes in _diferencas(tamanho_lote):
+            CodigoIndex.objects.bulk_create(em_falta, ignore_conflicts=True)
+            if divergentes:
+                CodigoIndex.objects.bulk_update(divergentes, ['objeto_id', 'empresa_id', 'estado'])
+            corrigidas += len(em_falta) + len(divergentes)
+        cache_codigos.invalidar_todas()
+    return corrigidas
@@ -0,0 +1,59 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from gerente import qrcodes
+from gerente.armazenamento import listar_senhas
+from gerente.models import RequisicaoSaldo, RequisicaoSenhas
+
+
+class Command(BaseCommand):
+    help = (
+        'Pré-gera na cache em disco os QR codes das requisições emitidas recentemente, '
+        'para que a primeira impressão da folha não tenha de os desenhar'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horas', type=float, default=24,
+                            help='Requisições criadas nas últimas N horas (por omissão 24)')
+        parser.add_argument('--requisicao', type=int, action='append',
+                            help='Aquecer só esta requisição de senhas (pode repetir)')
+        parser.add_argument('--formato', action='append',
+                            choices=[qrcodes.FORMATO_PNG, qrcodes.FORMATO_SVG],
+                            help='Formato a gerar (pode repetir; por omissão o das folhas, ENGEN_QR_FORMATO)')
+
+    def handle(self, *args, **options):
+        inicio = time.perf_counter()
+        formatos = options['formato'] or [qrcodes.FORMATO_PADRAO]
+
+        if options['requisicao']:
+            requisicoes = RequisicaoSenhas.objects.filter(id__in=options['requisicao'])
+            requisicoes_saldo = RequisicaoSaldo.objects.none()
+        else:
+            desde = timezone.now() - timedelta(hours=options['horas'])
+            requisicoes = RequisicaoSenhas.objects.filter(data_criacao__gte=desde, ativa=True)
+            requisicoes_saldo = RequisicaoSaldo.objects.filter(data_criacao__gte=desde, ativa=True)
+
+        total = 0
+        for requisicao in requisicoes.order_by('id'):
+            if requisicao.emissao_pendente:
+                self.stdout.write(f'Requisição #{requisicao.id}: emissão ainda em curso, ignorada.')
+                continue
+            codigos = [senha.codigo for senha in listar_senhas(requisicao, usada=False)]
+            for formato in formatos:
+                qrcodes.gerar_lote(codigos, formato=formato, paralelo=True)
+            total += len(codigos)
+            self.stdout.write(f'Requisição #{requisicao.id}: {len(codigos)} QR code(s)')
+
+        codigos_saldo = list(requisicoes_saldo.values_list('codigo', flat=True))
+        for formato in formatos:
+            qrcodes.gerar_lote(codigos_saldo, formato=formato, paralelo=True)
+        total += len(codigos_saldo)
+
+        estatisticas = qrcodes.estatisticas()
+        self.stdout.write(self.style.SUCCESS(
+            f'{total} QR code(s) em cache ({", ".join(formatos)}) em {time.perf_counter() - inicio:.1f}s '
+            f'({estatisticas["falhas"]} gerados, {estatisticas["disco"]} já estavam em disco).'
+        ))
@@ -0,0 +1,52 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from empresas.models import Empresa
+from gerente.emissao import emitir_senhas
+from gerente.models import Cliente, RequisicaoSenhas
+
+
+class _Rollback(Exception):
+    """Usada para desfazer os dados temporários do benchmark"""
+
+
+class Command(BaseCommand):
+    help = 'Mede o tempo de emissão de senhas em lote (os dados criados são descartados no fim)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--senhas', type=int, default=10000, help='Quantidade de senhas a emitir')
+        parser.add_argument('--repeticoes', type=int, default=3, help='Número de execuções')
+
+    def handle(self, *args, **options):
+        quantidade = options['senhas']
+        self.stdout.write(f'Base de dados: {connection.vendor}')
+
+        tempos = []
+        for _ in range(options['repeticoes']):
+            try:
+                with transaction.atomic():
+                    requisicao = self._criar_requisicao(quantidade)
+                    inicio = time.perf_counter()
+                    emitir_senhas(requisicao, quantidade)
+                    tempos.append(time.perf_counter() - inicio)
+                    raise _Rollback
+            except _Rollback:
+                pass
+
+        for i, tempo in enumerate(tempos, 1):
+            self.stdout.write(f'Execução {i}: {quantidade} senhas em {tempo:.3f}s ({quantidade / tempo:.0f} senhas/s)')
+        self.stdout.write(self.style.SUCCESS(f'Melhor tempo: {min(tempos):.3f}s'))
+
+    def _criar_requisicao(self, quantidade):
+        gerente = User.objects.create_user(username='benchmark_emissao')
+        empresa = Empresa.objects.create(nome='Benchmark', gerente=gerente)
+        cliente = Cliente.objects.create(empresa=empresa, nome='Cliente Benchmark')
+        return RequisicaoSenhas.objects.create(
+            empresa=empresa,
+            cliente=cliente,
+            valor=quantidade,
+            senhas=quantidade,
+        )
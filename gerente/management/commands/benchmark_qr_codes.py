@@ -0,0 +1,61 @@
+import base64
+import gzip
+import time
+
+from django.core.management.base import BaseCommand
+
+from gerente import codigos, qrcodes
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara a geração de QR codes em série e no pool de processos, e o PNG com o SVG '
+        '(tempo e peso no HTML), sem usar a cache'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quantidades', type=int, nargs='+', default=[100, 1000, 10000],
+                            help='Número de QR codes de cada medição')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Processos no pool: {qrcodes.PROCESSOS}')
+
+        # Arrancar o pool fora das medições (só acontece uma vez por processo)
+        inicio = time.perf_counter()
+        qrcodes.desenhar_paralelo([codigos.gerar_codigo(codigos.TIPO_SENHA)] * qrcodes.PROCESSOS)
+        self.stdout.write(f'Arranque do pool: {time.perf_counter() - inicio:.3f}s')
+
+        for quantidade in options['quantidades']:
+            textos = [codigos.gerar_codigo(codigos.TIPO_SENHA) for _ in range(quantidade)]
+
+            inicio = time.perf_counter()
+            serie = [qrcodes.desenhar_png(texto) for texto in textos]
+            tempo_serie = time.perf_counter() - inicio
+
+            inicio = time.perf_counter()
+            paralelo = qrcodes.desenhar_paralelo(textos)
+            tempo_paralelo = time.perf_counter() - inicio
+
+            inicio = time.perf_counter()
+            svgs = [qrcodes.desenhar_svg(texto) for texto in textos]
+            tempo_svg = time.perf_counter() - inicio
+
+            if serie != paralelo:
+                self.stderr.write(self.style.ERROR(f'{quantidade}: resultados diferentes entre série e pool!'))
+
+            self.stdout.write(
+                f'{quantidade:>6} QR codes: PNG série {tempo_serie:.3f}s ({quantidade / tempo_serie:.0f}/s), '
+                f'PNG pool {tempo_paralelo:.3f}s (ganho x{tempo_serie / tempo_paralelo:.2f}), '
+                f'SVG série {tempo_svg:.3f}s ({quantidade / tempo_svg:.0f}/s)'
+            )
+
+            # Peso das imagens na página, tal como são escritas no template
+            html_png = ''.join(
+                f'<img src="data:image/png;base64,{base64.b64encode(png).decode()}">' for png in serie
+            ).encode()
+            html_svg = b''.join(svgs)
+            self.stdout.write(
+                f'{"":>6}  peso no HTML: PNG {len(html_png) / 1024:.0f} KiB '
+                f'({len(gzip.compress(html_png)) / 1024:.0f} KiB gzip), '
+                f'SVG {len(html_svg) / 1024:.0f} KiB ({len(gzip.compress(html_svg)) / 1024:.0f} KiB gzip)'
+            )
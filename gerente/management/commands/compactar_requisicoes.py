@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from gerente.armazenamento import converter_requisicao, pode_converter
+from gerente.models import RequisicaoSenhas
+
+
+class Command(BaseCommand):
+    help = (
+        'Converte requisições de senhas fechadas (todas as senhas usadas e fechadas) '
+        'para o armazenamento compacto em modo intervalo'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--empresa', type=int, help='Converter só as requisições desta empresa (id)')
+        parser.add_argument('--limite', type=int, help='Número máximo de requisições a converter')
+        parser.add_argument('--simular', action='store_true', help='Só lista as requisições que seriam convertidas')
+
+    def handle(self, *args, **options):
+        requisicoes = RequisicaoSenhas.objects.filter(
+            modo_armazenamento=RequisicaoSenhas.MODO_LINHAS,
+            fecho__isnull=False,
+        ).order_by('id')
+        if options['empresa']:
+            requisicoes = requisicoes.filter(empresa_id=options['empresa'])
+
+        convertidas = 0
+        total_senhas = 0
+        for requisicao in requisicoes.iterator():
+            if options['limite'] and convertidas >= options['limite']:
+                break
+            if not pode_converter(requisicao):
+                continue
+
+            if options['simular']:
+                self.stdout.write(f'Requisição #{requisicao.id}: {requisicao.senhas} senhas')
+            else:
+                total_senhas += converter_requisicao(requisicao)
+            convertidas += 1
+
+        if options['simular']:
+            self.stdout.write(f'{convertidas} requisição(ões) podem ser convertidas.')
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'{convertidas} requisição(ões) convertidas; {total_senhas} linhas de senhas removidas.'
+            ))
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gerente.emissao import executar_tarefa, reservar_tarefa
+from gerente.models import TarefaEmissao
+
+
+class Command(BaseCommand):
+    help = 'Worker que emite em segundo plano as senhas das requisições grandes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uma-vez', action='store_true',
+                            help='Processa as tarefas pendentes e termina')
+        parser.add_argument('--intervalo', type=float, default=2,
+                            help='Segundos de espera quando não há tarefas')
+        parser.add_argument('--repetir-erros', action='store_true',
+                            help='Volta a colocar como pendentes as tarefas que falharam')
+
+    def handle(self, *args, **options):
+        if options['repetir_erros']:
+            repetidas = TarefaEmissao.objects.filter(estado=TarefaEmissao.ESTADO_ERRO).update(
+                estado=TarefaEmissao.ESTADO_PENDENTE, erro=''
+            )
+            self.stdout.write(f'{repetidas} tarefa(s) com erro voltaram a ficar pendentes.')
+
+        while True:
+            tarefa = reservar_tarefa()
+            if tarefa is None:
+                if options['uma_vez']:
+                    break
+                time.sleep(options['intervalo'])
+                continue
+
+            self.stdout.write(f'A emitir senhas da requisição #{tarefa.requisicao_id} ({tarefa.total} senhas)...')
+            inicio = time.perf_counter()
+            try:
+                executar_tarefa(tarefa)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'Erro na requisição #{tarefa.requisicao_id}: {e}'))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'Requisição #{tarefa.requisicao_id} concluída em {time.perf_counter() - inicio:.1f}s'
+            ))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gerente.emissao import POOL_ALVO, POOL_MINIMO, reabastecer_pool
+from gerente.models import CodigoReservado, Senha
+
+
+class Command(BaseCommand):
+    help = 'Reabastece o pool de códigos pré-gerados quando fica abaixo do mínimo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minimo', type=int, default=POOL_MINIMO,
+                            help='Só reabastece se o pool tiver menos códigos do que este valor')
+        parser.add_argument('--alvo', type=int, default=POOL_ALVO,
+                            help='Número de códigos disponíveis após reabastecer')
+        parser.add_argument('--continuo', action='store_true',
+                            help='Fica a correr e verifica o pool periodicamente')
+        parser.add_argument('--intervalo', type=int, default=60,
+                            help='Segundos entre verificações no modo contínuo')
+
+    def handle(self, *args, **options):
+        while True:
+            self.verificar_pool(options['minimo'], options['alvo'])
+            if not options['continuo']:
+                break
+            time.sleep(options['intervalo'])
+
+    def verificar_pool(self, minimo, alvo):
+        disponiveis = CodigoReservado.objects.filter(formato=Senha.FORMATO_CODIGO).count()
+        if disponiveis >= minimo:
+            self.stdout.write(f'Pool com {disponiveis} códigos (mínimo {minimo}); nada a fazer.')
+            return
+
+        inicio = time.perf_counter()
+        criados = reabastecer_pool(alvo)
+        self.stdout.write(self.style.SUCCESS(
+            f'Pool reabastecido: {criados} códigos novos em {time.perf_counter() - inicio:.1f}s '
+            f'({disponiveis + criados} disponíveis).'
+        ))
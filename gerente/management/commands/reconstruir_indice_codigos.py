@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gerente import indice_codigos
+
+
+class Command(BaseCommand):
+    help = 'Apaga e volta a gerar o índice de códigos (CodigoIndex) a partir das senhas e requisições de saldo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=indice_codigos.TAMANHO_LOTE,
+                            help='Entradas lidas e gravadas por lote')
+
+    def handle(self, *args, **options):
+        inicio = time.perf_counter()
+        total = indice_codigos.reconstruir(options['lote'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Índice reconstruído: {total} código(s) em {time.perf_counter() - inicio:.1f}s.'
+        ))
@@ -0,0 +1,108 @@
+import random
+import threading
+import time
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, close_old_connections, connection, transaction
+
+from empresas.models import Empresa
+from gerente.emissao import emitir_senhas
+from gerente.models import Cliente, RequisicaoSenhas, Senha
+
+UTILIZADOR = 'teste_concorrencia_resgate'
+
+
+class Command(BaseCommand):
+    help = (
+        'Várias threads (cada uma com a sua ligação à base de dados) tentam resgatar as mesmas '
+        'senhas ao mesmo tempo; cada senha tem de ser resgatada exatamente uma vez. '
+        'Os dados criados são apagados no fim.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--senhas', type=int, default=50, help='Senhas da requisição de teste')
+        parser.add_argument('--threads', type=int, default=8, help='Threads a resgatar em paralelo')
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username=UTILIZADOR).exists():
+            raise CommandError(f'O utilizador "{UTILIZADOR}" já existe (teste anterior interrompido?); apague-o primeiro.')
+
+        self.stdout.write(f'Base de dados: {connection.vendor}')
+        gerente = User.objects.create_user(username=UTILIZADOR)
+        try:
+            requisicao = self._criar_requisicao(gerente, options['senhas'])
+            self._testar(requisicao, options['threads'])
+        finally:
+            # Apaga em cascata a empresa, o cliente, a requisição e as senhas
+            gerente.delete()
+
+    def _criar_requisicao(self, gerente, quantidade):
+        empresa = Empresa.objects.create(nome='Teste de concorrência', gerente=gerente)
+        cliente = Cliente.objects.create(empresa=empresa, nome='Cliente de teste')
+        requisicao = RequisicaoSenhas.objects.create(empresa=empresa, cliente=cliente, valor=quantidade, senhas=quantidade)
+        with transaction.atomic():
+            emitir_senhas(requisicao, quantidade)
+        return requisicao
+
+    def _testar(self, requisicao, numero_threads):
+        ids = list(requisicao.lista_senhas.values_list('id', flat=True))
+        sucessos = Counter()
+        erros = Counter()
+        lock = threading.Lock()
+        barreira = threading.Barrier(numero_threads)
+
+        def trabalhar():
+            try:
+                # Cada thread lê as senhas ainda por usar, como um pedido que leu o código antes dos outros
+                senhas = list(Senha.objects.filter(id__in=ids).select_related('requisicao'))
+                random.shuffle(senhas)
+                barreira.wait()
+                for senha in senhas:
+                    try:
+                        senha.usar(None, 'gasolina')
+                    except ValueError:
+                        continue
+                    except OperationalError as e:
+                        # SQLite: base de dados bloqueada por outra escrita
+                        with lock:
+                            erros[str(e)] += 1
+                        continue
+                    with lock:
+                        sucessos[senha.id] += 1
+            finally:
+                close_old_connections()
+                connection.close()
+
+        inicio = time.perf_counter()
+        threads = [threading.Thread(target=trabalhar) for _ in range(numero_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duracao = time.perf_counter() - inicio
+
+        duplicadas = [senha_id for senha_id, total in sucessos.items() if total > 1]
+        usadas = Senha.objects.filter(id__in=ids, usada=True).count()
+        requisicao.refresh_from_db()
+
+        self.stdout.write(
+            f'{numero_threads} threads, {len(ids)} senhas em {duracao:.2f}s: '
+            f'{sum(sucessos.values())} resgates, {usadas} senhas usadas'
+        )
+        for erro, total in erros.items():
+            self.stdout.write(self.style.WARNING(f'  {total}x {erro}'))
+
+        problemas = []
+        if duplicadas:
+            problemas.append(f'{len(duplicadas)} senha(s) resgatadas mais do que uma vez')
+        if usadas != sum(sucessos.values()):
+            problemas.append('o número de senhas usadas não coincide com os resgates')
+        if requisicao.senhas_usadas != usadas:
+            problemas.append(f'o contador da requisição ({requisicao.senhas_usadas}) não é o número de senhas usadas')
+        if usadas == len(ids) and requisicao.data_conclusao is None:
+            problemas.append('a requisição não foi concluída')
+        if problemas:
+            raise CommandError('; '.join(problemas))
+        self.stdout.write(self.style.SUCCESS('Cada senha foi resgatada no máximo uma vez.'))
@@ -0,0 +1,138 @@
+import statistics
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, close_old_connections, connection
+from django.db.models import Sum
+
+from empresas.models import Empresa
+from gerente import saldos
+from gerente.models import Cliente, Movimento, RequisicaoSaldo
+
+UTILIZADOR = 'teste_debitos_saldo'
+
+
+class Command(BaseCommand):
+    help = (
+        'Várias threads (cada uma com a sua ligação à base de dados) debitam o mesmo saldo ao mesmo '
+        'tempo; o saldo nunca pode ficar negativo. Mede depois a latência de um débito com vários '
+        'tamanhos de histórico de movimentos. Os dados criados são apagados no fim.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Threads a debitar em paralelo')
+        parser.add_argument('--debitos', type=int, default=25, help='Débitos tentados por cada thread')
+        parser.add_argument('--valor', type=Decimal, default=Decimal('10'), help='Valor de cada débito (MT)')
+        parser.add_argument(
+            '--historico', default='0,1000,10000',
+            help='Movimentos anteriores para a medição da latência, separados por vírgulas',
+        )
+        parser.add_argument('--repeticoes', type=int, default=50, help='Débitos medidos por tamanho de histórico')
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username=UTILIZADOR).exists():
+            raise CommandError(f'O utilizador "{UTILIZADOR}" já existe (teste anterior interrompido?); apague-o primeiro.')
+        try:
+            historicos = [int(valor) for valor in options['historico'].split(',') if valor.strip()]
+        except ValueError:
+            raise CommandError('--historico: números separados por vírgulas')
+
+        self.stdout.write(f'Base de dados: {connection.vendor}')
+        gerente = User.objects.create_user(username=UTILIZADOR)
+        try:
+            empresa = Empresa.objects.create(nome='Teste de débitos', gerente=gerente)
+            cliente = Cliente.objects.create(empresa=empresa, nome='Cliente de teste')
+            self._testar_concorrencia(empresa, cliente, options['threads'], options['debitos'], options['valor'])
+            self._medir_latencia(empresa, cliente, historicos, options['repeticoes'])
+        finally:
+            # Apaga em cascata a empresa, o cliente, as requisições e os movimentos
+            gerente.delete()
+
+    def _testar_concorrencia(self, empresa, cliente, numero_threads, debitos, valor):
+        # Saldo para metade dos débitos tentados: metade tem de ser recusada
+        tentativas = numero_threads * debitos
+        requisicao = RequisicaoSaldo.objects.create(
+            empresa=empresa, cliente=cliente, valor_total=valor * (tentativas // 2),
+        )
+        resultados = Counter()
+        erros = Counter()
+        lock = threading.Lock()
+        barreira = threading.Barrier(numero_threads)
+
+        def trabalhar():
+            try:
+                barreira.wait()
+                for _ in range(debitos):
+                    try:
+                        saldos.debitar(requisicao, valor, 'gasolina', descricao='Teste de concorrência')
+                        estado = 'debitado'
+                    except saldos.SaldoInsuficiente:
+                        estado = 'recusado'
+                    except OperationalError as e:
+                        # SQLite: base de dados bloqueada por outra escrita
+                        with lock:
+                            erros[str(e)] += 1
+                        continue
+                    with lock:
+                        resultados[estado] += 1
+            finally:
+                close_old_connections()
+                connection.close()
+
+        inicio = time.perf_counter()
+        threads = [threading.Thread(target=trabalhar) for _ in range(numero_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duracao = time.perf_counter() - inicio
+
+        debitado = requisicao.movimentos.aggregate(total=Sum('valor'))['total'] or 0
+        requisicao.refresh_from_db()
+        restante = requisicao.saldo_restante
+        self.stdout.write(
+            f'{numero_threads} threads, {tentativas} débitos de {valor} MT em {duracao:.2f}s: '
+            f'{resultados["debitado"]} debitados, {resultados["recusado"]} recusados, saldo final {restante} MT'
+        )
+        for erro, total in erros.items():
+            self.stdout.write(self.style.WARNING(f'  {total}x {erro}'))
+
+        problemas = []
+        if restante < 0:
+            problemas.append(f'o saldo ficou negativo ({restante} MT)')
+        if debitado != valor * resultados['debitado']:
+            problemas.append('o total dos movimentos não coincide com os débitos aceites')
+        if requisicao.total_debitado != debitado:
+            problemas.append(f'o total guardado ({requisicao.total_debitado} MT) não é a soma dos movimentos')
+        if problemas:
+            raise CommandError('; '.join(problemas))
+        self.stdout.write(self.style.SUCCESS('O saldo nunca foi ultrapassado.'))
+
+    def _medir_latencia(self, empresa, cliente, historicos, repeticoes):
+        self.stdout.write(f'Latência de um débito ({repeticoes} débitos por tamanho de histórico):')
+        for historico in historicos:
+            requisicao = RequisicaoSaldo.objects.create(
+                empresa=empresa, cliente=cliente, valor_total=historico + repeticoes + 1,
+            )
+            Movimento.objects.bulk_create(
+                [Movimento(requisicao_saldo=requisicao, valor=1, descricao='Histórico') for _ in range(historico)],
+                batch_size=1000,
+            )
+            # bulk_create não acerta o total debitado
+            saldos.recalcular(RequisicaoSaldo.objects.filter(pk=requisicao.pk))
+
+            tempos = []
+            for _ in range(repeticoes):
+                inicio = time.perf_counter()
+                saldos.debitar(requisicao, Decimal('1'), 'diesel', descricao='Teste de latência')
+                tempos.append((time.perf_counter() - inicio) * 1000)
+
+            tempos.sort()
+            p95 = tempos[max(0, int(len(tempos) * 0.95) - 1)]
+            self.stdout.write(
+                f'  {historico:>8} movimentos: mediana {statistics.median(tempos):.2f} ms, p95 {p95:.2f} ms'
+            )
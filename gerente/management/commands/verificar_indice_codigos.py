@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from gerente import indice_codigos
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara o índice de códigos (CodigoIndex) com as senhas e requisições de saldo: '
+        'entradas em falta, divergentes (objeto, empresa ou estado) e órfãs'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corrigir', action='store_true', help='Corrigir as diferenças encontradas')
+        parser.add_argument('--exemplos', type=int, default=10, help='Entradas a mostrar de cada problema')
+
+    def handle(self, *args, **options):
+        resultado = indice_codigos.verificar(exemplos=options['exemplos'])
+        problemas = (
+            ('em_falta', 'Em falta no índice'),
+            ('divergentes', 'Divergentes'),
+            ('orfas', 'Órfãs (o objeto já não existe ou tem outro código)'),
+        )
+        total = 0
+        for chave, titulo in problemas:
+            quantas, exemplos = resultado[chave]
+            total += quantas
+            self.stdout.write(f'{titulo}: {quantas}')
+            for entrada in exemplos:
+                self.stdout.write(f'  {entrada}')
+
+        if not total:
+            self.stdout.write(self.style.SUCCESS('O índice está consistente.'))
+        elif options['corrigir']:
+            corrigidas = indice_codigos.corrigir()
+            self.stdout.write(self.style.SUCCESS(f'{corrigidas} entrada(s) corrigidas.'))
+        else:
+            self.stdout.write(self.style.WARNING('Use --corrigir para corrigir, ou reconstruir_indice_codigos.'))
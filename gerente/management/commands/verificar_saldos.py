@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from gerente import saldos
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara o total debitado guardado em cada requisição de saldo com a soma dos seus '
+        'movimentos e mostra as diferenças'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corrigir', action='store_true', help='Repor os totais a partir dos movimentos')
+        parser.add_argument('--exemplos', type=int, default=10, help='Requisições a mostrar')
+
+    def handle(self, *args, **options):
+        divergentes = list(
+            saldos.divergencias().values_list('pk', 'codigo', 'total_debitado', 'somado')[:options['exemplos']]
+        )
+        total = saldos.divergencias().count() if divergentes else 0
+        self.stdout.write(f'Requisições com o total divergente: {total}')
+        for pk, codigo, guardado, somado in divergentes:
+            self.stdout.write(f'  #{pk} {codigo}: guardado {guardado} MT, movimentos {somado} MT ({somado - guardado:+} MT)')
+
+        if not total:
+            self.stdout.write(self.style.SUCCESS('Os saldos estão consistentes.'))
+        elif options['corrigir']:
+            corrigidas = saldos.recalcular()
+            self.stdout.write(self.style.SUCCESS(f'{corrigidas} requisição(ões) corrigidas.'))
+        else:
+            self.stdout.write(self.style.WARNING('Use --corrigir para repor os totais.'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from gerente import resgates
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara o contador de senhas usadas de cada requisição com as senhas usadas '
+        '(tabela Senha no modo linhas, mapa de bits no modo intervalo) e mostra as diferenças'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corrigir', action='store_true', help='Repor os contadores a partir das senhas')
+        parser.add_argument('--exemplos', type=int, default=10, help='Requisições a mostrar')
+
+    def handle(self, *args, **options):
+        divergentes = resgates.contagens_divergentes()
+        self.stdout.write(f'Requisições com o contador divergente: {len(divergentes)}')
+        for pk, guardado, contadas in divergentes[:options['exemplos']]:
+            self.stdout.write(f'  #{pk}: contador {guardado}, senhas usadas {contadas} ({contadas - guardado:+})')
+
+        if not divergentes:
+            self.stdout.write(self.style.SUCCESS('Os contadores estão consistentes.'))
+        elif options['corrigir']:
+            corrigidas = resgates.corrigir_contagens()
+            self.stdout.write(self.style.SUCCESS(f'{corrigidas} requisição(ões) corrigidas.'))
+        else:
+            self.stdout.write(self.style.WARNING('Use --corrigir para repor os contadores.'))
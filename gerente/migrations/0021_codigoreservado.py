@@ -0,0 +1,39 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gerente", "0020_senha_tipo_combustivel"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CodigoReservado",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("formato", models.CharField(max_length=20)),
+                ("codigo", models.CharField(max_length=20, unique=True)),
+                ("data_criacao", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "Código Reservado",
+                "verbose_name_plural": "Códigos Reservados",
+                "indexes": [
+                    models.Index(
+                        fields=["formato", "id"], name="gerente_cod_formato_05ed09_idx"
+                    )
+                ],
+            },
+        ),
+    ]
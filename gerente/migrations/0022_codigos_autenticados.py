@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:44
+
+import gerente.models
+from django.db import migrations, models
+
+
+def descartar_pool_antigo(apps, schema_editor):
+    """Os códigos do formato antigo no pool já não são emitidos"""
+    CodigoReservado = apps.get_model("gerente", "CodigoReservado")
+    CodigoReservado.objects.filter(formato="A36-10").delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gerente", "0021_codigoreservado"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="requisicaosaldo",
+            name="codigo",
+            field=models.CharField(
+                default=gerente.models.gerar_codigo,
+                editable=False,
+                max_length=12,
+                unique=True,
+            ),
+        ),
+        migrations.RunPython(descartar_pool_antigo, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gerente", "0022_codigos_autenticados"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TarefaEmissao",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "total",
+                    models.PositiveIntegerField(
+                        help_text="Número de senhas que a requisição deve ter no fim da emissão"
+                    ),
+                ),
+                ("criadas", models.PositiveIntegerField(default=0)),
+                (
+                    "estado",
+                    models.CharField(
+                        choices=[
+                            ("pendente", "Pendente"),
+                            ("em_curso", "Em curso"),
+                            ("concluida", "Concluída"),
+                            ("erro", "Erro"),
+                        ],
+                        default="pendente",
+                        max_length=10,
+                    ),
+                ),
+                ("tentativas", models.PositiveIntegerField(default=0)),
+                ("erro", models.TextField(blank=True)),
+                ("data_criacao", models.DateTimeField(auto_now_add=True)),
+                ("data_inicio", models.DateTimeField(blank=True, null=True)),
+                ("data_fim", models.DateTimeField(blank=True, null=True)),
+                ("ultimo_sinal", models.DateTimeField(blank=True, null=True)),
+                (
+                    "requisicao",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="tarefas_emissao",
+                        to="gerente.requisicaosenhas",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Tarefa de Emissão",
+                "verbose_name_plural": "Tarefas de Emissão",
+                "ordering": ["id"],
+                "indexes": [
+                    models.Index(
+                        fields=["estado", "id"], name="gerente_tar_estado_956431_idx"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:47
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gerente", "0023_tarefaemissao"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="requisicaosenhas",
+            name="bitmap_uso",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="requisicaosenhas",
+            name="modo_armazenamento",
+            field=models.CharField(
+                choices=[
+                    ("linhas", "Uma linha por senha"),
+                    ("intervalo", "Intervalo de códigos + mapa de uso"),
+                ],
+                default="linhas",
+                max_length=10,
+            ),
+        ),
+        migrations.CreateModel(
+            name="ResgateSenha",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("indice", models.PositiveIntegerField()),
+                ("codigo", models.CharField(db_index=True, max_length=20)),
+                ("data_uso", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "tipo_combustivel",
+                    models.CharField(
+                        blank=True,
+                        choices=[("gasolina", "Gasolina"), ("diesel", "Diesel")],
+                        max_length=10,
+                        null=True,
+                    ),
+                ),
+                (
+                    "fecho",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="resgates_senhas",
+                        to="gerente.fecho",
+                    ),
+                ),
+                (
+                    "funcionario_uso",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="resgates_senhas",
+                        to="gerente.funcionario",
+                    ),
+                ),
+                (
+                    "requisicao",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="resgates",
+                        to="gerente.requisicaosenhas",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Resgate de Senha",
+                "verbose_name_plural": "Resgates de Senhas",
+                "ordering": ["-data_uso"],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("requisicao", "indice"), name="resgate_unico_por_indice"
+                    )
+                ],
+            },
+        ),
+    ]
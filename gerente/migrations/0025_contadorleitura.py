@@ -0,0 +1,59 @@
+# Generated by Django 5.2.5 on 2026-10-18 03:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gerente", "0024_armazenamento_intervalo"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ContadorLeitura",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("data", models.DateField()),
+                (
+                    "modo",
+                    models.CharField(
+                        choices=[
+                            ("dispositivo", "No dispositivo"),
+                            ("servidor", "No servidor"),
+                            ("recurso", "No servidor (recurso)"),
+                        ],
+                        max_length=12,
+                    ),
+                ),
+                ("leituras", models.PositiveIntegerField(default=0)),
+                (
+                    "funcionario",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="contadores_leitura",
+                        to="gerente.funcionario",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Contador de Leituras",
+                "verbose_name_plural": "Contadores de Leituras",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("data", "funcionario", "modo"),
+                        name="contador_leitura_unico",
+                    )
+                ],
+            },
+        ),
+    ]
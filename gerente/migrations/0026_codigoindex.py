@@ -0,0 +1,124 @@
+# Generated by Django 5.2.5 on 2026-10-18 03:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+TAMANHO_LOTE = 5000
+
+
+def preencher_indice(apps, schema_editor):
+    """Índice dos códigos já gravados (prioridade senha, resgate, saldo como na procura antiga)"""
+    CodigoIndex = apps.get_model("gerente", "CodigoIndex")
+    Senha = apps.get_model("gerente", "Senha")
+    ResgateSenha = apps.get_model("gerente", "ResgateSenha")
+    RequisicaoSaldo = apps.get_model("gerente", "RequisicaoSaldo")
+
+    def entradas():
+        senhas = Senha.objects.order_by().values_list(
+            "id", "codigo", "empresa_id", "usada"
+        )
+        for id_, codigo, empresa_id, usada in senhas.iterator(chunk_size=TAMANHO_LOTE):
+            yield CodigoIndex(
+                codigo=codigo,
+                tipo="senha",
+                objeto_id=id_,
+                empresa_id=empresa_id,
+                estado="usada" if usada else "disponivel",
+            )
+        resgates = ResgateSenha.objects.order_by().values_list(
+            "id", "codigo", "requisicao__empresa_id"
+        )
+        for id_, codigo, empresa_id in resgates.iterator(chunk_size=TAMANHO_LOTE):
+            # Códigos derivados do modo intervalo (14 caracteres, prefixo C) não são indexados
+            if len(codigo) == 14 and codigo.startswith("C"):
+                continue
+            yield CodigoIndex(
+                codigo=codigo,
+                tipo="resgate",
+                objeto_id=id_,
+                empresa_id=empresa_id,
+                estado="usada",
+            )
+        saldos = RequisicaoSaldo.objects.order_by().values_list(
+            "id", "codigo", "empresa_id", "ativa"
+        )
+        for id_, codigo, empresa_id, ativa in saldos.iterator(chunk_size=TAMANHO_LOTE):
+            yield CodigoIndex(
+                codigo=codigo,
+                tipo="saldo",
+                objeto_id=id_,
+                empresa_id=empresa_id,
+                estado="disponivel" if ativa else "inativa",
+            )
+
+    lote = []
+    for entrada in entradas():
+        lote.append(entrada)
+        if len(lote) == TAMANHO_LOTE:
+            CodigoIndex.objects.bulk_create(lote, ignore_conflicts=True)
+            lote = []
+    CodigoIndex.objects.bulk_create(lote, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("empresas", "0001_initial"),
+        ("gerente", "0025_contadorleitura"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CodigoIndex",
+            fields=[
+                (
+                    "codigo",
+                    models.CharField(max_length=20, primary_key=True, serialize=False),
+                ),
+                (
+                    "tipo",
+                    models.CharField(
+                        choices=[
+                            ("senha", "Senha"),
+                            ("resgate", "Senha convertida"),
+                            ("saldo", "Requisição de saldo"),
+                        ],
+                        max_length=8,
+                    ),
+                ),
+                ("objeto_id", models.BigIntegerField()),
+                (
+                    "estado",
+                    models.CharField(
+                        choices=[
+                            ("disponivel", "Disponível"),
+                            ("usada", "Usada"),
+                            ("inativa", "Inativa"),
+                        ],
+                        default="disponivel",
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "empresa",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="codigos_indice",
+                        to="empresas.empresa",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Índice de Código",
+                "verbose_name_plural": "Índice de Códigos",
+                "indexes": [
+                    models.Index(
+                        fields=["tipo", "objeto_id"], name="gerente_cod_tipo_689a09_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(preencher_indice, migrations.RunPython.noop),
+    ]
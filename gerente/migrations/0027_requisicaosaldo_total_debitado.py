@@ -0,0 +1,46 @@
+# Generated by Django 5.2.5 on 2026-10-18 03:27
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def preencher_total_debitado(apps, schema_editor):
+    """Soma dos movimentos já gravados, com um só UPDATE"""
+    RequisicaoSaldo = apps.get_model("gerente", "RequisicaoSaldo")
+    Movimento = apps.get_model("gerente", "Movimento")
+
+    somas = (
+        Movimento.objects.filter(requisicao_saldo=OuterRef("pk"))
+        .order_by()
+        .values("requisicao_saldo")
+        .annotate(total=Sum("valor"))
+        .values("total")
+    )
+    RequisicaoSaldo.objects.update(
+        total_debitado=Coalesce(
+            Subquery(somas),
+            Value(Decimal("0")),
+            output_field=models.DecimalField(max_digits=12, decimal_places=2),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gerente", "0026_codigoindex"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="requisicaosaldo",
+            name="total_debitado",
+            field=models.DecimalField(
+                decimal_places=2, default=0, editable=False, max_digits=12
+            ),
+        ),
+        migrations.RunPython(preencher_total_debitado, migrations.RunPython.noop),
+    ]
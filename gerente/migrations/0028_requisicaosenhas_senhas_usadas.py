@@ -0,0 +1,46 @@
+# Generated by Django 5.2.5 on 2026-10-18 03:29
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def preencher_senhas_usadas(apps, schema_editor):
+    """Senhas já usadas: contadas na tabela Senha (modo linhas) ou no mapa de bits (modo intervalo)"""
+    RequisicaoSenhas = apps.get_model("gerente", "RequisicaoSenhas")
+    Senha = apps.get_model("gerente", "Senha")
+
+    usadas = (
+        Senha.objects.filter(requisicao=OuterRef("pk"), usada=True)
+        .order_by()
+        .values("requisicao")
+        .annotate(total=Count("id"))
+        .values("total")
+    )
+    RequisicaoSenhas.objects.filter(modo_armazenamento="linhas").update(
+        senhas_usadas=Coalesce(Subquery(usadas), Value(0))
+    )
+
+    intervalos = RequisicaoSenhas.objects.filter(
+        modo_armazenamento="intervalo"
+    ).values_list("pk", "bitmap_uso")
+    for pk, bitmap in intervalos.iterator():
+        RequisicaoSenhas.objects.filter(pk=pk).update(
+            senhas_usadas=int.from_bytes(bytes(bitmap or b""), "big").bit_count()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gerente", "0027_requisicaosaldo_total_debitado"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="requisicaosenhas",
+            name="senhas_usadas",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(preencher_senhas_usadas, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,10 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.core.validators import MinValueValidator
 from django.utils import timezone
-import string, random
 from django.contrib.auth.models import User
 from empresas.models import Empresa
 from decimal import Decimal
+from . import codigos
 
 class Fecho(models.Model):
     empresa = models.ForeignKey(Empresa, on_delete=models.CASCADE, related_name='fechos', null=True, blank=True)
@@ -75,9 +75,33 @@ class RequisicaoSenhas(models.Model):
     banco = models.CharField(max_length=100, null=True, blank=True, verbose_name="Nome do Banco")
     banco = models.CharField(max_length=100, null=True, blank=True, verbose_name="Nome do Banco")
 
+    # MODO DE ARMAZENAMENTO DAS SENHAS (ver gerente/armazenamento.py)
+    MODO_LINHAS = 'linhas'
+    MODO_INTERVALO = 'intervalo'
+    MODO_ARMAZENAMENTO_CHOICES = [
+        (MODO_LINHAS, 'Uma linha por senha'),
+        (MODO_INTERVALO, 'Intervalo de códigos + mapa de uso'),
+    ]
+    modo_armazenamento = models.CharField(max_length=10, choices=MODO_ARMAZENAMENTO_CHOICES, default=MODO_LINHAS)
+    # Modo intervalo: um bit por senha (1 = usada)
+    bitmap_uso = models.BinaryField(null=True, blank=True)
+    # Contador mantido na mesma transação de cada resgate (ver gerente/resgates.py)
+    senhas_usadas = models.PositiveIntegerField(default=0, editable=False)
+
+    # Só os resgates alteram estes campos (com UPDATE): editar a requisição não os reescreve
+    CAMPOS_DE_USO = ('senhas_usadas', 'bitmap_uso')
+
     def __str__(self):
        return f"Requisição #{self.id} - {self.cliente.nome}"
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                campo.name for campo in self._meta.concrete_fields
+                if not campo.primary_key and campo.name not in self.CAMPOS_DE_USO
+            ]
+        super().save(*args, **kwargs)
+
     def get_forma_pagamento_display_icon(self):
         """Retorna ícone para forma de pagamento"""
         icons = {
@@ -88,8 +112,8 @@ class RequisicaoSenhas(models.Model):
         return icons.get(self.forma_pagamento, 'fas fa-money-bill-wave')
 
     @property
-    def senhas_usadas(self):
-       return self.lista_senhas.filter(usada=True).count()
+    def em_intervalo(self):
+        return self.modo_armazenamento == self.MODO_INTERVALO
 
     @property
     def senhas_restantes(self):
@@ -97,9 +121,9 @@ class RequisicaoSenhas(models.Model):
 
     def concluir(self):
        """Marca como concluída se não restarem senhas"""
-       if self.senhas_restantes == 0 and not self.data_conclusao:
+       if self.senhas_restantes <= 0 and not self.data_conclusao:
            self.data_conclusao = timezone.now()
-           self.save()
+           self.save(update_fields=['data_conclusao'])
 
     @property
     def pode_editar(self):
@@ -115,11 +139,54 @@ class RequisicaoSenhas(models.Model):
     def status_fecho(self):
         """Retorna o status do fecho como string"""
         return 'fechado' if self.fecho else 'aberto'
+
+    @property
+    def emissao_pendente(self):
+        """Retorna a tarefa de emissão em segundo plano ainda por concluir (ou None)"""
+        return self.tarefas_emissao.exclude(estado=TarefaEmissao.ESTADO_CONCLUIDA).first()
     
     def __str__(self):
         status = " (FECHADA)" if self.fecho else ""
         return f"Requisição #{self.id} - {self.cliente.nome}{status}"
 
+class TarefaEmissao(models.Model):
+    """Emissão de senhas em segundo plano (comando processar_emissoes) para requisições muito grandes"""
+    ESTADO_PENDENTE = 'pendente'
+    ESTADO_EM_CURSO = 'em_curso'
+    ESTADO_CONCLUIDA = 'concluida'
+    ESTADO_ERRO = 'erro'
+    ESTADO_CHOICES = [
+        (ESTADO_PENDENTE, 'Pendente'),
+        (ESTADO_EM_CURSO, 'Em curso'),
+        (ESTADO_CONCLUIDA, 'Concluída'),
+        (ESTADO_ERRO, 'Erro'),
+    ]
+
+    requisicao = models.ForeignKey(RequisicaoSenhas, on_delete=models.CASCADE, related_name='tarefas_emissao')
+    total = models.PositiveIntegerField(help_text="Número de senhas que a requisição deve ter no fim da emissão")
+    criadas = models.PositiveIntegerField(default=0)
+    estado = models.CharField(max_length=10, choices=ESTADO_CHOICES, default=ESTADO_PENDENTE)
+    tentativas = models.PositiveIntegerField(default=0)
+    erro = models.TextField(blank=True)
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    data_inicio = models.DateTimeField(null=True, blank=True)
+    data_fim = models.DateTimeField(null=True, blank=True)
+    # Atualizado a cada lote; uma tarefa em curso sem sinal há muito tempo é retomada por outro worker
+    ultimo_sinal = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Tarefa de Emissão"
+        verbose_name_plural = "Tarefas de Emissão"
+        ordering = ['id']
+        indexes = [models.Index(fields=['estado', 'id'])]
+
+    def __str__(self):
+        return f"Emissão da requisição #{self.requisicao_id} ({self.criadas}/{self.total} - {self.get_estado_display()})"
+
+    @property
+    def percentagem(self):
+        return int(self.criadas * 100 / self.total) if self.total else 100
+
 class Senha(models.Model):
     TIPO_COMBUSTIVEL_CHOICES = [
         ('gasolina', 'Gasolina'),
@@ -159,10 +226,13 @@ class Senha(models.Model):
         combustivel_info = f' - {self.get_tipo_combustivel_display()}' if self.tipo_combustivel and self.usada else ''
         return f"{self.codigo} ({status}{combustivel_info}{fecho_info})"
 
+    # Identifica o formato dos códigos gerados (usado pelo pool de códigos)
+    FORMATO_CODIGO = 'S12-HMAC'
+
     @staticmethod
-    def gerar_codigo(tamanho=10):
-        chars = string.ascii_uppercase + string.digits
-        return ''.join(random.choices(chars, k=tamanho))
+    def gerar_codigo():
+        """Gera código no formato autenticado (ver gerente/codigos.py)"""
+        return codigos.gerar_codigo(codigos.TIPO_SENHA)
     
     @property
     def pode_ser_usada(self):
@@ -192,34 +262,79 @@ class Senha(models.Model):
             return f'Usada (Pendente fecho{combustivel_info})'
     
     def usar(self, funcionario, tipo_combustivel=None):
-        """Marca senha como usada por um funcionário com tipo de combustível - FICA PENDENTE PARA FECHO"""
+        """
+        Marca senha como usada por um funcionário com tipo de combustível - FICA PENDENTE PARA FECHO.
+        UPDATE condicional, seguro entre funcionários (ver gerente/resgates.py).
+        """
         if self.usada:
             raise ValueError("Senha já foi usada")
         
-        self.usada = True
-        self.data_uso = timezone.now()
-        self.funcionario_uso = funcionario
-        self.tipo_combustivel = tipo_combustivel  # NOVO: Armazenar tipo de combustível
-        self.fecho = None  # Fica pendente até próximo fecho
-        self.save()
-        
-        # Verificar se completou a requisição
-        self.requisicao.concluir()
-        
-        return True
+        from .resgates import resgatar
+        return resgatar(self, funcionario, tipo_combustivel)
+
+class ResgateSenha(models.Model):
+    """Uso de uma senha de uma requisição em modo intervalo (não existe linha em Senha)"""
+    TIPO_COMBUSTIVEL_CHOICES = Senha.TIPO_COMBUSTIVEL_CHOICES
+
+    requisicao = models.ForeignKey(RequisicaoSenhas, on_delete=models.CASCADE, related_name='resgates')
+    indice = models.PositiveIntegerField()
+    # Código derivado do intervalo (ou o código original, nas requisições convertidas)
+    codigo = models.CharField(max_length=20, db_index=True)
+    data_uso = models.DateTimeField(default=timezone.now)
+    funcionario_uso = models.ForeignKey(Funcionario, on_delete=models.SET_NULL, null=True, blank=True, related_name='resgates_senhas')
+    tipo_combustivel = models.CharField(max_length=10, choices=TIPO_COMBUSTIVEL_CHOICES, null=True, blank=True)
+    fecho = models.ForeignKey(Fecho, on_delete=models.SET_NULL, null=True, blank=True, related_name='resgates_senhas')
+
+    class Meta:
+        verbose_name = "Resgate de Senha"
+        verbose_name_plural = "Resgates de Senhas"
+        ordering = ['-data_uso']
+        constraints = [
+            models.UniqueConstraint(fields=['requisicao', 'indice'], name='resgate_unico_por_indice'),
+        ]
+
+    def __str__(self):
+        return f"{self.codigo} (Usada - Requisição #{self.requisicao_id})"
+
+    # Mesma interface que Senha para os templates, extrato e fecho
+    usada = True
+
+    @property
+    def cliente(self):
+        return self.requisicao.cliente
+
+    @property
+    def data_criacao(self):
+        return self.requisicao.data_criacao
+
+class CodigoReservado(models.Model):
+    """Pool de códigos únicos pré-gerados, consumidos em blocos na emissão de senhas"""
+    formato = models.CharField(max_length=20)
+    codigo = models.CharField(max_length=20, unique=True)
+    data_criacao = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Código Reservado"
+        verbose_name_plural = "Códigos Reservados"
+        indexes = [models.Index(fields=['formato', 'id'])]
+
+    def __str__(self):
+        return f"{self.codigo} ({self.formato})"
 
 def gerar_codigo():
-   """Gera um código aleatório de 10 caracteres alfanuméricos"""
-   return ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+   """Gera o código de uma requisição de saldo no formato autenticado"""
+   return codigos.gerar_codigo(codigos.TIPO_SALDO)
 
 class RequisicaoSaldo(models.Model):
     empresa = models.ForeignKey(Empresa, on_delete=models.CASCADE, related_name='requisicoes_saldo', null=True, blank=True)
     cliente = models.ForeignKey("Cliente", on_delete=models.CASCADE, related_name='requisicoes_saldo')
     valor_total = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0)])
     funcionario_responsavel = models.ForeignKey("Funcionario", on_delete=models.SET_NULL, null=True, blank=True)
-    codigo = models.CharField(max_length=10, unique=True, default=gerar_codigo, editable=False)
+    codigo = models.CharField(max_length=12, unique=True, default=gerar_codigo, editable=False)
     data_criacao = models.DateTimeField(auto_now_add=True)
     ativa = models.BooleanField(default=True)
+    # Soma dos movimentos, mantida na mesma transação de cada débito (ver gerente/saldos.py)
+    total_debitado = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
     
     # NOVO CAMPO PARA CONTROLAR FECHO
     fecho = models.ForeignKey(Fecho, on_delete=models.SET_NULL, null=True, blank=True, related_name='requisicoes_saldo')
@@ -259,8 +374,7 @@ class RequisicaoSaldo(models.Model):
 
     @property
     def saldo_restante(self):
-        total_debitos = self.movimentos.aggregate(models.Sum("valor"))["valor__sum"] or 0
-        return self.valor_total - total_debitos
+        return self.valor_total - self.total_debitado
     
     @property
     def pode_editar(self):
@@ -280,6 +394,30 @@ class RequisicaoSaldo(models.Model):
     def __str__(self):
         status = " (FECHADA)" if self.fecho else ""
         return f"Req. Saldo {self.codigo} - {self.cliente.nome}{status}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        requisicao = super().from_db(db, field_names, values)
+        # Código e estado tal como estão no índice, para só o atualizar quando mudam
+        requisicao._indexada = (requisicao.__dict__.get('codigo'), requisicao.__dict__.get('ativa'))
+        return requisicao
+
+    def save(self, *args, **kwargs):
+        criada = self._state.adding
+        # total_debitado só muda com os movimentos: editar a requisição não reescreve
+        # o valor lido antes (um débito pode ter entrado entretanto)
+        if not criada and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                campo.name for campo in self._meta.concrete_fields
+                if not campo.primary_key and campo.name != 'total_debitado'
+            ]
+        super().save(*args, **kwargs)
+        # Criação e desativação refletem-se logo no índice de códigos; as outras edições não lhe tocam
+        gravados = kwargs.get('update_fields')
+        indexar = gravados is None or {'codigo', 'ativa'} & set(gravados)
+        if criada or (indexar and getattr(self, '_indexada', None) != (self.codigo, self.ativa)):
+            CodigoIndex.indexar_saldo(self)
+            self._indexada = (self.codigo, self.ativa)
    
 class Movimento(models.Model):
     TIPO_COMBUSTIVEL_CHOICES = [
@@ -307,6 +445,30 @@ class Movimento(models.Model):
     def empresa(self):
         """Propriedade para acessar a empresa através da requisição de saldo"""
         return self.requisicao_saldo.empresa if self.requisicao_saldo else None
+
+    def save(self, *args, atualizar_saldo=True, **kwargs):
+        """
+        Grava o movimento e acerta o total debitado da requisição na mesma transação.
+        atualizar_saldo=False quando o total já foi acertado (saldos.debitar).
+        """
+        update_fields = kwargs.get('update_fields')
+        atualizar_saldo = atualizar_saldo and (update_fields is None or 'valor' in update_fields)
+        with transaction.atomic():
+            anterior = 0
+            if not self._state.adding and atualizar_saldo:
+                anterior = Movimento.objects.filter(pk=self.pk).values_list('valor', flat=True).first() or 0
+            super().save(*args, **kwargs)
+            if atualizar_saldo and self.valor != anterior:
+                RequisicaoSaldo.objects.filter(pk=self.requisicao_saldo_id).update(
+                    total_debitado=models.F('total_debitado') + self.valor - anterior
+                )
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            RequisicaoSaldo.objects.filter(pk=self.requisicao_saldo_id).update(
+                total_debitado=models.F('total_debitado') - self.valor
+            )
+            return super().delete(*args, **kwargs)
     
     def __str__(self):
         combustivel_info = f" ({self.get_tipo_combustivel_display()})" if self.tipo_combustivel else ""
@@ -331,4 +493,112 @@ class LogSistema(models.Model):
         ordering = ['-data_hora']
     
     def __str__(self):
-        return f"{self.funcionario.nome} - {self.tipo_acao} - {self.data_hora}"
\ No newline at end of file
+        return f"{self.funcionario.nome} - {self.tipo_acao} - {self.data_hora}"
+
+class ContadorLeitura(models.Model):
+    """Códigos lidos com sucesso por dia, funcionário e modo de leitura do QR code"""
+    MODO_DISPOSITIVO = 'dispositivo'  # lido no browser, só o código vai ao servidor
+    MODO_SERVIDOR = 'servidor'        # imagem enviada ao scan_qr_code
+    MODO_RECURSO = 'recurso'          # imagem enviada depois de a leitura no browser falhar
+    MODO_CHOICES = [
+        (MODO_DISPOSITIVO, 'No dispositivo'),
+        (MODO_SERVIDOR, 'No servidor'),
+        (MODO_RECURSO, 'No servidor (recurso)'),
+    ]
+
+    data = models.DateField()
+    funcionario = models.ForeignKey(Funcionario, on_delete=models.CASCADE, related_name='contadores_leitura')
+    modo = models.CharField(max_length=12, choices=MODO_CHOICES)
+    leituras = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Contador de Leituras"
+        verbose_name_plural = "Contadores de Leituras"
+        constraints = [
+            models.UniqueConstraint(fields=['data', 'funcionario', 'modo'], name='contador_leitura_unico'),
+        ]
+
+    def __str__(self):
+        return f"{self.funcionario.nome} - {self.data} - {self.modo}: {self.leituras}"
+
+    @classmethod
+    def registar(cls, funcionario, modo, quantidade=1):
+        """Soma leituras ao contador do dia (UPDATE atómico; cria a linha na primeira leitura)"""
+        filtro = {'data': timezone.localdate(), 'funcionario': funcionario, 'modo': modo}
+        if cls.objects.filter(**filtro).update(leituras=models.F('leituras') + quantidade):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(leituras=quantidade, **filtro)
+        except IntegrityError:
+            # Outro pedido criou a linha entretanto
+            cls.objects.filter(**filtro).update(leituras=models.F('leituras') + quantidade)
+
+class CodigoIndex(models.Model):
+    """
+    Índice de todos os códigos gravados (senhas, senhas de requisições convertidas
+    e requisições de saldo): o scan resolve qualquer código com uma só query pela
+    chave primária, sem procurar tabela a tabela. Os códigos do modo intervalo não
+    são gravados e não entram no índice (ver gerente/indice_codigos.py).
+    """
+    TIPO_SENHA = 'senha'
+    TIPO_RESGATE = 'resgate'  # senha já usada de uma requisição convertida (ResgateSenha)
+    TIPO_SALDO = 'saldo'
+    TIPO_CHOICES = [
+        (TIPO_SENHA, 'Senha'),
+        (TIPO_RESGATE, 'Senha convertida'),
+        (TIPO_SALDO, 'Requisição de saldo'),
+    ]
+
+    ESTADO_DISPONIVEL = 'disponivel'
+    ESTADO_USADA = 'usada'
+    ESTADO_INATIVA = 'inativa'
+    ESTADO_CHOICES = [
+        (ESTADO_DISPONIVEL, 'Disponível'),
+        (ESTADO_USADA, 'Usada'),
+        (ESTADO_INATIVA, 'Inativa'),
+    ]
+
+    codigo = models.CharField(max_length=20, primary_key=True)
+    tipo = models.CharField(max_length=8, choices=TIPO_CHOICES)
+    objeto_id = models.BigIntegerField()
+    empresa = models.ForeignKey(Empresa, on_delete=models.CASCADE, related_name='codigos_indice', null=True, blank=True)
+    estado = models.CharField(max_length=10, choices=ESTADO_CHOICES, default=ESTADO_DISPONIVEL)
+
+    class Meta:
+        verbose_name = "Índice de Código"
+        verbose_name_plural = "Índice de Códigos"
+        indexes = [models.Index(fields=['tipo', 'objeto_id'])]
+
+    def __str__(self):
+        return f"{self.codigo} -> {self.tipo} #{self.objeto_id} ({self.estado})"
+
+    @classmethod
+    def indexar_senhas(cls, senhas):
+        """Entradas das senhas acabadas de gravar (com id), na mesma transação"""
+        cls.objects.bulk_create([
+            cls(
+                codigo=senha.codigo,
+                tipo=cls.TIPO_SENHA,
+                objeto_id=senha.id,
+                empresa_id=senha.empresa_id,
+                estado=cls.ESTADO_USADA if senha.usada else cls.ESTADO_DISPONIVEL,
+            )
+            for senha in senhas
+        ])
+
+    @classmethod
+    def indexar_saldo(cls, requisicao):
+        _, criada = cls.objects.update_or_create(
+            codigo=requisicao.codigo,
+            defaults={
+                'tipo': cls.TIPO_SALDO,
+                'objeto_id': requisicao.id,
+                'empresa_id': requisicao.empresa_id,
+                'estado': cls.ESTADO_DISPONIVEL if requisicao.ativa else cls.ESTADO_INATIVA,
+            },
+        )
+        if criada:
+            # O código de uma requisição não muda: só um código novo vai para as caches
+            from . import cache_codigos
+            cache_codigos.adicionar(requisicao.empresa_id, [requisicao.codigo])
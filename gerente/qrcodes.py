@@ -0,0 +1,316 @@
+"""
+Geração de QR codes com cache em dois níveis.
+
+A imagem de um código nunca muda, por isso o PNG ou SVG é guardado com uma
+chave derivada do conteúdo (formato + texto + parâmetros do QR code):
+  1. cache em memória (LRU limitado em bytes), por processo;
+  2. cache em disco em MEDIA_ROOT/cache/qr, partilhada por todos os workers.
+Os acertos e falhas de cada processo estão em /gerente/ajax/metricas/cache-qr/.
+"""
+import atexit
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from io import BytesIO
+
+import qrcode
+from django.conf import settings
+
+# Parâmetros por omissão (os mesmos que as folhas de QR codes sempre usaram)
+VERSAO = 1
+TAMANHO_CAIXA = 8
+BORDA = 4
+CORRECAO_ERRO = qrcode.constants.ERROR_CORRECT_L
+
+FORMATO_PNG = 'png'
+FORMATO_SVG = 'svg'
+# Formato usado nas folhas de QR codes ('svg' imprime nítido, mas pesa quase o dobro)
+FORMATO_PADRAO = getattr(settings, 'ENGEN_QR_FORMATO', FORMATO_PNG)
+
+LIMITE_MEMORIA = getattr(settings, 'ENGEN_QR_CACHE_MEMORIA_BYTES', 32 * 1024 * 1024)
+PASTA_CACHE = getattr(
+    settings, 'ENGEN_QR_CACHE_PASTA',
+    os.path.join(settings.MEDIA_ROOT, 'cache', 'qr'),
+)
+
+# Lotes de aquecimento com pelo menos este número de QR codes por desenhar usam um pool de processos
+PARALELO_A_PARTIR_DE = getattr(settings, 'ENGEN_QR_PARALELO_A_PARTIR_DE', 200)
+PROCESSOS = getattr(settings, 'ENGEN_QR_PROCESSOS', None) or os.cpu_count() or 1
+
+
+class CacheLRU:
+    """Cache LRU em memória limitado pelo total de bytes guardados"""
+
+    def __init__(self, limite_bytes):
+        self.limite_bytes = limite_bytes
+        self.bytes_usados = 0
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        with self._lock:
+            dados = self._itens.get(chave)
+            if dados is not None:
+                self._itens.move_to_end(chave)
+            return dados
+
+    def guardar(self, chave, dados):
+        if len(dados) > self.limite_bytes:
+            return
+        with self._lock:
+            anterior = self._itens.pop(chave, None)
+            if anterior is not None:
+                self.bytes_usados -= len(anterior)
+            self._itens[chave] = dados
+            self.bytes_usados += len(dados)
+            while self.bytes_usados > self.limite_bytes:
+                _, removido = self._itens.popitem(last=False)
+                self.bytes_usados -= len(removido)
+
+    def __len__(self):
+        return len(self._itens)
+
+
+_memoria = CacheLRU(LIMITE_MEMORIA)
+_contadores = {'memoria': 0, 'disco': 0, 'falhas': 0}
+_contadores_lock = threading.Lock()
+
+
+def _contar(tipo):
+    with _contadores_lock:
+        _contadores[tipo] += 1
+
+
+def estatisticas():
+    """Acertos/falhas da cache neste processo"""
+    with _contadores_lock:
+        dados = dict(_contadores)
+    pedidos = dados['memoria'] + dados['disco'] + dados['falhas']
+    dados.update({
+        'pedidos': pedidos,
+        'taxa_acerto': (dados['memoria'] + dados['disco']) / pedidos if pedidos else 0.0,
+        'itens_memoria': len(_memoria),
+        'bytes_memoria': _memoria.bytes_usados,
+    })
+    return dados
+
+
+def chave_qr(texto, formato=FORMATO_PNG, versao=VERSAO, tamanho_caixa=TAMANHO_CAIXA, borda=BORDA, correcao_erro=CORRECAO_ERRO):
+    """Chave de conteúdo: muda se mudar o texto ou qualquer parâmetro da imagem"""
+    conteudo = f'{formato}|{versao}|{tamanho_caixa}|{borda}|{correcao_erro}|{texto}'
+    return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+
+def _caminho_disco(chave, formato):
+    return os.path.join(PASTA_CACHE, chave[:2], f'{chave}.{formato}')
+
+
+def _ler_disco(chave, formato):
+    try:
+        with open(_caminho_disco(chave, formato), 'rb') as ficheiro:
+            return ficheiro.read()
+    except OSError:
+        return None
+
+
+def _escrever_disco(chave, dados, formato):
+    """Escrita atómica (ficheiro temporário + rename) para não servir ficheiros a meio"""
+    caminho = _caminho_disco(chave, formato)
+    try:
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        descritor, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho))
+        with os.fdopen(descritor, 'wb') as ficheiro:
+            ficheiro.write(dados)
+        os.replace(temporario, caminho)
+    except OSError:
+        # A cache em disco é opcional: sem permissões continua a funcionar só em memória
+        pass
+
+
+def _criar_qr(texto, versao, tamanho_caixa, borda, correcao_erro):
+    qr = qrcode.QRCode(
+        version=versao,
+        error_correction=correcao_erro,
+        box_size=tamanho_caixa,
+        border=borda,
+    )
+    qr.add_data(texto)
+    qr.make(fit=True)
+    return qr
+
+
+def matriz_qr(texto, versao=VERSAO, correcao_erro=CORRECAO_ERRO):
+    """Módulos do QR code (lista de linhas de booleanos), sem a margem branca"""
+    return _criar_qr(texto, versao, 1, 0, correcao_erro).get_matrix()
+
+
+def sequencias_pretas(linha):
+    """(início, fim) de cada sequência de módulos pretos de uma linha da matriz"""
+    x = 0
+    lado = len(linha)
+    while x < lado:
+        if not linha[x]:
+            x += 1
+            continue
+        inicio = x
+        while x < lado and linha[x]:
+            x += 1
+        yield inicio, x
+
+
+def desenhar_png(texto, versao=VERSAO, tamanho_caixa=TAMANHO_CAIXA, borda=BORDA, correcao_erro=CORRECAO_ERRO):
+    """Gera o PNG do QR code sem passar pela cache"""
+    qr = _criar_qr(texto, versao, tamanho_caixa, borda, correcao_erro)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def desenhar_svg(texto, versao=VERSAO, tamanho_caixa=TAMANHO_CAIXA, borda=BORDA, correcao_erro=CORRECAO_ERRO):
+    """
+    Gera o SVG do QR code sem passar pela cache.
+    Cada sequência de módulos pretos de uma linha é um traço horizontal de
+    1 módulo de espessura, tudo num único <path> com coordenadas relativas.
+    """
+    qr = _criar_qr(texto, versao, tamanho_caixa, borda, correcao_erro)
+    matriz = qr.get_matrix()
+    lado = len(matriz)
+
+    tracos = []
+    for y, linha in enumerate(matriz):
+        cursor = None
+        for inicio, fim in sequencias_pretas(linha):
+            if cursor is None:
+                tracos.append(f'M{inicio} {y}.5h{fim - inicio}')
+            else:
+                tracos.append(f'm{inicio - cursor} 0h{fim - inicio}')
+            cursor = fim
+
+    pixeis = lado * tamanho_caixa
+    svg = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {lado} {lado}" '
+        f'width="{pixeis}" height="{pixeis}" shape-rendering="crispEdges">'
+        f'<rect width="{lado}" height="{lado}" fill="#fff"/>'
+        f'<path d="{"".join(tracos)}" stroke="#000"/></svg>'
+    )
+    return svg.encode('utf-8')
+
+
+_DESENHAR = {FORMATO_PNG: desenhar_png, FORMATO_SVG: desenhar_svg}
+
+
+def gerar(texto, formato=FORMATO_PNG, versao=VERSAO, tamanho_caixa=TAMANHO_CAIXA, borda=BORDA, correcao_erro=CORRECAO_ERRO):
+    """Imagem do QR code (bytes do PNG ou do SVG), usando a cache em memória e em disco"""
+    chave = chave_qr(texto, formato, versao, tamanho_caixa, borda, correcao_erro)
+
+    dados = _memoria.obter(chave)
+    if dados is not None:
+        _contar('memoria')
+        return dados
+
+    dados = _ler_disco(chave, formato)
+    if dados is not None:
+        _contar('disco')
+        _memoria.guardar(chave, dados)
+        return dados
+
+    _contar('falhas')
+    dados = _DESENHAR[formato](texto, versao, tamanho_caixa, borda, correcao_erro)
+    _escrever_disco(chave, dados, formato)
+    _memoria.guardar(chave, dados)
+    return dados
+
+
+# ================================
+# GERAÇÃO EM LOTE (POOL DE PROCESSOS)
+# ================================
+# Só para o aquecimento offline (manage.py aquecer_qr_codes) e os benchmarks:
+# as folhas de QR codes pedem cada imagem a /gerente/qr/<codigo>, que usa gerar(),
+# e nenhum pedido web arranca o pool.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _obter_pool():
+    """Pool de processos partilhado, criado no primeiro uso"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # "spawn" evita fazer fork de um worker web com threads ativas
+            _pool = ProcessPoolExecutor(
+                max_workers=PROCESSOS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            atexit.register(_pool.shutdown, wait=False, cancel_futures=True)
+        return _pool
+
+
+def _descartar_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def desenhar_paralelo(textos, formato=FORMATO_PNG, versao=VERSAO, tamanho_caixa=TAMANHO_CAIXA, borda=BORDA, correcao_erro=CORRECAO_ERRO):
+    """Desenha as imagens no pool de processos, mantendo a ordem dos textos"""
+    desenhar = partial(
+        _DESENHAR[formato], versao=versao, tamanho_caixa=tamanho_caixa, borda=borda, correcao_erro=correcao_erro,
+    )
+    tamanho_bloco = max(1, len(textos) // (PROCESSOS * 4))
+    return list(_obter_pool().map(desenhar, textos, chunksize=tamanho_bloco))
+
+
+def gerar_lote(textos, formato=FORMATO_PNG, versao=VERSAO, tamanho_caixa=TAMANHO_CAIXA, borda=BORDA, correcao_erro=CORRECAO_ERRO, paralelo=False):
+    """
+    Imagens de vários QR codes pela mesma ordem de `textos`.
+    As que já estão em cache são lidas diretamente; as em falta são desenhadas
+    em série ou, com `paralelo` (só fora dos workers web), os PNGs no pool de
+    processos se forem muitos (os SVGs são baratos o suficiente para não compensar).
+    """
+    resultado = [None] * len(textos)
+    em_falta = []
+    for posicao, texto in enumerate(textos):
+        chave = chave_qr(texto, formato, versao, tamanho_caixa, borda, correcao_erro)
+        dados = _memoria.obter(chave)
+        if dados is not None:
+            _contar('memoria')
+        else:
+            dados = _ler_disco(chave, formato)
+            if dados is not None:
+                _contar('disco')
+                _memoria.guardar(chave, dados)
+            else:
+                em_falta.append((posicao, chave))
+        resultado[posicao] = dados
+
+    if not em_falta:
+        return resultado
+
+    parametros = (versao, tamanho_caixa, borda, correcao_erro)
+    textos_em_falta = [textos[posicao] for posicao, _ in em_falta]
+    desenhados = None
+    if paralelo and formato == FORMATO_PNG and PROCESSOS > 1 and len(em_falta) >= PARALELO_A_PARTIR_DE:
+        try:
+            desenhados = desenhar_paralelo(textos_em_falta, formato, *parametros)
+        except (BrokenProcessPool, OSError):
+            # Um worker morreu ou não foi possível criar processos: continuar em série
+            _descartar_pool()
+    if desenhados is None:
+        desenhados = [_DESENHAR[formato](texto, *parametros) for texto in textos_em_falta]
+
+    for (posicao, chave), dados in zip(em_falta, desenhados):
+        _contar('falhas')
+        _escrever_disco(chave, dados, formato)
+        _memoria.guardar(chave, dados)
+        resultado[posicao] = dados
+    return resultado
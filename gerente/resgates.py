@@ -0,0 +1,263 @@
+"""
+Resgate de senhas gravadas em linhas sem corridas entre funcionários.
+
+Uma senha é marcada como usada com um só UPDATE condicional
+(... WHERE id = ? AND usada = false): só o pedido que altera a linha a
+resgata, mesmo que duas bombas leiam a mesma senha (fotocopiada) ao mesmo
+tempo, sem ler a linha antes nem gravar todas as colunas.
+
+    manage.py testar_concorrencia_resgate   - resgates em paralelo (threads)
+
+No resgate em lote (frotas: o motorista entrega uma tira de senhas para um
+só abastecimento) as senhas gravadas em linhas são validadas com uma query e
+marcadas como usadas com um só UPDATE condicional (WHERE id IN (...) AND
+usada = false), tudo na mesma transação; as do modo intervalo com um bloqueio
+e uma escrita do mapa de bits por requisição (ver
+armazenamento.resgatar_indices). O resultado é dado código a código.
+
+Cada resgate soma as senhas usadas ao contador da requisição
+(RequisicaoSenhas.senhas_usadas) e conclui-a, se ficar sem senhas, no mesmo
+UPDATE e na mesma transação: senhas_restantes e concluir() não contam senhas.
+
+    manage.py verificar_senhas_usadas   - contadores que não batem com as senhas
+"""
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import codigos
+from .armazenamento import bits_usados, resgatar_indices
+from .models import CodigoIndex, RequisicaoSenhas, Senha
+
+# Máximo de códigos num resgate em lote
+MAXIMO_LOTE = getattr(settings, 'ENGEN_RESGATE_LOTE_MAXIMO', 50)
+
+RESGATADA = 'resgatada'
+JA_USADA = 'ja_usada'
+NAO_ENCONTRADA = 'nao_encontrada'
+INVALIDA = 'invalida'
+SALDO = 'saldo'
+
+MENSAGENS = {
+    RESGATADA: 'Resgatada',
+    JA_USADA: 'Já foi utilizada',
+    NAO_ENCONTRADA: 'Não encontrada ou não pertence à sua empresa',
+    INVALIDA: 'Código inválido',
+    SALDO: 'Código de saldo: use o débito de saldo',
+}
+
+
+def separar_codigos(texto):
+    """Códigos escritos no mesmo campo, separados por espaços, vírgulas ou mudanças de linha"""
+    return [codigo for codigo in re.split(r'[\s,;]+', texto or '') if codigo]
+
+
+def registar_usadas(contagens, agora):
+    """
+    Soma {requisicao_id: senhas resgatadas} aos contadores das requisições em
+    modo linhas e conclui as que ficam sem senhas, com um UPDATE por requisição.
+    """
+    # Sempre pela mesma ordem, para dois lotes com as mesmas requisições não se bloquearem
+    for requisicao_id in sorted(contagens):
+        quantidade = contagens[requisicao_id]
+        RequisicaoSenhas.objects.filter(pk=requisicao_id).update(
+            senhas_usadas=F('senhas_usadas') + quantidade,
+            data_conclusao=Case(
+                When(data_conclusao__isnull=True, senhas__lte=F('senhas_usadas') + quantidade, then=Value(agora)),
+                default=F('data_conclusao'),
+            ),
+        )
+
+
+def resgatar(senha, funcionario, tipo_combustivel=None):
+    """
+    Marca a senha como usada - FICA PENDENTE PARA FECHO. Levanta ValueError se
+    já tiver sido usada (por este ou por outro pedido). A requisição só é
+    verificada (concluída) quando o resgate acontece.
+    """
+    agora = timezone.now()
+    with transaction.atomic():
+        alteradas = Senha.objects.filter(pk=senha.pk, usada=False).update(
+            usada=True,
+            data_uso=agora,
+            funcionario_uso=funcionario,
+            tipo_combustivel=tipo_combustivel,
+            fecho=None,
+        )
+        if not alteradas:
+            raise ValueError("Senha já foi usada")
+        CodigoIndex.objects.filter(codigo=senha.codigo).update(estado=CodigoIndex.ESTADO_USADA)
+        registar_usadas({senha.requisicao_id: 1}, agora)
+
+    senha.usada = True
+    senha.data_uso = agora
+    senha.funcionario_uso = funcionario
+    senha.tipo_combustivel = tipo_combustivel
+    senha.fecho = None
+    return True
+
+
+def _resgatar_linhas(resultados, lidos, empresa, funcionario, tipo_combustivel):
+    agora = timezone.now()
+    senhas = list(
+        Senha.objects.select_for_update(of=('self',)).select_related('cliente')
+        .filter(codigo__in=lidos, empresa=empresa)
+    )
+    livres = [senha.id for senha in senhas if not senha.usada]
+
+    resgatadas = set()
+    if livres:
+        uso = {
+            'usada': True,
+            'data_uso': agora,
+            'funcionario_uso': funcionario,
+            'tipo_combustivel': tipo_combustivel,
+            'fecho': None,
+        }
+        ponto = transaction.savepoint()
+        if Senha.objects.filter(id__in=livres, usada=False).update(**uso) == len(livres):
+            transaction.savepoint_commit(ponto)
+            resgatadas = set(livres)
+        else:
+            # Sem SELECT ... FOR UPDATE (SQLite) outra transação pode ter usado alguma:
+            # desfazer e marcar uma a uma, o UPDATE de cada senha diz se foi este resgate
+            transaction.savepoint_rollback(ponto)
+            resgatadas = {
+                senha_id for senha_id in livres
+                if Senha.objects.filter(id=senha_id, usada=False).update(**uso)
+            }
+
+    for senha in senhas:
+        resultados[senha.codigo].update(
+            estado=RESGATADA if senha.id in resgatadas else JA_USADA,
+            cliente=senha.cliente.nome if senha.cliente else 'N/A',
+        )
+
+    if resgatadas:
+        CodigoIndex.objects.filter(
+            codigo__in=[senha.codigo for senha in senhas if senha.id in resgatadas],
+        ).update(estado=CodigoIndex.ESTADO_USADA)
+        registar_usadas(Counter(senha.requisicao_id for senha in senhas if senha.id in resgatadas), agora)
+
+    # Os não encontrados podem ser senhas de requisições convertidas (já usadas) ou saldos
+    em_falta = [codigo for codigo in lidos if resultados[codigo]['estado'] == NAO_ENCONTRADA]
+    if em_falta:
+        entradas = CodigoIndex.objects.filter(codigo__in=em_falta, empresa=empresa).values_list('codigo', 'tipo')
+        for codigo, tipo in entradas:
+            if tipo == CodigoIndex.TIPO_RESGATE:
+                resultados[codigo]['estado'] = JA_USADA
+            elif tipo == CodigoIndex.TIPO_SALDO:
+                resultados[codigo]['estado'] = SALDO
+
+
+def _resgatar_intervalo(resultados, requisicao_id, itens, empresa, funcionario, tipo_combustivel):
+    requisicao, resgatados = resgatar_indices(
+        requisicao_id, [indice for indice, _ in itens], empresa, funcionario, tipo_combustivel,
+    )
+    if requisicao is None:
+        return
+    for indice, codigo in itens:
+        if indice >= requisicao.senhas:
+            continue
+        resultados[codigo].update(
+            estado=RESGATADA if indice in resgatados else JA_USADA,
+            cliente=requisicao.cliente.nome if requisicao.cliente else 'N/A',
+        )
+
+
+def resgatar_lote(lidos, empresa, funcionario, tipo_combustivel=None):
+    """
+    Resgata de uma vez as senhas DA EMPRESA com os códigos dados.
+    Retorna um resultado por código (pela ordem dada, sem repetidos):
+    {'codigo', 'estado', 'mensagem', 'cliente'}.
+    Levanta ValueError se houver mais de MAXIMO_LOTE códigos.
+    """
+    lidos = list(dict.fromkeys(codigo.strip() for codigo in lidos if codigo and codigo.strip()))
+    if len(lidos) > MAXIMO_LOTE:
+        raise ValueError(f'No máximo {MAXIMO_LOTE} códigos de cada vez.')
+
+    resultados = {codigo: {'codigo': codigo, 'estado': NAO_ENCONTRADA, 'cliente': None} for codigo in lidos}
+    linhas = []
+    intervalos = {}
+    for codigo in lidos:
+        tipo = codigos.classificar_codigo(codigo)
+        if tipo is None:
+            resultados[codigo]['estado'] = INVALIDA
+        elif tipo == codigos.TIPO_SALDO:
+            resultados[codigo]['estado'] = SALDO
+        elif tipo == codigos.TIPO_INTERVALO:
+            requisicao_id, indice = codigos.decodificar_intervalo(codigo)
+            intervalos.setdefault(requisicao_id, []).append((indice, codigo))
+        else:
+            linhas.append(codigo)
+
+    with transaction.atomic():
+        if linhas:
+            _resgatar_linhas(resultados, linhas, empresa, funcionario, tipo_combustivel)
+        # Sempre pela mesma ordem, para dois lotes com as mesmas requisições não se bloquearem
+        for requisicao_id, itens in sorted(intervalos.items()):
+            _resgatar_intervalo(resultados, requisicao_id, itens, empresa, funcionario, tipo_combustivel)
+
+    for resultado in resultados.values():
+        resultado['mensagem'] = MENSAGENS[resultado['estado']]
+    return [resultados[codigo] for codigo in lidos]
+
+
+# ================================
+# VERIFICAÇÃO DOS CONTADORES
+# ================================
+
+def contagens_divergentes(requisicoes=None):
+    """[(id da requisição, contador guardado, senhas usadas contadas)] dos contadores que não batem"""
+    if requisicoes is None:
+        requisicoes = RequisicaoSenhas.objects.all()
+
+    usadas = (
+        Senha.objects.filter(requisicao=OuterRef('pk'), usada=True)
+        .order_by()
+        .values('requisicao')
+        .annotate(total=Count('id'))
+        .values('total')
+    )
+    linhas = (
+        requisicoes.filter(modo_armazenamento=RequisicaoSenhas.MODO_LINHAS)
+        .annotate(contadas=Coalesce(Subquery(usadas), Value(0)))
+        .exclude(senhas_usadas=F('contadas'))
+        .values_list('pk', 'senhas_usadas', 'contadas')
+    )
+    divergentes = list(linhas)
+
+    intervalos = requisicoes.filter(modo_armazenamento=RequisicaoSenhas.MODO_INTERVALO).values_list(
+        'pk', 'senhas_usadas', 'bitmap_uso',
+    )
+    for pk, guardado, bitmap in intervalos.iterator():
+        contadas = bits_usados(bitmap)
+        if contadas != guardado:
+            divergentes.append((pk, guardado, contadas))
+    return sorted(divergentes)
+
+
+def corrigir_contagens(requisicoes=None):
+    """Repõe os contadores que não batem e conclui as requisições completas. Retorna quantos corrigiu."""
+    pks = [pk for pk, _, _ in contagens_divergentes(requisicoes)]
+    if not pks:
+        return 0
+    agora = timezone.now()
+    with transaction.atomic():
+        # Contadas outra vez com as requisições bloqueadas: nenhum resgate se perde entre a contagem e a escrita
+        requisicoes = RequisicaoSenhas.objects.filter(pk__in=pks)
+        list(requisicoes.select_for_update().values_list('pk', flat=True))
+        divergentes = contagens_divergentes(requisicoes)
+        for pk, _, contadas in divergentes:
+            RequisicaoSenhas.objects.filter(pk=pk).update(senhas_usadas=contadas)
+        RequisicaoSenhas.objects.filter(
+            pk__in=[pk for pk, _, _ in divergentes],
+            data_conclusao__isnull=True,
+            senhas_usadas__gte=F('senhas'),
+        ).update(data_conclusao=agora)
+    return len(divergentes)
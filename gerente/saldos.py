@@ -0,0 +1,101 @@
+"""
+Débitos das requisições de saldo sem corridas entre funcionários.
+
+A requisição guarda o total debitado (total_debitado); o saldo restante é
+valor_total - total_debitado, sem somar o histórico de movimentos. Um débito
+é um só UPDATE condicional (... SET total_debitado = total_debitado + v
+WHERE total_debitado + v <= valor_total) seguido do INSERT do Movimento, na
+mesma transação: dois débitos simultâneos do mesmo código não passam o
+saldo, e o custo não cresce com o número de movimentos.
+
+Os movimentos gravados com save()/delete() acertam o total sozinhos;
+bulk_create e QuerySet.delete() não - depois deles use recalcular().
+
+    manage.py testar_debitos_saldo   - débitos em paralelo e latência com histórico
+    manage.py verificar_saldos       - totais guardados que não batem com os movimentos
+"""
+from decimal import Decimal
+
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import Movimento, RequisicaoSaldo
+
+
+class SaldoInsuficiente(ValueError):
+    def __init__(self, disponivel):
+        self.disponivel = disponivel
+        super().__init__(f'Saldo insuficiente! Disponível: {disponivel} MT')
+
+
+def debitar(requisicao_saldo, valor, tipo_combustivel, funcionario=None, descricao=''):
+    """
+    Debita `valor` (Decimal) da requisição de saldo ativa. Retorna o Movimento criado.
+    Levanta ValueError se o valor não for positivo, SaldoInsuficiente se não houver
+    saldo e RequisicaoSaldo.DoesNotExist se a requisição tiver sido desativada.
+    """
+    if valor <= 0:
+        raise ValueError('Valor deve ser maior que zero!')
+
+    with transaction.atomic():
+        alteradas = RequisicaoSaldo.objects.filter(
+            pk=requisicao_saldo.pk, ativa=True, total_debitado__lte=F('valor_total') - valor,
+        ).update(total_debitado=F('total_debitado') + valor)
+        if not alteradas:
+            atual = RequisicaoSaldo.objects.filter(pk=requisicao_saldo.pk, ativa=True).values(
+                'valor_total', 'total_debitado',
+            ).first()
+            if atual is None:
+                raise RequisicaoSaldo.DoesNotExist('Requisição de saldo não encontrada')
+            raise SaldoInsuficiente(atual['valor_total'] - atual['total_debitado'])
+
+        movimento = Movimento(
+            requisicao_saldo=requisicao_saldo,
+            valor=valor,
+            tipo_combustivel=tipo_combustivel,
+            descricao=descricao,
+            funcionario=funcionario,
+        )
+        movimento.save(atualizar_saldo=False)
+
+    requisicao_saldo.refresh_from_db(fields=['total_debitado'])
+    return movimento
+
+
+def somas_movimentos():
+    """Subquery com a soma dos movimentos de cada requisição (0 se não houver)"""
+    somas = (
+        Movimento.objects.filter(requisicao_saldo=OuterRef('pk'))
+        .order_by()
+        .values('requisicao_saldo')
+        .annotate(total=Sum('valor'))
+        .values('total')
+    )
+    return Coalesce(
+        Subquery(somas), Value(Decimal('0')),
+        output_field=models.DecimalField(max_digits=12, decimal_places=2),
+    )
+
+
+def divergencias(requisicoes=None):
+    """Requisições cujo total guardado não é a soma dos movimentos, com ambos os valores"""
+    if requisicoes is None:
+        requisicoes = RequisicaoSaldo.objects.all()
+    return (
+        requisicoes.annotate(somado=somas_movimentos())
+        .exclude(total_debitado=F('somado'))
+        .order_by('pk')
+    )
+
+
+def recalcular(requisicoes=None):
+    """Repõe o total debitado a partir dos movimentos, com um só UPDATE. Retorna quantas alterou."""
+    if requisicoes is None:
+        requisicoes = RequisicaoSaldo.objects.all()
+    with transaction.atomic():
+        # Bloqueia as requisições para que nenhum débito entre entre a soma e a escrita
+        ids = list(divergencias(requisicoes).select_for_update().values_list('pk', flat=True))
+        if not ids:
+            return 0
+        return RequisicaoSaldo.objects.filter(pk__in=ids).update(total_debitado=somas_movimentos())
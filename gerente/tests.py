@@ -1,3 +1,293 @@
-from django.test import TestCase
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from empresas.models import Empresa
+
+from . import armazenamento, cache_codigos, codigos, resgates, saldos
+from .emissao import emitir_senhas, reabastecer_pool
+from .models import Cliente, CodigoIndex, RequisicaoSaldo, RequisicaoSenhas, Senha
+
+CACHE_MEMORIA = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def criar_cliente(nome='Bomba'):
+    """Cliente de uma empresa nova"""
+    gerente = User.objects.create_user(username=f'gerente-{nome}')
+    empresa = Empresa.objects.create(nome=nome, gerente=gerente)
+    return Cliente.objects.create(empresa=empresa, nome='Cliente')
+
+
+def criar_requisicao(cliente, senhas, modo=RequisicaoSenhas.MODO_LINHAS):
+    """Requisição com as senhas já emitidas"""
+    requisicao = RequisicaoSenhas.objects.create(
+        empresa=cliente.empresa, cliente=cliente, valor=senhas, senhas=senhas, modo_armazenamento=modo,
+    )
+    with transaction.atomic():
+        emitir_senhas(requisicao, senhas)
+    return requisicao
+
+
+def repetir_se_bloqueada(operacao, tentativas=100):
+    """SQLite: repete a operação enquanto a base de dados estiver bloqueada por outra escrita"""
+    for tentativa in range(tentativas):
+        try:
+            return operacao()
+        except OperationalError:
+            if tentativa == tentativas - 1:
+                raise
+            time.sleep(0.01)
+
+
+def em_paralelo(numero_threads, trabalho):
+    """Corre `trabalho` em várias threads (cada uma com a sua ligação) e retorna os resultados"""
+    resultados = []
+    erros = []
+    lock = threading.Lock()
+    barreira = threading.Barrier(numero_threads)
+
+    def correr():
+        try:
+            preparado = trabalho()
+            barreira.wait()
+            resultado = preparado()
+            with lock:
+                resultados.append(resultado)
+        except Exception as e:
+            with lock:
+                erros.append(e)
+        finally:
+            close_old_connections()
+            connection.close()
+
+    threads = [threading.Thread(target=correr) for _ in range(numero_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if erros:
+        raise erros[0]
+    return resultados
+
+
+class EmissaoTest(TestCase):
+
+    def test_codigos_unicos_e_autenticados(self):
+        # Parte dos códigos vem do pool e o resto é gerado na hora
+        reabastecer_pool(150)
+        cliente = criar_cliente()
+        requisicao = RequisicaoSenhas.objects.create(empresa=cliente.empresa, cliente=cliente, valor=300, senhas=300)
+        with transaction.atomic():
+            self.assertEqual(emitir_senhas(requisicao, 300, tamanho_lote=100), 300)
+
+        emitidos = list(requisicao.lista_senhas.values_list('codigo', flat=True))
+        self.assertEqual(len(set(emitidos)), 300)
+        self.assertTrue(all(codigos.classificar_codigo(codigo) == codigos.TIPO_SENHA for codigo in emitidos))
+        self.assertEqual(CodigoIndex.objects.filter(codigo__in=emitidos, empresa=requisicao.empresa).count(), 300)
+
+    def test_tag_verificada(self):
+        senha = codigos.gerar_codigo(codigos.TIPO_SENHA)
+        saldo = codigos.gerar_codigo(codigos.TIPO_SALDO)
+        self.assertEqual(codigos.classificar_codigo(senha), codigos.TIPO_SENHA)
+        self.assertEqual(codigos.classificar_codigo(saldo), codigos.TIPO_SALDO)
+
+        trocar = lambda caracter: 'B' if caracter == 'A' else 'A'
+        # Tag, corpo ou tipo alterados: a tag deixa de corresponder
+        self.assertIsNone(codigos.classificar_codigo(senha[:-1] + trocar(senha[-1])))
+        self.assertIsNone(codigos.classificar_codigo(senha[:4] + trocar(senha[4]) + senha[5:]))
+        self.assertIsNone(codigos.classificar_codigo(codigos.TIPO_SALDO + senha[1:]))
+        self.assertIsNone(codigos.classificar_codigo(senha.lower()))
+
+
+class ResgateTest(TestCase):
+
+    def setUp(self):
+        self.requisicao = criar_requisicao(criar_cliente(), 2)
+        self.senha = self.requisicao.lista_senhas.first()
+
+    def test_resgatar_uma_so_vez(self):
+        self.assertTrue(resgates.resgatar(self.senha, None, 'gasolina'))
+        # Outro pedido com a senha lida antes do resgate
+        with self.assertRaises(ValueError):
+            resgates.resgatar(Senha(pk=self.senha.pk, requisicao=self.requisicao, codigo=self.senha.codigo), None, 'diesel')
+
+        self.senha.refresh_from_db()
+        self.assertEqual(self.senha.tipo_combustivel, 'gasolina')
+        self.requisicao.refresh_from_db()
+        self.assertEqual(self.requisicao.senhas_usadas, 1)
+        self.assertIsNone(self.requisicao.data_conclusao)
+        self.assertEqual(CodigoIndex.objects.get(codigo=self.senha.codigo).estado, CodigoIndex.ESTADO_USADA)
+
+    def test_lote_com_codigo_repetido_e_ja_usado(self):
+        empresa = self.requisicao.empresa
+        primeiro = resgates.resgatar_lote([self.senha.codigo, self.senha.codigo], empresa, None, 'diesel')
+        self.assertEqual([r['estado'] for r in primeiro], [resgates.RESGATADA])
+        segundo = resgates.resgatar_lote([self.senha.codigo], empresa, None, 'diesel')
+        self.assertEqual([r['estado'] for r in segundo], [resgates.JA_USADA])
+        self.requisicao.refresh_from_db()
+        self.assertEqual(self.requisicao.senhas_usadas, 1)
+
+
+class IntervaloTest(TestCase):
+
+    def setUp(self):
+        self.requisicao = criar_requisicao(criar_cliente(), 5, modo=RequisicaoSenhas.MODO_INTERVALO)
+
+    def test_codigos_listados_voltam_a_requisicao(self):
+        senhas = armazenamento.listar_senhas(self.requisicao)
+        self.assertEqual([senha.indice for senha in senhas], list(range(5)))
+        for senha in senhas:
+            self.assertEqual(codigos.classificar_codigo(senha.codigo), codigos.TIPO_INTERVALO)
+            self.assertEqual(codigos.decodificar_intervalo(senha.codigo), (self.requisicao.id, senha.indice))
+            self.assertFalse(senha.usada)
+
+    def test_resgatar_indices_e_listar(self):
+        empresa = self.requisicao.empresa
+        requisicao, resgatados = armazenamento.resgatar_indices(self.requisicao.id, [3, 1, 3, 9], empresa, None, 'gasolina')
+        self.assertEqual(resgatados, [1, 3])
+        # Os já usados são ignorados
+        _, resgatados = armazenamento.resgatar_indices(self.requisicao.id, [1, 4], empresa, None, 'gasolina')
+        self.assertEqual(resgatados, [4])
+        # Só a empresa da requisição
+        outra = criar_cliente('Outra').empresa
+        self.assertEqual(armazenamento.resgatar_indices(self.requisicao.id, [0], outra, None), (None, []))
+
+        self.requisicao.refresh_from_db()
+        self.assertEqual(self.requisicao.senhas_usadas, 3)
+        usadas = armazenamento.listar_senhas(self.requisicao, usada=True)
+        self.assertEqual([senha.indice for senha in usadas], [1, 3, 4])
+        self.assertEqual([senha.tipo_combustivel for senha in usadas], ['gasolina'] * 3)
+        self.assertEqual([senha.indice for senha in armazenamento.listar_senhas(self.requisicao, usada=False)], [0, 2])
+        self.assertEqual(
+            list(armazenamento.iterar_codigos(self.requisicao, usada=True)), [senha.codigo for senha in usadas],
+        )
+
+
+@override_settings(CACHES=CACHE_MEMORIA)
+class CacheCodigosTest(TransactionTestCase):
+    """Procura de códigos emitidos noutro processo (com o seu próprio estado da cache)"""
+
+    def setUp(self):
+        patcher = mock.patch.multiple(cache_codigos, ATIVA=True, _empresas={}, _lru=OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cliente = criar_cliente()
+        self.empresa = self.cliente.empresa
+        self.antiga = criar_requisicao(self.cliente, 3).lista_senhas.first().codigo
+        # Este processo monta o filtro com os códigos que já existem
+        self.assertIsNotNone(cache_codigos.procurar_entrada(self.antiga, self.empresa))
+        self.estado = cache_codigos._empresas[self.empresa.id]
+        self.esperar(lambda: self.estado.filtro is not None and not self.estado.montando)
+
+    def esperar(self, condicao, timeout=5):
+        limite = time.monotonic() + timeout
+        while not condicao():
+            if time.monotonic() > limite:
+                self.fail('A condição não se verificou a tempo')
+            time.sleep(0.02)
+
+    def emitir_noutro_processo(self, senhas):
+        with mock.patch.multiple(cache_codigos, _empresas={}, _lru=OrderedDict()):
+            requisicao = criar_requisicao(self.cliente, senhas)
+        # O filtro deste processo não os tem; a versão é lida de novo na procura seguinte
+        self.estado.verificada_em -= cache_codigos.INTERVALO_VERSAO
+        return list(requisicao.lista_senhas.values_list('codigo', flat=True))
+
+    def test_codigo_emitido_noutro_processo(self):
+        novos = self.emitir_noutro_processo(2)
+        self.assertFalse(any(codigo in self.estado.filtro for codigo in novos))
+
+        # Versão nova: até o filtro ser montado de novo a procura vai ao índice
+        for codigo in novos:
+            self.assertIsNotNone(cache_codigos.procurar_entrada(codigo, self.empresa))
+        self.esperar(lambda: self.estado.confiavel and not self.estado.montando)
+        self.assertTrue(all(codigo in self.estado.filtro for codigo in novos))
+        self.assertIsNone(cache_codigos.procurar_entrada(codigos.gerar_codigo(codigos.TIPO_SENHA), self.empresa))
+
+    def test_codigo_do_registo_de_adicoes(self):
+        # Com uma cache que incrementa de forma atómica os códigos novos vão para o registo
+        lotes = cache_codigos.estatisticas()['lotes_adicionados']
+        with mock.patch.object(cache_codigos, '_registo_atomico', return_value=True):
+            novos = self.emitir_noutro_processo(2)
+            for codigo in novos:
+                self.assertIsNotNone(cache_codigos.procurar_entrada(codigo, self.empresa))
+        self.assertTrue(self.estado.confiavel)
+        self.assertEqual(cache_codigos.estatisticas()['lotes_adicionados'], lotes + 1)
+
+
+class ResgateConcorrenteTest(TransactionTestCase):
+    THREADS = 8
+
+    def setUp(self):
+        self.requisicao = criar_requisicao(criar_cliente(), 2)
+
+    def test_mesma_senha_resgatada_uma_so_vez(self):
+        senha_id = self.requisicao.lista_senhas.values_list('id', flat=True).first()
+
+        def trabalho():
+            # Cada pedido leu a senha (ainda por usar) antes de os outros a resgatarem
+            senha = Senha.objects.get(pk=senha_id)
+
+            def resgatar():
+                try:
+                    return repetir_se_bloqueada(lambda: resgates.resgatar(senha, None, 'gasolina'))
+                except ValueError:
+                    return False
+            return resgatar
+
+        resultados = em_paralelo(self.THREADS, trabalho)
+
+        self.assertEqual(resultados.count(True), 1)
+        self.assertEqual(resultados.count(False), self.THREADS - 1)
+        self.assertTrue(Senha.objects.get(pk=senha_id).usada)
+        self.requisicao.refresh_from_db()
+        self.assertEqual(self.requisicao.senhas_usadas, 1)
+        self.assertIsNone(self.requisicao.data_conclusao)
+
+
+class DebitoConcorrenteTest(TransactionTestCase):
+    THREADS = 8
+    DEBITOS = 5
+    VALOR = Decimal('10')
+
+    def test_saldo_nunca_ultrapassado(self):
+        cliente = criar_cliente()
+        # Saldo para metade dos débitos tentados: a outra metade tem de ser recusada
+        aceites = self.THREADS * self.DEBITOS // 2
+        requisicao = RequisicaoSaldo.objects.create(
+            empresa=cliente.empresa, cliente=cliente, valor_total=self.VALOR * aceites,
+        )
+
+        def trabalho():
+            # Cada pedido com a sua cópia da requisição
+            propria = RequisicaoSaldo.objects.get(pk=requisicao.pk)
+
+            def debitar():
+                debitados = 0
+                for _ in range(self.DEBITOS):
+                    try:
+                        repetir_se_bloqueada(lambda: saldos.debitar(propria, self.VALOR, 'gasolina'))
+                        debitados += 1
+                    except saldos.SaldoInsuficiente:
+                        pass
+                return debitados
+            return debitar
+
+        debitados = sum(em_paralelo(self.THREADS, trabalho))
+
+        requisicao.refresh_from_db()
+        movimentos = requisicao.movimentos.aggregate(total=Sum('valor'))['total']
+        # No SQLite, um débito já commitado pode ser repetido (bloqueio ao reler o total):
+        # as contas certas são as da base de dados
+        self.assertLessEqual(debitados, aceites)
+        self.assertEqual(requisicao.movimentos.count(), aceites)
+        self.assertEqual(requisicao.total_debitado, movimentos)
+        self.assertEqual(requisicao.total_debitado, requisicao.valor_total)
+        self.assertGreaterEqual(requisicao.saldo_restante, 0)
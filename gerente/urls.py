@@ -1,5 +1,5 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from gerente import views
 from django.contrib.auth.views import LoginView, LogoutView
 
@@ -27,6 +27,9 @@ urlpatterns = [
     path('requisicoes/deletar/<int:requisicao_id>/', views.deletar_requisicao, name='deletar_requisicao'),
     path('requisicoes/<int:requisicao_id>/senhas/', views.ver_senhas, name='ver_senhas'),
     path('requisicao/<int:requisicao_id>/qr-codes/', views.imprimir_qr_codes, name='imprimir_qr_codes'),
+    path('requisicao/<int:requisicao_id>/senhas-pdf/', views.imprimir_senhas_pdf, name='imprimir_senhas_pdf'),
+    re_path(r'^qr/(?P<codigo>[A-Z0-9]+)\.(?P<formato>png|svg)$', views.imagem_qr, name='imagem_qr'),
+    path('requisicoes/<int:requisicao_id>/emissao/', views.progresso_emissao, name='progresso_emissao'),
     
     path('requisicoes-saldo/', views.requisicoes_saldo, name='requisicoes_saldo'),
     path('requisicoes-saldo/adicionar/', views.adicionar_requisicao_saldo, name='adicionar_requisicao_saldo'),
@@ -42,4 +45,6 @@ urlpatterns = [
     path('fecho/preview/', views.preview_fecho, name='preview_fecho'),
 
     path('requisicoes/ajax/pode-editar/<int:requisicao_id>/', views.ajax_pode_editar_requisicao, name='ajax_pode_editar_requisicao'),
+    path('ajax/metricas/cache-codigos/', views.ajax_metricas_cache_codigos, name='ajax_metricas_cache_codigos'),
+    path('ajax/metricas/cache-qr/', views.ajax_metricas_cache_qr, name='ajax_metricas_cache_qr'),
 ]
\ No newline at end of file
@@ -2,13 +2,18 @@ from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.db.models import Sum, Count, Q
+from django.db.models import Sum, Count, F, Q
 from django.db import models
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import condition
 from django.core.paginator import Paginator
 from django.utils import timezone
+from django.utils.safestring import mark_safe
+from django.conf import settings
 from django.db import transaction
-from .models import Funcionario, Cliente, RequisicaoSenhas, Senha, RequisicaoSaldo, Movimento, Fecho
+from .models import Funcionario, Cliente, RequisicaoSenhas, Senha, RequisicaoSaldo, Movimento, Fecho, TarefaEmissao, ResgateSenha
+from . import armazenamento, cache_codigos, codigos, qrcodes
+from .emissao import emitir_senhas, criar_tarefa_emissao, EMISSAO_ASSINCRONA_A_PARTIR_DE, EMISSAO_WORKER
 from empresas.models import Empresa
 import logging
 import csv
@@ -34,6 +39,7 @@ try:
     from reportlab.lib.pagesizes import A4
     from reportlab.lib.units import cm
     from reportlab.lib.colors import black, blue
+    from . import folha_pdf
     REPORTLAB_AVAILABLE = True
 except ImportError:
     REPORTLAB_AVAILABLE = False
@@ -41,6 +47,9 @@ except ImportError:
 # Configurar logging
 logger = logging.getLogger(__name__)
 
+# Senhas por página na folha de QR codes
+QR_CODES_POR_PAGINA = getattr(settings, 'ENGEN_QR_POR_PAGINA', 60)
+
 def is_gerente(user):
   """Verifica se o usuário é Gerente"""
   return user.groups.filter(name='Gerente').exists()
@@ -113,6 +122,10 @@ def dashboard_view(request):
         usada=True,
         data_uso__gte=inicio_mes,
         data_uso__lt=fim_mes
+    ).count() + ResgateSenha.objects.filter(
+        requisicao__empresa=empresa,
+        data_uso__gte=inicio_mes,
+        data_uso__lt=fim_mes
     ).count()
 
     # Dados para gráfico de formas de pagamento
@@ -599,13 +612,22 @@ def extrato_cliente(request, cliente_id):
         tipo=models.Value("senha_usada", output_field=models.CharField())
     ).order_by('data_uso')
     
+    # Senhas usadas fechadas das requisições em modo intervalo
+    resgates_usados = ResgateSenha.objects.filter(
+        requisicao__cliente=cliente,
+        requisicao__empresa=empresa,
+        fecho__isnull=False
+    ).select_related('requisicao', 'fecho').annotate(
+        tipo=models.Value("senha_usada", output_field=models.CharField())
+    ).order_by('data_uso')
+    
     print(f"DEBUG: Senhas usadas fechadas encontradas: {senhas_usadas.count()}")
     for senha in senhas_usadas:
         print(f"  Senha {senha.codigo}: tipo_combustivel={senha.tipo_combustivel}, display={senha.get_tipo_combustivel_display() if senha.tipo_combustivel else 'None'}")
 
     # Juntar todos os lançamentos numa única lista
     lancamentos = sorted(
-        chain(creditos, debitos, requisicoes_senhas, senhas_usadas),
+        chain(creditos, debitos, requisicoes_senhas, senhas_usadas, resgates_usados),
         key=lambda x: x.data_uso if hasattr(x, 'data_uso') and x.data_uso else x.data_criacao
     )
 
@@ -745,6 +767,8 @@ def extrato_cliente(request, cliente_id):
         ).count(),
         'senhas_usadas': Senha.objects.filter(
             cliente=cliente, empresa=empresa, usada=True, fecho__isnull=True
+        ).count() + ResgateSenha.objects.filter(
+            requisicao__cliente=cliente, requisicao__empresa=empresa, fecho__isnull=True
         ).count()
     }
     
@@ -777,7 +801,7 @@ def requisicoes(request):
     requisicoes = (
         RequisicaoSenhas.objects.filter(empresa=empresa, ativa=True)
         .select_related('cliente', 'fecho')  # ADICIONADO select_related para 'fecho'
-        .prefetch_related('lista_senhas')
+        .alias(restantes=F('senhas') - F('senhas_usadas'))
         .order_by('-data_criacao')
     )
 
@@ -798,18 +822,19 @@ def requisicoes(request):
     elif fecho_filter == 'aberto':
         requisicoes = requisicoes.filter(fecho__isnull=True)
 
-    # Filtragem por status (feito em Python, já que senhas_restantes é @property)
+    # Filtragem por status (senhas restantes = senhas - senhas_usadas, guardados na requisição)
     if status_filter:
         if status_filter == 'completo':
-            requisicoes = [r for r in requisicoes if r.senhas_restantes == 0]
+            requisicoes = requisicoes.filter(restantes=0)
         elif status_filter == 'baixo':
-            requisicoes = [r for r in requisicoes if 0 < r.senhas_restantes <= 5]
+            requisicoes = requisicoes.filter(restantes__gt=0, restantes__lte=5)
         elif status_filter == 'medio':
-            requisicoes = [r for r in requisicoes if 5 < r.senhas_restantes <= 15]
+            requisicoes = requisicoes.filter(restantes__gt=5, restantes__lte=15)
         elif status_filter == 'alto':
-            requisicoes = [r for r in requisicoes if r.senhas_restantes > 15]
+            requisicoes = requisicoes.filter(restantes__gt=15)
 
     # Estatísticas
+    requisicoes = list(requisicoes)
     total_valor = sum(r.valor for r in requisicoes)
     total_senhas = sum(r.senhas for r in requisicoes)
     senhas_restantes_total = sum(r.senhas_restantes for r in requisicoes)
@@ -883,29 +908,31 @@ def adicionar_requisicao(request):
                     senhas=quantidade_senhas,
                     forma_pagamento=forma_pagamento,
                     banco=banco if forma_pagamento == 'transferencia' else None,  # NOVO CAMPO
-                    funcionario_responsavel=None
+                    funcionario_responsavel=None,
+                    modo_armazenamento=armazenamento.MODO_PADRAO
                 )
 
-                # Criar senhas random
-                for _ in range(quantidade_senhas):
-                    codigo = Senha.gerar_codigo()
-                    # Garantir que não repete
-                    while Senha.objects.filter(codigo=codigo).exists():
-                        codigo = Senha.gerar_codigo()
-                    Senha.objects.create(
-                        empresa=empresa,
-                        codigo=codigo,
-                        requisicao=requisicao,
-                        cliente=cliente
-                    )
-            
-            messages.success(request, f'Requisição #{requisicao.id} criada com sucesso!')
+                # Requisições muito grandes são emitidas em segundo plano, se houver
+                # worker (no modo intervalo não há linhas a gravar)
+                tarefa_emissao = None
+                if (EMISSAO_WORKER and quantidade_senhas >= EMISSAO_ASSINCRONA_A_PARTIR_DE
+                        and not requisicao.em_intervalo):
+                    tarefa_emissao = criar_tarefa_emissao(requisicao)
+                else:
+                    # Criar senhas random em lote
+                    emitir_senhas(requisicao, quantidade_senhas)
+            
+            if tarefa_emissao:
+                messages.success(request, f'Requisição #{requisicao.id} criada! As {quantidade_senhas} senhas estão a ser emitidas em segundo plano.')
+            else:
+                messages.success(request, f'Requisição #{requisicao.id} criada com sucesso!')
             
             # Renderizar template com modal de recibo
             return render(request, 'gerente/adicionar_requisicao.html', {
                 'clientes': clientes,
                 'mostrar_recibo': True,
-                'requisicao': requisicao
+                'requisicao': requisicao,
+                'tarefa_emissao': tarefa_emissao,
             })
             
         except Exception as e:
@@ -932,6 +959,10 @@ def editar_requisicao(request, requisicao_id):
         messages.error(request, f'Não é possível editar a requisição #{requisicao.id} pois ela já foi fechada no fecho #{requisicao.fecho.id}.')
         return redirect('requisicoes')
     
+    if requisicao.emissao_pendente:
+        messages.error(request, f'A requisição #{requisicao.id} ainda tem senhas a ser emitidas. Aguarde o fim da emissão.')
+        return redirect('requisicoes')
+    
     clientes = Cliente.objects.filter(empresa=empresa).order_by('nome')
     
     if request.method == 'POST':
@@ -1007,16 +1038,7 @@ def editar_requisicao(request, requisicao_id):
 
                 # Criar novas senhas se aumentou a quantidade
                 if diferenca > 0:
-                    for _ in range(diferenca):
-                        codigo = Senha.gerar_codigo()
-                        while Senha.objects.filter(codigo=codigo).exists():
-                            codigo = Senha.gerar_codigo()
-                        Senha.objects.create(
-                            empresa=empresa,
-                            codigo=codigo,
-                            requisicao=requisicao,
-                            cliente=cliente
-                        )
+                    emitir_senhas(requisicao, diferenca)
             
             messages.success(request, f'Requisição #{requisicao.id} atualizada com sucesso!')
             return redirect('requisicoes')
@@ -1067,19 +1089,55 @@ def ver_senhas(request, requisicao_id):
         return redirect('login')
     
     requisicao = get_object_or_404(RequisicaoSenhas, id=requisicao_id, empresa=empresa)
-    senhas = requisicao.lista_senhas.all()
+    senhas = armazenamento.listar_senhas(requisicao)
     
     # Contar senhas disponíveis (não usadas)
-    senhas_disponiveis_count = senhas.filter(usada=False).count()
+    if requisicao.em_intervalo:
+        total_senhas = len(senhas)
+        senhas_disponiveis_count = requisicao.senhas_restantes
+    else:
+        total_senhas = senhas.count()
+        senhas_disponiveis_count = senhas.filter(usada=False).count()
     
     context = {
         'requisicao': requisicao,
         'senhas': senhas,
+        'total_senhas': total_senhas,
         'senhas_disponiveis_count': senhas_disponiveis_count,
     }
     
     return render(request, 'gerente/senhas.html', context)
 
+@login_required(login_url='/gerente/login')
+@user_passes_test(is_gerente, login_url='/login')
+def progresso_emissao(request, requisicao_id):
+    """AJAX com o progresso da emissão em segundo plano (senhas criadas / total)"""
+    empresa = get_empresa_usuario(request.user)
+    if not empresa:
+        return JsonResponse({'error': 'Empresa não encontrada'}, status=403)
+    
+    requisicao = get_object_or_404(RequisicaoSenhas, id=requisicao_id, empresa=empresa)
+    tarefa = requisicao.tarefas_emissao.order_by('-id').first()
+    
+    if tarefa is None:
+        # Requisição emitida de forma síncrona
+        return JsonResponse({
+            'estado': TarefaEmissao.ESTADO_CONCLUIDA,
+            'criadas': requisicao.senhas,
+            'total': requisicao.senhas,
+            'percentagem': 100,
+            'concluida': True,
+        })
+    
+    return JsonResponse({
+        'estado': tarefa.estado,
+        'criadas': tarefa.criadas,
+        'total': tarefa.total,
+        'percentagem': tarefa.percentagem,
+        'concluida': tarefa.estado == TarefaEmissao.ESTADO_CONCLUIDA,
+        'erro': tarefa.erro,
+    })
+
 # ================================
 # VIEWS DE REQUISIÇÕES SALDO
 # ================================
@@ -1096,7 +1154,7 @@ def requisicoes_saldo(request):
     requisicoes = (
         RequisicaoSaldo.objects.filter(empresa=empresa, ativa=True)
         .select_related('cliente', 'fecho')  # ADICIONADO select_related para 'fecho'
-        .prefetch_related('movimentos')
+        .alias(restante=F('valor_total') - F('total_debitado'))
         .order_by('-data_criacao')
     )
 
@@ -1118,18 +1176,19 @@ def requisicoes_saldo(request):
     elif fecho_filter == 'aberto':
         requisicoes = requisicoes.filter(fecho__isnull=True)
 
-    # Filtragem por status (feito em Python, já que saldo_restante é @property)
+    # Filtragem por status (saldo restante = valor_total - total_debitado, guardados na requisição)
     if status_filter:
         if status_filter == 'esgotado':
-            requisicoes = [r for r in requisicoes if r.saldo_restante == 0]
+            requisicoes = requisicoes.filter(restante=0)
         elif status_filter == 'baixo':
-            requisicoes = [r for r in requisicoes if 0 < r.saldo_restante <= 50]
+            requisicoes = requisicoes.filter(restante__gt=0, restante__lte=50)
         elif status_filter == 'medio':
-            requisicoes = [r for r in requisicoes if 50 < r.saldo_restante <= 200]
+            requisicoes = requisicoes.filter(restante__gt=50, restante__lte=200)
         elif status_filter == 'alto':
-            requisicoes = [r for r in requisicoes if r.saldo_restante > 200]
+            requisicoes = requisicoes.filter(restante__gt=200)
 
     # Estatísticas
+    requisicoes = list(requisicoes)
     total_valor = sum(r.valor_total for r in requisicoes)
     saldo_restante_total = sum(r.saldo_restante for r in requisicoes)
 
@@ -1407,15 +1466,18 @@ def dashboard(request):
        'requisicoes_concluidas': RequisicaoSenhas.objects.filter(empresa=empresa, ativa=True, data_conclusao__isnull=False).count(),
    }
    
-   # Requisições por status
-   requisicoes_ativas = RequisicaoSenhas.objects.filter(empresa=empresa, ativa=True).prefetch_related('lista_senhas')
+   # Requisições por status (com uma só query sobre o contador de senhas usadas)
+   requisicoes_ativas = RequisicaoSenhas.objects.filter(empresa=empresa, ativa=True).annotate(
+       restantes=F('senhas') - F('senhas_usadas')
+   )
    
-   requisicoes_status = {
-       'alto': sum(1 for r in requisicoes_ativas if r.senhas_restantes > 15),
-       'medio': sum(1 for r in requisicoes_ativas if 5 < r.senhas_restantes <= 15),
-       'baixo': sum(1 for r in requisicoes_ativas if 0 < r.senhas_restantes <= 5),
-       'completo': sum(1 for r in requisicoes_ativas if r.senhas_restantes == 0),
-   }
+   requisicoes_status = requisicoes_ativas.aggregate(
+       alto=Count('id', filter=Q(restantes__gt=15)),
+       medio=Count('id', filter=Q(restantes__gt=5, restantes__lte=15)),
+       baixo=Count('id', filter=Q(restantes__gt=0, restantes__lte=5)),
+       completo=Count('id', filter=Q(restantes=0)),
+       senhas_restantes_total=Sum('restantes'),
+   )
    
    # Valores totais
    valores = RequisicaoSenhas.objects.filter(empresa=empresa, ativa=True).aggregate(
@@ -1423,7 +1485,7 @@ def dashboard(request):
        senhas_total=Sum('senhas')
    )
    
-   senhas_restantes_total = sum(r.senhas_restantes for r in requisicoes_ativas)
+   senhas_restantes_total = requisicoes_status.pop('senhas_restantes_total') or 0
    
    # Últimas requisições
    ultimas_requisicoes = RequisicaoSenhas.objects.filter(empresa=empresa, ativa=True).select_related('cliente').order_by('-data_criacao')[:5]
@@ -1478,18 +1540,25 @@ def imprimir_qr_codes(request, requisicao_id):
         return redirect('login')
     
     requisicao = get_object_or_404(RequisicaoSenhas, id=requisicao_id, empresa=empresa)
-    senhas_nao_usadas = requisicao.lista_senhas.filter(usada=False)
     
-    # Gerar QR codes para cada senha não usada
-    senhas_com_qr = []
-    for senha in senhas_nao_usadas:
-        qr_code_base64 = gerar_qr_code(senha.codigo)
-        senha.qr_code_base64 = qr_code_base64
-        senhas_com_qr.append(senha)
+    if requisicao.emissao_pendente:
+        messages.error(request, f'As senhas da requisição #{requisicao.id} ainda estão a ser emitidas.')
+        return redirect('requisicoes')
+    
+    senhas_nao_usadas = armazenamento.listar_senhas(requisicao, usada=False)
+    if not requisicao.em_intervalo:
+        senhas_nao_usadas = senhas_nao_usadas.order_by('id')
+    
+    # Paginação: as imagens são pedidas ao endpoint imagem_qr (com cache HTTP)
+    # à medida que aparecem no ecrã, em vez de irem todas dentro do HTML
+    paginator = Paginator(senhas_nao_usadas, QR_CODES_POR_PAGINA)
+    page_obj = paginator.get_page(request.GET.get('page'))
     
     context = {
         'requisicao': requisicao,
-        'senhas_nao_usadas': senhas_com_qr,
+        'senhas_nao_usadas': page_obj,
+        'total_nao_usadas': paginator.count,
+        'formato_qr': formato_qr_pedido(request),
         'data_geracao': timezone.now().strftime("%d/%m/%Y %H:%M")
     }
     
@@ -1509,44 +1578,126 @@ def imprimir_qr_codes_saldo(request, requisicao_id):
     requisicao = get_object_or_404(RequisicaoSaldo, id=requisicao_id, empresa=empresa)
     
     # Gerar QR code apenas com o código da requisição
-    qr_code_base64 = gerar_qr_code(requisicao.codigo)
+    formato_qr = formato_qr_pedido(request)
+    qr_code = gerar_qr_code(requisicao.codigo, formato_qr)
     
     context = {
         'requisicao': requisicao,
-        'qr_code': qr_code_base64,
+        'qr_code': qr_code,
+        'formato_qr': formato_qr,
         'data_geracao': timezone.now().strftime("%d/%m/%Y %H:%M")
     }
     
     return render(request, 'gerente/qr_codes_saldo.html', context)
 
-def gerar_qr_code(texto):
+def gerar_qr_code(texto, formato=qrcodes.FORMATO_PNG):
+    """
+    Gera um QR Code para o texto fornecido (com cache, ver gerente/qrcodes.py):
+    PNG em base64 ou o SVG pronto a incluir no HTML
+    """
+    return imagem_qr_para_template(qrcodes.gerar(texto, formato), formato)
+
+
+def _inteiro_entre(valor, minimo, maximo, padrao):
+    try:
+        return min(max(int(valor), minimo), maximo)
+    except (TypeError, ValueError):
+        return padrao
+
+
+@login_required(login_url='/gerente/login')
+@user_passes_test(is_gerente, login_url='/login')
+def imprimir_senhas_pdf(request, requisicao_id):
+    """
+    PDF A4 com as senhas não usadas, várias por página e com marcas de corte.
+    A grelha pode ser escolhida com ?colunas=&linhas=. As páginas são enviadas
+    à medida que são geradas (ver gerente/folha_pdf.py).
+    """
+    empresa = get_empresa_usuario(request.user)
+    if not empresa:
+        messages.error(request, 'Empresa não encontrada.')
+        return redirect('login')
+
+    requisicao = get_object_or_404(RequisicaoSenhas.objects.select_related('cliente'), id=requisicao_id, empresa=empresa)
+
+    if requisicao.emissao_pendente:
+        messages.error(request, f'As senhas da requisição #{requisicao.id} ainda estão a ser emitidas.')
+        return redirect('requisicoes')
+
+    if not REPORTLAB_AVAILABLE:
+        messages.error(request, 'Geração de PDF indisponível (reportlab não instalado).')
+        return redirect('imprimir_qr_codes', requisicao_id=requisicao.id)
+
+    colunas = _inteiro_entre(request.GET.get('colunas'), 1, folha_pdf.MAX_COLUNAS, folha_pdf.COLUNAS)
+    linhas = _inteiro_entre(request.GET.get('linhas'), 1, folha_pdf.MAX_LINHAS, folha_pdf.LINHAS)
+
+    codigos_senhas = armazenamento.iterar_codigos(requisicao, usada=False)
+    response = StreamingHttpResponse(
+        folha_pdf.gerar_pdf(requisicao, codigos_senhas, colunas, linhas),
+        content_type='application/pdf',
+    )
+    response['Content-Disposition'] = f'inline; filename="senhas_requisicao_{requisicao.id}.pdf"'
+    return response
+
+
+def codigo_da_empresa(codigo, empresa):
     """
-    Gera um QR Code em base64 para o texto fornecido
+    Verifica se o código foi emitido pela empresa: os do modo intervalo pela
+    requisição que trazem, os restantes pelo índice de códigos (com o filtro de
+    Bloom de cache_codigos, sem query para códigos que não existem).
     """
-    # Configurar o QR Code
-    qr = qrcode.QRCode(
-        version=1,  # Controla o tamanho do QR Code
-        error_correction=qrcode.constants.ERROR_CORRECT_L,  # Correção de erro baixa
-        box_size=8,  # Tamanho de cada "caixa" do QR Code
-        border=4,   # Tamanho da borda
+    tipo = codigos.classificar_codigo(codigo)
+    if tipo is None or empresa is None:
+        return False
+    if tipo == codigos.TIPO_INTERVALO:
+        requisicao_id, indice = codigos.decodificar_intervalo(codigo)
+        return RequisicaoSenhas.objects.filter(
+            pk=requisicao_id, empresa=empresa, modo_armazenamento=RequisicaoSenhas.MODO_INTERVALO, senhas__gt=indice,
+        ).exists()
+    return cache_codigos.procurar_entrada(codigo, empresa) is not None
+
+
+def _etag_imagem_qr(request, codigo, formato):
+    return qrcodes.chave_qr(codigo, formato)
+
+
+@login_required(login_url='/gerente/login')
+@user_passes_test(is_gerente, login_url='/login')
+def imagem_qr(request, codigo, formato):
+    """
+    Imagem (PNG ou SVG) do QR code de um código. A imagem de um código nunca
+    muda, por isso vai com ETag forte e Cache-Control immutable: o browser
+    guarda-a e as reimpressões não chegam ao servidor. É privada (só para quem
+    tem sessão na empresa), por isso os proxies partilhados não a guardam.
+    """
+    # Antes do ETag: um 304 também confirmaria que o código é da empresa
+    if not codigo_da_empresa(codigo, get_empresa_usuario(request.user)):
+        raise Http404('Código não encontrado')
+    return _resposta_imagem_qr(request, codigo, formato)
+
+
+@condition(etag_func=_etag_imagem_qr)
+def _resposta_imagem_qr(request, codigo, formato):
+    response = HttpResponse(
+        qrcodes.gerar(codigo, formato),
+        content_type='image/svg+xml' if formato == qrcodes.FORMATO_SVG else 'image/png',
     )
-    
-    # Adicionar dados ao QR Code
-    qr.add_data(texto)
-    qr.make(fit=True)
-    
-    # Criar imagem do QR Code
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Converter para base64
-    buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    
-    # Codificar em base64
-    qr_code_base64 = base64.b64encode(buffer.getvalue()).decode()
-    
-    return qr_code_base64
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+def imagem_qr_para_template(imagem, formato):
+    if formato == qrcodes.FORMATO_SVG:
+        return mark_safe(imagem.decode('utf-8'))
+    return base64.b64encode(imagem).decode()
+
+
+def formato_qr_pedido(request):
+    """Formato das imagens da folha (?formato=png|svg, por omissão ENGEN_QR_FORMATO)"""
+    formato = request.GET.get('formato', qrcodes.FORMATO_PADRAO)
+    if formato not in (qrcodes.FORMATO_PNG, qrcodes.FORMATO_SVG):
+        formato = qrcodes.FORMATO_PADRAO
+    return formato
 
 
 @login_required(login_url='/gerente/login')
@@ -1561,6 +1712,10 @@ def gerar_recibo_pdf(request, requisicao_id):
         
         requisicao = get_object_or_404(RequisicaoSenhas, id=requisicao_id, empresa=empresa)
         
+        if requisicao.emissao_pendente:
+            messages.error(request, f'As senhas da requisição #{requisicao.id} ainda estão a ser emitidas.')
+            return redirect('requisicoes')
+        
         # Template HTML para PDF
         template_string = '''
         <!DOCTYPE html>
@@ -2183,6 +2338,13 @@ def fazer_fecho(request):
                 fecho__isnull=True  # CORREÇÃO: senhas não fechadas individualmente
             ).count()
             
+            # 5. Senhas usadas das requisições em modo intervalo
+            resgates_nao_fechados = ResgateSenha.objects.filter(
+                requisicao__empresa=empresa,
+                fecho__isnull=True
+            ).count()
+            senhas_usadas_nao_fechadas += resgates_nao_fechados
+            
             # Verificar se há dados para fechar
             total_dados_pendentes = (
                 requisicoes_senhas_nao_fechadas + 
@@ -2232,6 +2394,10 @@ def fazer_fecho(request):
                 data_uso__isnull=False,
                 fecho__isnull=True  # CORREÇÃO: senhas não fechadas individualmente
             ).update(fecho=novo_fecho)
+            senhas_fechadas += ResgateSenha.objects.filter(
+                requisicao__empresa=empresa,
+                fecho__isnull=True
+            ).update(fecho=novo_fecho)
             print(f"DEBUG FECHO: Senhas fechadas: {senhas_fechadas}")
             
             # DEBUG: Verificar se os movimentos foram realmente fechados
@@ -2317,6 +2483,17 @@ def preview_fecho(request):
         # (removemos a dependência do fecho da requisição)
     ).select_related('requisicao__cliente', 'funcionario_uso').order_by('-data_uso')
     
+    # Incluir senhas usadas das requisições em modo intervalo
+    resgates_abertos = ResgateSenha.objects.filter(
+        requisicao__empresa=empresa,
+        fecho__isnull=True
+    ).select_related('requisicao__cliente', 'funcionario_uso')
+    senhas_usadas_abertas = sorted(
+        chain(senhas_usadas_abertas, resgates_abertos),
+        key=attrgetter('data_uso'),
+        reverse=True
+    )
+    
     # Calcular totais financeiros
     total_valor_senhas = sum(r.valor for r in requisicoes_senhas_abertas)
     total_valor_saldo = sum(r.valor_total for r in requisicoes_saldo_abertas) 
@@ -2414,6 +2591,18 @@ def ajax_pode_editar_requisicao(request, requisicao_id):
     except Exception as e:
         return JsonResponse({'pode_editar': False, 'motivo': str(e)})
 
+@login_required(login_url='/gerente/login')
+@user_passes_test(is_gerente, login_url='/login')
+def ajax_metricas_cache_codigos(request):
+    """Taxa de acerto e de falsos positivos da cache de códigos do processo que responde"""
+    return JsonResponse(cache_codigos.estatisticas())
+
+@login_required(login_url='/gerente/login')
+@user_passes_test(is_gerente, login_url='/login')
+def ajax_metricas_cache_qr(request):
+    """Acertos em memória e em disco da cache de imagens de QR codes do processo que responde"""
+    return JsonResponse(qrcodes.estatisticas())
+
 @login_required(login_url='/gerente/login')
 @user_passes_test(is_gerente, login_url='/login')
 def ajax_cliente_info(request, cliente_id):
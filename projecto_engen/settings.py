@@ -54,6 +54,7 @@ INSTALLED_APPS = [
     "empresas",
     "gerente",
     "funcionario",
+    "channels",
 ]
 
 MIDDLEWARE = [
@@ -87,6 +88,7 @@ TEMPLATES = [
 
 
 WSGI_APPLICATION = "projecto_engen.wsgi.application"
+ASGI_APPLICATION = "projecto_engen.asgi.application"
 
 
 # Database
@@ -150,8 +152,150 @@ STATIC_URL = "static/"
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# Ficheiros gerados pela aplicação (cache de QR codes, etc.)
+MEDIA_URL = "media/"
+MEDIA_ROOT = os.environ.get("MEDIA_ROOT", os.path.join(BASE_DIR, 'media'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+
+# Pool de códigos pré-gerados para a emissão de senhas (ver manage.py reabastecer_codigos;
+# o Dockerfile corre-o em modo contínuo, a não ser com ENGEN_POOL_CODIGOS_REABASTECER=0)
+ENGEN_POOL_CODIGOS_MINIMO = int(os.environ.get("ENGEN_POOL_CODIGOS_MINIMO", 20000))
+ENGEN_POOL_CODIGOS_ALVO = int(os.environ.get("ENGEN_POOL_CODIGOS_ALVO", 100000))
+
+# Chave usada para autenticar os códigos de senhas/saldo (por omissão a SECRET_KEY).
+# ATENÇÃO: alterar esta chave invalida todos os códigos já emitidos no formato novo.
+ENGEN_CODIGO_CHAVE = os.environ.get("ENGEN_CODIGO_CHAVE")
+
+# Requisições com pelo menos este número de senhas são emitidas em segundo plano
+# pelo worker "manage.py processar_emissoes". ENGEN_EMISSAO_WORKER: "1" (o Dockerfile
+# arranca-o ao lado do gunicorn), "externo" (corre noutro serviço) ou "0" (não há worker
+# e todas as senhas são emitidas no pedido)
+ENGEN_EMISSAO_ASSINCRONA_A_PARTIR_DE = int(os.environ.get("ENGEN_EMISSAO_ASSINCRONA_A_PARTIR_DE", 50000))
+ENGEN_EMISSAO_WORKER = os.environ.get("ENGEN_EMISSAO_WORKER", "1") != "0"
+
+# Armazenamento das senhas das requisições novas: "linhas" (uma linha por senha)
+# ou "intervalo" (códigos derivados da requisição + mapa de bits de uso)
+ENGEN_MODO_ARMAZENAMENTO_SENHAS = os.environ.get("ENGEN_MODO_ARMAZENAMENTO_SENHAS", "linhas")
+
+# Cache das imagens de QR codes: memória por processo (em bytes) + disco em MEDIA_ROOT/cache/qr
+ENGEN_QR_CACHE_MEMORIA_BYTES = int(os.environ.get("ENGEN_QR_CACHE_MEMORIA_BYTES", 32 * 1024 * 1024))
+ENGEN_QR_CACHE_PASTA = os.environ.get("ENGEN_QR_CACHE_PASTA", os.path.join(MEDIA_ROOT, 'cache', 'qr'))
+
+# O aquecimento da cache de QR codes (manage.py aquecer_qr_codes, fora dos workers web)
+# usa um pool de processos (ENGEN_QR_PROCESSOS, por omissão o número de CPUs) quando
+# tem pelo menos este número de imagens por gerar
+ENGEN_QR_PARALELO_A_PARTIR_DE = int(os.environ.get("ENGEN_QR_PARALELO_A_PARTIR_DE", 200))
+ENGEN_QR_PROCESSOS = int(os.environ.get("ENGEN_QR_PROCESSOS", 0)) or None
+
+# Formato das imagens nas folhas de QR codes: "png" (por omissão, o mais leve a transferir)
+# ou "svg" (vetorial, quase o dobro dos bytes sem compressão). Pode ser escolhido por
+# pedido com ?formato=png|svg
+ENGEN_QR_FORMATO = os.environ.get("ENGEN_QR_FORMATO", "png")
+
+# Grelha (colunas x linhas) por omissão do PDF de senhas para corte
+ENGEN_PDF_GRELHA = os.environ.get("ENGEN_PDF_GRELHA", "3x7")
+
+# Senhas por página na folha de QR codes (as imagens vêm de /gerente/qr/<codigo>.png|svg)
+ENGEN_QR_POR_PAGINA = int(os.environ.get("ENGEN_QR_POR_PAGINA", 60))
+
+# Leitura dos QR codes enviados pela câmara (ver funcionario/leitura_qr.py):
+# lado máximo da imagem (0 = não reduzir), fração central tentada primeiro
+# (0 = ler só a imagem inteira) e limiar adaptativo como último recurso
+ENGEN_QR_LEITURA_LADO_MAXIMO = int(os.environ.get("ENGEN_QR_LEITURA_LADO_MAXIMO", 1024))
+ENGEN_QR_LEITURA_FRACAO_CENTRO = float(os.environ.get("ENGEN_QR_LEITURA_FRACAO_CENTRO", 0.6))
+ENGEN_QR_LEITURA_LIMIAR_ADAPTATIVO = os.environ.get("ENGEN_QR_LEITURA_LIMIAR_ADAPTATIVO", "1") == "1"
+
+# Pool de leitura de QR codes por processo: threads, leituras em curso/fila no
+# máximo (acima disto o scan responde "ocupado") e espera máxima de cada pedido (s)
+ENGEN_QR_LEITURA_TRABALHADORES = int(os.environ.get("ENGEN_QR_LEITURA_TRABALHADORES", 4))
+ENGEN_QR_LEITURA_CAPACIDADE = int(os.environ.get("ENGEN_QR_LEITURA_CAPACIDADE", 8))
+ENGEN_QR_LEITURA_ESPERA = float(os.environ.get("ENGEN_QR_LEITURA_ESPERA", 5))
+
+# Leitura dos QR codes no browser do funcionário (só o código vai ao servidor);
+# depois deste número de frames seguidos sem leitura, volta a enviar imagens
+ENGEN_QR_LEITURA_NO_DISPOSITIVO = os.environ.get("ENGEN_QR_LEITURA_NO_DISPOSITIVO", "0") == "1"
+ENGEN_QR_LEITURA_TENTATIVAS_DISPOSITIVO = int(os.environ.get("ENGEN_QR_LEITURA_TENTATIVAS_DISPOSITIVO", 10))
+
+# Validade (s) do token devolvido na leitura de um código de saldo, usado no débito
+# seguinte em vez de voltar a procurar o código
+ENGEN_TOKEN_SALDO_SEGUNDOS = int(os.environ.get("ENGEN_TOKEN_SALDO_SEGUNDOS", 120))
+
+# Resgatar as senhas logo na leitura (um só pedido) quando o funcionário escolhe
+# o combustível antes de apontar a câmara
+ENGEN_SCAN_RESGATE_DIRETO = os.environ.get("ENGEN_SCAN_RESGATE_DIRETO", "0") == "1"
+
+# Cache do Django, partilhada pelos workers e pelo "manage.py processar_emissoes"
+# (versões da cache de códigos): por omissão uma tabela da base de dados, criada
+# com "manage.py createcachetable"; ENGEN_CACHE_URL=redis://... usa o Redis
+if os.environ.get("ENGEN_CACHE_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["ENGEN_CACHE_URL"],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "engen_cache",
+        }
+    }
+
+# Cache em memória da resolução de códigos (ver gerente/cache_codigos.py): filtro de
+# Bloom por empresa + LRU de entradas do índice; a versão e o registo de códigos novos
+# de cada empresa são lidos da cache do Django no máximo a cada
+# ENGEN_CACHE_CODIGOS_INTERVALO_VERSAO segundos; cada lote de códigos novos fica no
+# registo ENGEN_CACHE_CODIGOS_DURACAO_ADICOES segundos (o registo só é usado com a
+# cache Redis; sem ela, cada emissão faz as outras réplicas montar o filtro de novo)
+ENGEN_CACHE_CODIGOS = os.environ.get("ENGEN_CACHE_CODIGOS", "1") == "1"
+ENGEN_CACHE_CODIGOS_LRU = int(os.environ.get("ENGEN_CACHE_CODIGOS_LRU", 10000))
+ENGEN_CACHE_CODIGOS_FALSOS_POSITIVOS = float(os.environ.get("ENGEN_CACHE_CODIGOS_FALSOS_POSITIVOS", 0.01))
+ENGEN_CACHE_CODIGOS_INTERVALO_VERSAO = float(os.environ.get("ENGEN_CACHE_CODIGOS_INTERVALO_VERSAO", 2))
+ENGEN_CACHE_CODIGOS_DURACAO_ADICOES = int(os.environ.get("ENGEN_CACHE_CODIGOS_DURACAO_ADICOES", 3600))
+
+# Supressão de trabalho repetido no scan (ver funcionario/repeticoes.py): um frame
+# com o mesmo QR code, no mesmo sítio, que o anterior da sessão (ou, sem código,
+# com diferença média da miniatura até ENGEN_QR_REPETIDO_DIFERENCA tons de cinzento)
+# dentro da janela não é lido de novo, e o mesmo código lido pelo mesmo funcionário
+# dentro da sua janela tem a resposta anterior. Uma janela a 0 desliga a respetiva supressão.
+ENGEN_QR_REPETIDO_JANELA_FRAME = float(os.environ.get("ENGEN_QR_REPETIDO_JANELA_FRAME", 2))
+ENGEN_QR_REPETIDO_DIFERENCA = float(os.environ.get("ENGEN_QR_REPETIDO_DIFERENCA", 3))
+ENGEN_QR_REPETIDO_JANELA_CODIGO = float(os.environ.get("ENGEN_QR_REPETIDO_JANELA_CODIGO", 5))
+
+# Canal WebSocket do scan (ver funcionario/consumers.py), servido só pelos workers
+# ASGI (gunicorn -k uvicorn_worker.UvicornWorker, ver Dockerfile; em desenvolvimento
+# uvicorn projecto_engen.asgi:application). A camada de canais só liga as várias
+# ligações do mesmo funcionário (avisos de resgate): em memória por omissão,
+# ENGEN_CHANNEL_LAYER_URL=redis://... (channels_redis) com mais de um worker
+if os.environ.get("ENGEN_CHANNEL_LAYER_URL"):
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [os.environ["ENGEN_CHANNEL_LAYER_URL"]]},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+# Frames lidos por segundo em cada ligação (0 para não limitar)
+ENGEN_WS_SCAN_FPS = float(os.environ.get("ENGEN_WS_SCAN_FPS", 4))
+# O dashboard envia os frames pelo WebSocket em vez de um pedido HTTP por frame
+ENGEN_SCAN_WEBSOCKET = os.environ.get("ENGEN_SCAN_WEBSOCKET", "0") == "1"
+
+# Câmaras ligadas ao servidor (ver funcionario/cameras.py): uma thread de captura
+# por dispositivo, partilhada pelos espectadores do MJPEG; os QR codes são lidos a
+# ENGEN_CAMERA_FPS_LEITURA por segundo. ENGEN_CAMERA_DISPOSITIVO=falsa usa uma fonte
+# de vídeo falsa (ou falsa:imagem.png, que repete a imagem)
+ENGEN_CAMERA_DISPOSITIVO = os.environ.get("ENGEN_CAMERA_DISPOSITIVO", "0")
+ENGEN_CAMERA_FPS = float(os.environ.get("ENGEN_CAMERA_FPS", 10))
+ENGEN_CAMERA_FPS_LEITURA = float(os.environ.get("ENGEN_CAMERA_FPS_LEITURA", 3))
+ENGEN_CAMERA_BUFFER = int(os.environ.get("ENGEN_CAMERA_BUFFER", 4))
+ENGEN_CAMERA_ESPERA_FECHO = float(os.environ.get("ENGEN_CAMERA_ESPERA_FECHO", 5))
+
+# Resgate em lote (frotas, ver gerente/resgates.py): máximo de códigos por pedido
+ENGEN_RESGATE_LOTE_MAXIMO = int(os.environ.get("ENGEN_RESGATE_LOTE_MAXIMO", 50))
@@ -0,0 +1,45 @@
+// Leitura de QR codes no próprio browser (modo "no dispositivo").
+// Usa o BarcodeDetector nativo do browser; nos browsers sem ele, usa um
+// descodificador JS (window.jsQR) se tiver sido carregado a partir dos
+// ficheiros estáticos. Sem nenhum dos dois, LeitorQR.suportado() é false
+// e a página continua a enviar imagens ao servidor.
+(function () {
+    let detector = null;
+    let suporte = null;
+
+    async function suportado() {
+        if (suporte !== null) return suporte;
+
+        if ('BarcodeDetector' in window) {
+            try {
+                const formatos = await BarcodeDetector.getSupportedFormats();
+                if (formatos.includes('qr_code')) {
+                    detector = new BarcodeDetector({ formats: ['qr_code'] });
+                }
+            } catch (error) {
+                detector = null;
+            }
+        }
+        suporte = detector !== null || typeof window.jsQR === 'function';
+        return suporte;
+    }
+
+    // Lê o QR code do frame atual do vídeo; retorna o código ou null
+    async function ler(video, canvas) {
+        if (detector) {
+            const codigos = await detector.detect(video);
+            return codigos.length ? codigos[0].rawValue.trim() : null;
+        }
+
+        // O jsQR trabalha sobre os pixels do frame
+        const ctx = canvas.getContext('2d', { willReadFrequently: true });
+        canvas.width = video.videoWidth;
+        canvas.height = video.videoHeight;
+        ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+        const imagem = ctx.getImageData(0, 0, canvas.width, canvas.height);
+        const resultado = window.jsQR(imagem.data, imagem.width, imagem.height, { inversionAttempts: 'dontInvert' });
+        return resultado ? resultado.data.trim() : null;
+    }
+
+    window.LeitorQR = { suportado: suportado, ler: ler };
+})();